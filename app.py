@@ -1,11 +1,24 @@
 import streamlit as st
 import os
 from menu import menu
+from utils.metrics import metrics
+from utils.model_registry import registry, warmup_model_names
 
 st.set_page_config(page_title='Knowledge Navigator', layout='wide')
 
+
+@st.cache_resource
+def warm_up():
+    # Runs once per process; models listed in KNOWLEDGE_NAVIGATOR_WARMUP_MODELS are loaded before first use
+    if not warmup_model_names():
+        return []
+    from utils.model_utils import warm_up_models
+    return warm_up_models()
+
+
 def main():
     st.title('Knowledge Navigator')
+    warm_up()
 
     # Button to go back to Data Collection Page
     if st.button('Go to Data Collection'):
@@ -25,12 +38,12 @@ def main():
     if st.button('Proceed to Q&A Testing'):
         st.switch_page('pages/05_testing_qa.py')
 
-    # Check if 'data' state variable is defined
-    if 'data' in st.session_state:
+    # Check if the scanned URL frontier is defined
+    if 'frontier' in st.session_state:
         st.write("Data Available")
-        st.write("Data (URL dataframe) is defined.")
+        st.write(f"Data (scanned URL frontier, {len(st.session_state['frontier'])} URLs) is defined.")
     else:
-        st.write("Data (URL dataframe) is not defined.")
+        st.write("Data (scanned URL frontier) is not defined.")
 
     # Check if 'docs' state variable is defined
     if 'docs' in st.session_state:
@@ -38,6 +51,33 @@ def main():
     else:
         st.write("Docs (fetched and stored data collection) is not defined.")
 
+    # Stage timings collected across every session of this process
+    with st.expander("Performance"):
+        windows = {"Last 5 minutes": 300, "Last hour": 3600, "Since start": None}
+        window = windows[st.selectbox("Window", list(windows), index=0)]
+        summary = metrics.stage_summary(window or float('inf'))
+        if summary:
+            st.dataframe(summary)
+        else:
+            st.caption("No stages have run yet.")
+        failures = metrics.counters('fetch_failures_total')
+        if failures:
+            st.write("Fetch failures:", failures)
+        traces = [{'trace': trace_id, 'root': spans[0].name, 'spans': len(spans),
+                   'seconds': round(max(span.start + span.seconds for span in spans) - spans[0].start, 3),
+                   'errors': sum(span.status == 'error' for span in spans)}
+                  for trace_id, spans in metrics.recent_traces(10).items()]
+        if traces:
+            st.caption("Recent requests")
+            st.dataframe(traces)
+        st.download_button("Download Prometheus metrics", metrics.to_prometheus(), file_name="metrics.prom")
+        st.download_button("Download trace (JSONL)", metrics.to_jsonl(), file_name="trace.jsonl")
+
+    # Models shared by all sessions
+    with st.expander("Loaded models"):
+        st.caption(f"Loads: {registry.loads}, reuses: {registry.hits}")
+        st.dataframe(registry.stats())
+
     # Render the navigation menu
     # menu()
 
@@ -0,0 +1,129 @@
+"""Compare the int8 ONNX Runtime embedding backend with sentence-transformers.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_embeddings
+    python -m benchmarks.bench_embeddings --tiny-hidden 384 --tiny-layers 6
+    python -m benchmarks.bench_embeddings --model thenlper/gte-small --batch-sizes 16 32 64 --threads 1 2 4
+
+Without --model a tiny model is generated locally, so the benchmark runs
+offline: a small random BERT when torch and transformers are installed
+(exported like a real model and compared with HuggingFaceEmbeddings),
+otherwise an ONNX-only model whose float version is the reference. Every
+batch size and thread count is timed in docs/s and compared with the
+reference vectors: per-document cosine similarity and how many of each
+document's nearest neighbours stay the same. --save writes the report as
+JSON; --baseline fails when the best docs/s dropped by more than
+--tolerance, and --min-cosine fails on poor agreement.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_qa import generate_corpus
+from utils.model_utils import acquire_embeddings
+from utils.onnx_embeddings import (CONFIG_FILE, QuantizedEmbeddings, build_tiny_model, build_tiny_transformer,
+                                   export_model, model_dir_for)
+
+
+def reference_and_model_dir(args, texts, workdir):
+    """(description, reference Embeddings, exported model directory)."""
+    if args.model:
+        model_dir = model_dir_for(args.model)
+        if not os.path.isfile(os.path.join(model_dir, CONFIG_FILE)):
+            export_model(args.model, model_dir)
+        return args.model, acquire_embeddings(args.model).model, model_dir
+    try:
+        hf_dir = build_tiny_transformer(os.path.join(workdir, 'tiny-bert'), texts, hidden_size=args.tiny_hidden,
+                                        layers=args.tiny_layers)
+    except ImportError:
+        model_dir = build_tiny_model(os.path.join(workdir, 'tiny-onnx'), texts, dim=args.tiny_hidden,
+                                     hidden=args.tiny_hidden * 4)
+        return "tiny ONNX model (float)", QuantizedEmbeddings(model_dir, quantized=False), model_dir
+    model_dir = export_model(hf_dir, os.path.join(workdir, 'tiny-bert-onnx'))
+    return "tiny BERT (sentence-transformers)", acquire_embeddings(hf_dir).model, model_dir
+
+
+def timed_embed(embeddings, texts):
+    embeddings.embed_documents(texts[:8])  # warm-up: first calls allocate buffers and pick kernels
+    start = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    return vectors, len(texts) / (time.perf_counter() - start)
+
+
+def agreement(reference, vectors, k=10):
+    """Cosine similarity of each document's two vectors, and the overlap of their k nearest neighbours."""
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    cosines = (reference * vectors).sum(axis=1)
+    k = min(k, len(vectors) - 1)
+    sample = np.arange(min(len(vectors), 500))
+    expected = np.argsort(-(reference[sample] @ reference.T), axis=1)[:, 1:k + 1]
+    found = np.argsort(-(vectors[sample] @ vectors.T), axis=1)[:, 1:k + 1]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(expected, found)])
+    return {'mean_cosine': round(float(cosines.mean()), 6), 'min_cosine': round(float(cosines.min()), 6),
+            f'neighbours@{k}': round(float(overlap), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', help="Hugging Face model name; default: a tiny locally generated model")
+    parser.add_argument('--tiny-hidden', type=int, default=64, help="generated model width (384 is MiniLM's)")
+    parser.add_argument('--tiny-layers', type=int, default=2, help="generated BERT layers (6 is MiniLM's)")
+    parser.add_argument('--docs', type=int, default=2000, help="synthetic documents to embed")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 0], help="ONNX Runtime threads, 0 = all cores")
+    parser.add_argument('--save', help="write the report to this JSON file")
+    parser.add_argument('--baseline', help="report JSON to compare the best docs/s against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed docs/s drop from the baseline")
+    parser.add_argument('--min-cosine', type=float, default=0.99, help="fail when mean cosine agreement is lower")
+    args = parser.parse_args()
+
+    docs, _ = generate_corpus(args.docs, n_questions=0)
+    texts = [doc.page_content for doc in docs]
+    with tempfile.TemporaryDirectory() as workdir:
+        reference_name, reference, model_dir = reference_and_model_dir(args, texts, workdir)
+        reference_vectors, reference_rate = timed_embed(reference, texts)
+        print(f"{len(texts)} documents, reference {reference_name}: {reference_rate:.1f} docs/s")
+        print(f"{'batch':>6} {'threads':>8} {'docs/s':>10} {'speedup':>8} {'mean cos':>10} {'min cos':>10} {'neighbours':>11}")
+        runs = []
+        for threads in args.threads:
+            for batch_size in args.batch_sizes:
+                model = QuantizedEmbeddings(model_dir, batch_size=batch_size, intra_op_threads=threads or None)
+                vectors, rate = timed_embed(model, texts)
+                run = {'batch_size': batch_size, 'threads': threads, 'docs_per_second': round(rate, 2),
+                       'speedup': round(rate / reference_rate, 2), **agreement(reference_vectors, vectors)}
+                runs.append(run)
+                neighbours = next(value for key, value in run.items() if key.startswith('neighbours@'))
+                print(f"{batch_size:>6} {threads or 'all':>8} {rate:>10.1f} {run['speedup']:>7.2f}x "
+                      f"{run['mean_cosine']:>10.5f} {run['min_cosine']:>10.5f} {neighbours:>11.1%}")
+
+    best = max(runs, key=lambda run: run['docs_per_second'])
+    report = {'reference': reference_name, 'documents': len(texts),
+              'reference_docs_per_second': round(reference_rate, 2), 'best': best, 'runs': runs}
+    print(f"Best: batch {best['batch_size']}, threads {best['threads'] or 'all'}, "
+          f"{best['docs_per_second']} docs/s ({best['speedup']}x)")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    failures = [f"batch {run['batch_size']}, threads {run['threads']}: mean cosine {run['mean_cosine']}"
+                for run in runs if run['mean_cosine'] < args.min_cosine]
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)['best']['docs_per_second']
+        if best['docs_per_second'] < old * (1 - args.tolerance):
+            failures.append(f"best docs/s {old} -> {best['docs_per_second']}")
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
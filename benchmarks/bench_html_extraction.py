@@ -0,0 +1,117 @@
+"""Compare the single-pass extractor against the previous BeautifulSoup code.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_html_extraction
+    python -m benchmarks.bench_html_extraction --corpus path/to/html_dir
+
+Without --corpus a fixed, seeded corpus of synthetic pages is generated so
+numbers are comparable between runs and machines.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+from bs4 import BeautifulSoup
+
+from utils.html_extraction import etree, extract_html
+
+WORDS = ("navigator knowledge vector index crawler document embedding model query "
+         "answer page link image video source content storage retrieval").split()
+
+
+def generate_corpus(n_pages=200, seed=0):
+    rng = random.Random(seed)
+    pages = []
+    for i in range(n_pages):
+        # Mix of small and very large pages, like a real crawl
+        n_blocks = rng.choice([20, 50, 200, 1000, 3000])
+        parts = [f"<html><head><title>Page {i}</title>",
+                 "<style>body { color: #333 }</style><script>var x = 1;</script></head><body>"]
+        for b in range(n_blocks):
+            kind = rng.random()
+            words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+            if kind < 0.5:
+                parts.append(f"<p>{words} <a href='/page/{rng.randint(0, 5000)}'>more</a></p>")
+            elif kind < 0.7:
+                parts.append(f"<div class='card'><img src='/img/{b}.png' alt='{words[:20]}'><span>{words}</span></div>")
+            elif kind < 0.75:
+                parts.append(f"<video controls><source src='/v/{b}.mp4'><source src='/v/{b}.webm'></video>")
+            elif kind < 0.9:
+                parts.append(f"<ul><li><a href='https://example.com/{b}'>{words}</a></li></ul>")
+            else:
+                parts.append(f"<h2>{words}</h2>")
+        parts.append("</body></html>")
+        pages.append(''.join(parts))
+    return pages
+
+
+def load_corpus(path):
+    pages = []
+    for file_path in sorted(glob.glob(os.path.join(path, '**', '*.htm*'), recursive=True)):
+        with open(file_path, encoding='utf-8', errors='replace') as f:
+            pages.append(f.read())
+    return pages
+
+
+def legacy_extract(html):
+    """The code this module replaced: two separate html.parser passes."""
+    soup = BeautifulSoup(html, 'html.parser')
+    links = soup.find_all('a')
+    urls = {link.get('href') for link in links if link.get('href') is not None}
+    title_tag = soup.find('title')
+    page_title = title_tag.text if title_tag else 'No Title Found'
+
+    soup = BeautifulSoup(html, 'html.parser')
+    results = []
+    for img in soup.find_all('img'):
+        results.append({'tag': 'img', 'src': img.get('src'), 'alt': img.get('alt', 'N/A')})
+    for video in soup.find_all('video'):
+        results.append({'tag': 'video', 'src': [source.get('src') for source in video.find_all('source')]})
+    return urls, page_title, results
+
+
+def time_it(fn, pages, repeat):
+    best = float('inf')
+    outputs = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [fn(page) for page in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def media_key(media):
+    return sorted(json.dumps(m, sort_keys=True) for m in media)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help="directory of .html files to use instead of the generated corpus")
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus) if args.corpus else generate_corpus(args.pages)
+    total_mb = sum(len(p) for p in pages) / 1e6
+    print(f"Corpus: {len(pages)} pages, {total_mb:.1f} MB")
+
+    legacy_time, legacy_out = time_it(legacy_extract, pages, args.repeat)
+    print(f"{'legacy (bs4 x2)':<20} {legacy_time:8.3f}s  {total_mb / legacy_time:8.2f} MB/s")
+
+    backends = ['bs4'] + (['lxml'] if etree is not None else [])
+    for backend in backends:
+        elapsed, out = time_it(lambda html: extract_html(html, backend=backend), pages, args.repeat)
+        mismatches = sum(
+            1 for (urls, title, media), page in zip(legacy_out, out)
+            if urls != page.links or title != page.title or media_key(media) != media_key(page.media)
+        )
+        print(f"{'extract_html ' + backend:<20} {elapsed:8.3f}s  {total_mb / elapsed:8.2f} MB/s  "
+              f"speedup {legacy_time / elapsed:5.2f}x  mismatched pages: {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Run a file of questions through the Q&A retrieval and generation chain.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_qa
+    python -m benchmarks.bench_qa --questions questions.jsonl --package out/docs_vectors.zip \
+        --embedding-model thenlper/gte-small --llm mistralai/Mistral-7B-Instruct-v0.2
+
+Questions are read from JSONL ({"question": ..., "expected_sources": [...]}),
+CSV (question, expected_sources separated by '|') or plain text, one per
+line. Without --questions a seeded synthetic corpus and matching questions
+are generated, and by default the stub LLM and hashing embedder are used,
+so the benchmark needs no network and can run in CI. --save writes the
+report as JSON; --baseline compares p95 latencies against a saved report and
+exits non-zero on regressions.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+from utils.metrics import metrics
+from utils.model_utils import HASHING_MODEL_NAME, STUB_LLM_NAME, StubLLM, acquire_embeddings, acquire_llm
+from utils.qa_chain import StreamedAnswer, astream_answer
+from utils.storage_utils import content_hash
+from utils.vector_index import VectorIndexManager, extract_vector_package, is_vector_package, open_vector_package
+
+# embed_query and search are the spans qa_chain.retrieve records; retrieve is both plus building the prompt
+STAGES = ('embed_query', 'search', 'retrieve', 'first_token', 'generate', 'total')
+DEFAULT_TEMPLATE = ("You are a knowledgeable assistant answering the following question based on the "
+                    "provided documents: {context} Question: {question}")
+TOPICS = ("crawler frontier politeness robots sitemap", "embedding model vector dimension normalize cosine",
+          "faiss index nprobe recall quantization", "streamlit session page widget rerun",
+          "chunk overlap tokenizer splitter duplicate", "package manifest zip docstore mmap",
+          "prompt template answer context question", "latency throughput percentile benchmark")
+
+
+def generate_corpus(n_docs=500, n_questions=200, seed=0):
+    """Synthetic documents mixing topic words, and questions quoting one document each."""
+    rng = random.Random(seed)
+    vocabulary = [word for topic in TOPICS for word in topic.split()]
+    docs = []
+    for i in range(n_docs):
+        topic = TOPICS[i % len(TOPICS)].split()
+        words = [rng.choice(topic if rng.random() < 0.3 else vocabulary) for _ in range(80)]
+        words += [f"term{i}x{j}" for j in range(3)]
+        rng.shuffle(words)
+        docs.append(Document(page_content=' '.join(words), metadata={'source': f"https://example.com/doc/{i}"}))
+
+    questions = []
+    for doc in rng.sample(docs, min(n_questions, n_docs)):
+        words = doc.page_content.split()
+        start = rng.randrange(0, len(words) - 12)
+        questions.append({'question': "What about " + ' '.join(words[start:start + 12]) + "?",
+                          'expected_sources': [doc.metadata['source']]})
+    return docs, questions
+
+
+def load_questions(path):
+    questions = []
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    questions.append({'question': item['question'],
+                                      'expected_sources': item.get('expected_sources') or []})
+    elif path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                expected = row.get('expected_sources') or ''
+                questions.append({'question': row['question'],
+                                  'expected_sources': [s for s in expected.split('|') if s]})
+    else:
+        with open(path, encoding='utf-8') as f:
+            questions = [{'question': line.strip(), 'expected_sources': []} for line in f if line.strip()]
+    return questions
+
+
+def load_vectorstore(args, embedding):
+    if args.package:
+        package_dir = args.package
+        if not os.path.isdir(package_dir):
+            if not is_vector_package(package_dir):
+                sys.exit(f"{package_dir} is not a vector store package")
+            stat = os.stat(package_dir)
+            key = content_hash(f"{os.path.abspath(package_dir)}:{stat.st_size}:{stat.st_mtime_ns}")[:16]
+            package_dir = extract_vector_package(package_dir, key)
+        return open_vector_package(package_dir, embedding)[0]
+    if args.index:
+        return VectorIndexManager.open(args.index).as_vectorstore(embedding)
+    return None
+
+
+def percentiles(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return {'p50': round(float(p50), 2), 'p95': round(float(p95), 2), 'p99': round(float(p99), 2)}
+
+
+def _child_seconds(parent, stages):
+    """{stage: seconds} for the spans of `stages` opened directly under `parent`."""
+    seconds = dict.fromkeys(stages)
+    for span in reversed(list(metrics.spans)):
+        if span.parent_id == parent.span_id and span.name in seconds and seconds[span.name] is None:
+            seconds[span.name] = span.seconds
+    return seconds
+
+
+async def run_question(item, vectorstore, embedding, llm, template, k, semaphore):
+    async with semaphore:
+        # The same retrieval and streaming chain as the Q&A page, timed by the StreamedAnswer it fills in
+        # and by the spans it records under this request's span
+        result = StreamedAnswer(item['question'])
+        with metrics.span('qa_request') as request:
+            async for _ in astream_answer(result, vectorstore, embedding, template, llm, k=k):
+                pass
+        timings = {
+            **_child_seconds(request, ('embed_query', 'search')),
+            'retrieve': result.retrieval_seconds,
+            # An empty answer has no first token; count it as arriving with the end of the stream
+            'first_token': result.first_token_seconds or result.total_seconds,
+            'generate': result.total_seconds - result.retrieval_seconds,
+            'total': result.total_seconds,
+        }
+
+        retrieved = {doc.metadata.get('source') for doc in result.documents}
+        hit = bool(retrieved & set(item['expected_sources'])) if item['expected_sources'] else None
+        return timings, hit, result.answer
+
+
+async def run_benchmark(questions, vectorstore, embedding, llm, template=DEFAULT_TEMPLATE, k=4, concurrency=8):
+    """Answer `questions` with at most `concurrency` in flight. Returns the report dict."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_question(item, vectorstore, embedding, llm, template, k, semaphore)
+                                     for item in questions))
+    elapsed = time.perf_counter() - start
+
+    hits = [hit for _, hit, _ in results if hit is not None]
+    return {
+        'questions': len(questions),
+        'concurrency': concurrency,
+        'k': k,
+        'seconds': round(elapsed, 3),
+        'throughput_qps': round(len(questions) / elapsed, 2) if elapsed else None,
+        f'hit_rate@{k}': round(sum(hits) / len(hits), 4) if hits else None,
+        'latency_ms': {stage: percentiles([timings[stage] for timings, _, _ in results]) for stage in STAGES},
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Stages whose p95 latency grew by more than `tolerance` (a fraction) over the baseline."""
+    regressions = []
+    for stage in STAGES:
+        old = baseline.get('latency_ms', {}).get(stage, {}).get('p95')
+        new = report['latency_ms'][stage]['p95']
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{stage} p95 {old:.1f} ms -> {new:.1f} ms")
+    return regressions
+
+
+def print_report(report):
+    print(f"{report['questions']} questions, concurrency {report['concurrency']}: "
+          f"{report['seconds']:.2f}s, {report['throughput_qps']} questions/s")
+    hit_key = f"hit_rate@{report['k']}"
+    if report[hit_key] is not None:
+        print(f"Retrieval {hit_key}: {report[hit_key]:.1%}")
+    print(f"{'stage':<12} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for stage, values in report['latency_ms'].items():
+        print(f"{stage:<12} {values['p50']:>10.2f} {values['p95']:>10.2f} {values['p99']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', help="questions file (.jsonl, .csv or text); default: synthetic")
+    parser.add_argument('--package', help="vector store package (.zip or extracted directory)")
+    parser.add_argument('--index', help="vector index directory written by the encoding page")
+    parser.add_argument('--embedding-model', default=HASHING_MODEL_NAME,
+                        help=f"Hugging Face model name, or {HASHING_MODEL_NAME} for the offline test embedder")
+    parser.add_argument('--llm', default=STUB_LLM_NAME, help=f"Hugging Face repo id, or {STUB_LLM_NAME}")
+    parser.add_argument('--stub-first-token-delay', type=float, default=0.05)
+    parser.add_argument('--stub-token-delay', type=float, default=0.002)
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--docs', type=int, default=500, help="synthetic corpus size")
+    parser.add_argument('--save', help="write the report to this JSON file")
+    parser.add_argument('--baseline', help="report JSON to compare p95 latencies against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p95 growth over the baseline")
+    args = parser.parse_args()
+
+    embedding = acquire_embeddings(args.embedding_model).model
+    if args.llm == STUB_LLM_NAME:
+        llm = StubLLM(first_token_delay=args.stub_first_token_delay, token_delay=args.stub_token_delay)
+    else:
+        llm = acquire_llm(args.llm).model
+
+    vectorstore = load_vectorstore(args, embedding)
+    if args.questions:
+        questions = load_questions(args.questions)
+        if vectorstore is None:
+            sys.exit("--questions needs --package or --index")
+    else:
+        docs, questions = generate_corpus(args.docs)
+        if vectorstore is None:
+            vectorstore = FAISS.from_documents(docs, embedding)
+
+    report = asyncio.run(run_benchmark(questions, vectorstore, embedding, llm, template=args.template,
+                                       k=args.k, concurrency=args.concurrency))
+    print_report(report)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Measure cold import time and first-render time of the app and each page.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --save startup.json
+    python -m benchmarks.bench_startup --baseline startup.json
+
+Every script is rendered in a fresh interpreter with Streamlit's testing
+harness, so the first render includes importing everything the script
+needs; the import share and the slowest packages come from
+`python -X importtime`. A second render in the same process shows the cost
+of a rerun once imports and caches are warm. --baseline exits non-zero
+when a first render got slower than the saved report by more than
+--tolerance.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+RENDER_MARKER = "--- first render ---"
+SCRIPTS = ['app.py'] + sorted(os.path.join('pages', name) for name in os.listdir('pages') if name.endswith('.py'))
+
+
+def render(script, timeout):
+    """Child process: render `script` twice and print the timings as JSON."""
+    start = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    harness_seconds = time.perf_counter() - start
+
+    modules_before = set(sys.modules)
+    at = AppTest.from_file(os.path.abspath(script), default_timeout=timeout)
+    # Marks where the script's own imports start and end in the -X importtime output
+    print(RENDER_MARKER, file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    at.run()
+    first_render = time.perf_counter() - start
+    print(RENDER_MARKER, file=sys.stderr, flush=True)
+    modules_loaded = len(set(sys.modules) - modules_before)
+
+    start = time.perf_counter()
+    at.run()
+    rerun = time.perf_counter() - start
+    print(json.dumps({
+        'harness_seconds': harness_seconds,
+        'first_render_seconds': first_render,
+        'rerun_seconds': rerun,
+        'modules_loaded': modules_loaded,
+        'exceptions': [str(e.value).splitlines()[0] for e in at.exception],
+    }))
+
+
+def render_imports(stderr):
+    """{top-level package: seconds} imported during the first render, from `-X importtime` output."""
+    parts = stderr.split(RENDER_MARKER)
+    totals = {}
+    for line in (parts[1] if len(parts) > 2 else '').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are already counted in their parent's cumulative time
+        if name.startswith('  '):
+            continue
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(cumulative) / 1e6
+    return totals
+
+
+def measure(script, timeout):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'benchmarks.bench_startup',
+                             '--child', script, '--timeout', str(timeout)],
+                            capture_output=True, text=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+    if result.returncode or not lines:
+        return {'script': script, 'error': (result.stderr.strip().splitlines() or ['failed'])[-1]}
+    report = json.loads(lines[-1])
+    imports = render_imports(result.stderr)
+    report['script'] = script
+    report['import_seconds'] = round(sum(imports.values()), 3)
+    report['slowest_imports'] = sorted(imports.items(), key=lambda item: -item[1])[:5]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scripts', nargs='*', default=SCRIPTS)
+    parser.add_argument('--repeat', type=int, default=3, help="fresh processes per script; the best is reported")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--save', help="write the report to this JSON file")
+    parser.add_argument('--baseline', help="report JSON to compare first-render times against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed first-render growth over the baseline")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        render(args.child, args.timeout)
+        return
+
+    reports = []
+    print(f"{'script':<32} {'first render s':>15} {'imports s':>10} {'rerun s':>10} {'modules':>8}  slowest imports")
+    for script in args.scripts:
+        runs = [measure(script, args.timeout) for _ in range(args.repeat)]
+        ok = [run for run in runs if 'error' not in run]
+        if not ok:
+            print(f"{script:<32} failed: {runs[-1]['error']}")
+            reports.append(runs[-1])
+            continue
+        best = min(ok, key=lambda run: run['first_render_seconds'])
+        reports.append(best)
+        imports = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in best['slowest_imports'])
+        print(f"{script:<32} {best['first_render_seconds']:>15.2f} {best['import_seconds']:>10.2f} "
+              f"{best['rerun_seconds']:>10.2f} "
+              f"{best['modules_loaded']:>8}  {imports}")
+        for exception in best['exceptions']:
+            print(f"{'':<32} raised: {exception}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(reports, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {report['script']: report for report in json.load(f)}
+        regressions = []
+        for report in reports:
+            old = baseline.get(report['script'], {}).get('first_render_seconds')
+            new = report.get('first_render_seconds')
+            if old and new and new > old * (1 + args.tolerance):
+                regressions.append(f"{report['script']} first render {old:.2f}s -> {new:.2f}s")
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,126 @@
 import streamlit as st
 from menu import menu
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from datetime import datetime
-
-def find_linked_urls_and_title(url):
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            links = soup.find_all('a')
-            urls = {link.get('href') for link in links if link.get('href') is not None}
-            title_tag = soup.find('title')
-            page_title = title_tag.text if title_tag else 'No Title Found'
-            return urls, page_title
-        else:
-            st.write(f"Failed to retrieve {url}")
-            return set(), 'No Title Found'
-    except Exception as e:
-        st.write(f"An error occurred with {url}: {e}")
-        return set(), 'No Title Found'
-
-def convert_to_absolute_urls(base_url, links):
-    return {urljoin(base_url, link) if not link.startswith('http') else link for link in links}
-
-def categorize_links(base_url, links):
-    internal_links, external_links = set(), set()
-    for link in links:
-        if urlparse(link).netloc == urlparse(base_url).netloc:
-            internal_links.add(link)
-        else:
-            external_links.add(link)
-    return internal_links, external_links
-
-def display_editable_table(df):
-    edited_df = st.data_editor(data=df, key="data_editor_key", num_rows="dynamic")  # Add num_rows="dynamic" to allow adding/deleting rows
-    return edited_df
-
-def prepare_dataframe(df):
-    if "Ignore" not in df.columns:
-        df["Ignore"] = False  # Initialize all values as False
-    return df
-
-def store_data(df):
-    st.session_state['data'] = df
+import time
+
+from utils.data_processing import crawl, crawl_result_rows
+from utils.storage_utils import PageCache
+from utils.url_frontier import URLFrontier
+
+PAGE_SIZES = [100, 500, 1000, 5000]
+
+@st.cache_resource
+def get_page_cache():
+    return PageCache()
+
+def display_editable_table(frontier):
+    # Only one page of the frontier is turned into a DataFrame, so the table stays fast with millions of URLs
+    filter_cols = st.columns(4)
+    url_type = filter_cols[0].selectbox("Type", ["All", "Internal", "External"])
+    hide_ignored = filter_cols[1].checkbox("Hide ignored", value=False)
+    page_size = filter_cols[2].selectbox("Rows per page", PAGE_SIZES, index=2)
+    url_type = None if url_type == "All" else url_type
+    total = frontier.count(url_type=url_type, include_ignored=not hide_ignored)
+    page_count = max(1, -(-total // page_size))
+    page_number = filter_cols[3].number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1)
+
+    view = frontier.page((page_number - 1) * page_size, page_size, url_type=url_type,
+                         include_ignored=not hide_ignored)
+    st.caption(f"{total} of {len(frontier)} URLs")
+    # Bumped whenever rows are added or removed, so the editor starts again from the renumbered rows
+    revision = st.session_state.get('frontier_revision', 0)
+    key = f"data_editor_key_{url_type}_{hide_ignored}_{page_size}_{page_number}_{revision}"
+    edited_df = st.data_editor(data=view, key=key, num_rows="dynamic", disabled=["Scanned DateTime"])
+    return edited_df, view, key
+
+def store_edits(frontier, view, edits):
+    """Write the editor's changes through to the frontier. Returns True when rows were added or removed."""
+    removed = [view.index[position] for position in edits.get('deleted_rows', [])]
+    added = list(edits.get('added_rows', []))
+    for position, changes in edits.get('edited_rows', {}).items():
+        row_id = view.index[int(position)]
+        if set(changes) - {'Ignore'}:
+            # A changed URL, type or page name replaces the row
+            removed.append(row_id)
+            added.append({**view.loc[row_id].to_dict(), **changes})
+        elif bool(changes['Ignore']) != bool(view.at[row_id, 'Ignore']):
+            frontier.set_ignore([row_id], changes['Ignore'])
+    added = [(row['URL'].strip(), row.get('Type'), row.get('Page Name'), row.get('Scanned DateTime'),
+              bool(row.get('Ignore'))) for row in added if (row.get('URL') or '').strip()]
+    if not removed and not added:
+        return False
+    frontier.delete(removed)
+    frontier.add_many(added)
+    return True
 
 def main():
     #menu()
 
     st.title("Data Source Configuration")
     
-    # Initialize 'scanned_urls' with all columns, including 'Ignore'
-    if 'scanned_urls' not in st.session_state:
-        st.session_state['scanned_urls'] = pd.DataFrame(columns=['URL', 'Type', 'Page Name', 'Scanned DateTime', 'Ignore'])
+    # Scanned URLs, deduplicated on their canonical form, with an 'Ignore' flag per URL
+    if 'frontier' not in st.session_state:
+        st.session_state['frontier'] = URLFrontier()
+    frontier = st.session_state['frontier']
     
     st.subheader("Scan Websites for URLs")
     url_input = st.text_area("Enter URLs to scan, separated by new lines:", "https://fubarlabs.org")
     url_list = [url.strip() for url in url_input.strip().split('\n') if url.strip()]
+
+    with st.expander("Crawler Settings"):
+        max_depth = st.number_input("Follow internal links to depth", min_value=0, max_value=5, value=0)
+        max_pages = st.number_input("Maximum pages to fetch", min_value=1, value=500)
+        max_workers = st.number_input("Concurrent requests", min_value=1, max_value=128, value=16)
+        per_host_concurrency = st.number_input("Concurrent requests per host", min_value=1, max_value=32, value=4)
+        requests_per_second = st.number_input("Requests per second per host (0 = unlimited)", min_value=0.0, value=2.0)
+        timeout = st.number_input("Request timeout (seconds)", min_value=1, value=10)
+        use_cache = st.checkbox("Use page cache (conditional re-fetch)", value=True)
+        only_changed = st.checkbox("Only add links from pages that changed since the last scan", value=False)
+
     scan_button_clicked = st.button("Scan URLs")
-    
+
     if scan_button_clicked:
-        for url in url_list:
-            unique_urls, page_title = find_linked_urls_and_title(url)
-            scan_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            absolute_urls = convert_to_absolute_urls(url, unique_urls)
-            internal_links, external_links = categorize_links(url, absolute_urls)
-            
-            new_entries = pd.DataFrame([(url, 'Internal', page_title, scan_datetime, False) for url in internal_links] + 
-                                       [(url, 'External', page_title, scan_datetime, False) for url in external_links],
-                                       columns=['URL', 'Type', 'Page Name', 'Scanned DateTime', 'Ignore'])  # Include 'Ignore' column
-            st.session_state['scanned_urls'] = pd.concat([st.session_state['scanned_urls'], new_entries]).drop_duplicates().reset_index(drop=True)
-            store_data(st.session_state['scanned_urls'])
-
-    if not st.session_state['scanned_urls'].empty:
-        # Prepare the dataframe, this now includes the 'Ignore' column from the start
-        prepared_df = prepare_dataframe(st.session_state['scanned_urls'])
-        
+        progress_text = st.empty()
+        live_table = st.empty()
+        links_before = len(frontier)
+        pages_done = 0
+        pages_unchanged = 0
+        last_render = 0.0
+        for result in crawl(url_list,
+                            max_depth=int(max_depth),
+                            max_pages=int(max_pages),
+                            max_workers=int(max_workers),
+                            per_host_concurrency=int(per_host_concurrency),
+                            requests_per_second=requests_per_second or None,
+                            timeout=timeout,
+                            cache=get_page_cache() if use_cache else None):
+            pages_done += 1
+            if result.error:
+                st.write(f"Failed to retrieve {result.url}: {result.error}")
+            if not result.changed:
+                pages_unchanged += 1
+                if only_changed:
+                    continue
+            frontier.add_many(crawl_result_rows(result))
+            progress_text.write(f"Scanned {pages_done} pages ({pages_unchanged} unchanged), "
+                                f"found {len(frontier) - links_before} new links...")
+            # Re-rendering the table is the expensive part, so throttle it
+            now = time.monotonic()
+            if now - last_render > 0.5:
+                live_table.dataframe(frontier.tail(200))
+                last_render = now
+        live_table.empty()
+
+    if len(frontier):
         # Display the editable table with an "Ignore" column
-        edited_df = display_editable_table(prepared_df)
-        
-        if edited_df is not None:
-            st.session_state['scanned_urls'] = edited_df
+        edited_df, view, key = display_editable_table(frontier)
+        if key in st.session_state and store_edits(frontier, view, st.session_state[key]):
+            st.session_state['frontier_revision'] = st.session_state.get('frontier_revision', 0) + 1
+            st.rerun()
 
         # Access the edits made to the table
-        if "data_editor_key" in st.session_state:
-            edits = st.session_state["data_editor_key"]
+        if key in st.session_state:
+            edits = st.session_state[key]
             st.write("Edits made to the table:")
             st.write(edits)
 
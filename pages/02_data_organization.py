@@ -1,112 +1,128 @@
 # Import necessary libraries
 import streamlit as st
-import pandas as pd
-from langchain_community.document_loaders import AsyncHtmlLoader
-from langchain.schema import Document
-from pydantic import BaseModel
-
-from crewai import Agent, Task, Crew
-from crewai_tools import BaseTool
 import json
-import asyncio
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup
-
-# Define the custom tool for analyzing HTML content
-class HtmlContentAnalyzer(BaseTool):
-    name: str = "HTML Content Analyzer"
-    description: str = "Analyzes HTML content to find and report image and video tags."
-
-    def _run(self, html_content: str) -> str:
-        soup = BeautifulSoup(html_content, 'html.parser')
-        results = []
-
-        # Extract all image tags
-        for img in soup.find_all('img'):
-            img_details = {
-                'tag': 'img',
-                'src': img.get('src'),
-                'alt': img.get('alt', 'N/A')
-            }
-            results.append(img_details)
-
-        # Extract all video tags
-        for video in soup.find_all('video'):
-            video_details = {
-                'tag': 'video',
-                'src': [source.get('src') for source in video.find_all('source')]
-            }
-            results.append(video_details)
-
-        return json.dumps(results)
-
-# Define the HTML Reviewer agent and task
-html_reviewer = Agent(
-    role='HTML Reviewer',
-    goal='Identify and report HTML tags related to images and videos.',
-    verbose=True,
-    memory=True,
-    backstory=(
-        "As an HTML Reviewer, you meticulously scan through web pages, identifying "
-        "and cataloging every image and video, ensuring no visual content is overlooked."
-    ),
-    tools=[HtmlContentAnalyzer()],
-    allow_delegation=True
-)
-
-review_html_task = Task(
-    description=(
-        "Analyze the HTML content of documents to find image and video tags. "
-        "Report the URLs and other relevant attributes of these tags."
-    ),
-    expected_output='A JSON string with details of all image and video tags found.',
-    tools=[HtmlContentAnalyzer()],
-    agent=html_reviewer,
-)
-
-document_review_crew = Crew(
-    agents=[html_reviewer],
-    tasks=[review_html_task]
-)
-
-# Async function to fetch documents
-async def fetch_documents(urls):
-    loader = AsyncHtmlLoader(urls)
-    docs = await loader.aload()
-    return docs
+
+from utils.data_processing import fetch_documents, is_valid_url, review_documents_local
+from utils.html_extraction import extract_html
+from utils.metrics import metrics
+from utils.storage_utils import FETCH_JOB, JobCheckpoint, JobInUseError, PageCache, job_name
+
+PREVIEW_ROWS = 1000
+
+# The crewAI reviewer is opt-in, so crewAI is only imported and the agent only
+# built the first time it is used, then shared by every session
+@st.cache_resource
+def get_document_review_crew():
+    from crewai import Agent, Task, Crew
+    from crewai_tools import BaseTool
+
+    # Define the custom tool for analyzing HTML content
+    class HtmlContentAnalyzer(BaseTool):
+        name: str = "HTML Content Analyzer"
+        description: str = "Analyzes HTML content to find and report image and video tags."
+
+        def _run(self, html_content: str) -> str:
+            # Image and video tags, in document order
+            return json.dumps(extract_html(html_content).media)
+
+    # Define the HTML Reviewer agent and task
+    html_reviewer = Agent(
+        role='HTML Reviewer',
+        goal='Identify and report HTML tags related to images and videos.',
+        verbose=True,
+        memory=True,
+        backstory=(
+            "As an HTML Reviewer, you meticulously scan through web pages, identifying "
+            "and cataloging every image and video, ensuring no visual content is overlooked."
+        ),
+        tools=[HtmlContentAnalyzer()],
+        allow_delegation=True
+    )
+
+    review_html_task = Task(
+        description=(
+            "Analyze the HTML content of documents to find image and video tags. "
+            "Report the URLs and other relevant attributes of these tags."
+        ),
+        expected_output='A JSON string with details of all image and video tags found.',
+        tools=[HtmlContentAnalyzer()],
+        agent=html_reviewer,
+    )
+
+    return Crew(
+        agents=[html_reviewer],
+        tasks=[review_html_task]
+    )
+
+@st.cache_resource
+def get_page_cache():
+    return PageCache()
+
+# Review documents with the crewAI agent (opt-in, sends all HTML through one LLM call)
+@metrics.timed('review_documents_agent')
+def review_documents_with_agent(docs):
+    import pandas as pd
+
+    html_content = ' '.join(doc.page_content for doc in docs)
+    result = get_document_review_crew().kickoff(inputs={'html_content': html_content})
+    return pd.DataFrame(json.loads(result))  # Convert JSON string to Python object for easier processing
 
 # Review documents function
-def review_documents(docs):
-    html_content = ' '.join(doc.text for doc in docs if hasattr(doc, 'text'))
-    result = document_review_crew.kickoff(inputs={'html_content': html_content})
-    return json.loads(result)  # Convert JSON string to Python object for easier processing
+def review_documents(docs, use_agent=False):
+    if use_agent:
+        return review_documents_with_agent(docs)
+    return review_documents_local(docs)
 
 # Main function for Streamlit app
 def fetch_clean_organize_page():
     st.title("Fetch, Clean, and Organize Documents")
 
     # Check session state
-    if 'data' not in st.session_state:
+    if 'frontier' not in st.session_state or not len(st.session_state['frontier']):
         st.warning("No data found. Please go back to the previous page and scan URLs first.")
         return
 
-    data = st.session_state['data']
-    st.write("URLs to fetch and clean:")
-    st.write(data)
+    frontier = st.session_state['frontier']
+    st.write(f"URLs to fetch and clean: {frontier.count(include_ignored=False)} of {len(frontier)} scanned "
+             f"(the rest are ignored). First {PREVIEW_ROWS}:")
+    st.dataframe(frontier.page(0, PREVIEW_ROWS, include_ignored=False))
 
     # Filter and fetch documents
-    valid_urls = data[(data['Ignore'] == False) & (data['URL'].apply(is_valid_url))]['URL'].tolist()
+    use_cache = st.checkbox("Use page cache (conditional re-fetch)", value=True)
+    only_changed = st.checkbox("Only pass changed documents downstream", value=True, disabled=not use_cache)
+    # Fetched pages are checkpointed to disk per URL selection, so a fetch of the same URLs cut short by a
+    # restart or a dropped session can resume
+    resume = st.checkbox("Resume an interrupted fetch of these URLs (with the same cache options)", value=True)
     if st.button("Fetch Documents"):
-        docs = asyncio.run(fetch_documents(valid_urls))
+        valid_urls = [url for url in frontier.urls(include_ignored=False) if is_valid_url(url)]
+        try:
+            checkpoint = JobCheckpoint.open(job_name(FETCH_JOB, valid_urls),
+                                            {'use_cache': use_cache, 'only_changed': use_cache and only_changed},
+                                            resume=resume)
+        except JobInUseError:
+            st.warning("These URLs are already being fetched in another session.")
+            return
+        with checkpoint, st.spinner(f"Fetching {len(valid_urls) - len(checkpoint)} documents..."):
+            docs, stats = fetch_documents(valid_urls,
+                                          cache=get_page_cache() if use_cache else None,
+                                          only_changed=use_cache and only_changed,
+                                          # Carried into every chunk so searches can be scoped by it
+                                          url_metadata=frontier.metadata_view(),
+                                          checkpoint=checkpoint)
         st.session_state['docs'] = docs
-        st.write(f"Fetched {len(st.session_state['docs'])} documents.")
+        if stats['resumed']:
+            st.write(f"Resumed the interrupted fetch: {stats['resumed']} pages were already fetched.")
+        st.write(f"Fetched {stats['fetched']} documents: {stats['changed']} changed, "
+                 f"{stats['unchanged']} unchanged, {stats['failed']} failed.")
+        st.write(f"Passing {len(docs)} documents downstream.")
 
     # Review documents and display results in a DataFrame
+    use_agent = st.checkbox("Review with the crewAI HTML Reviewer agent (slow, requires an LLM)", value=False)
     if 'docs' in st.session_state and st.button("Review HTML Content"):
-        results = review_documents(st.session_state['docs'])
-        st.session_state['review_results'] = results
-        df = pd.DataFrame(results)
-        st.write("Reviewed Data:")
+        with st.spinner(f"Reviewing {len(st.session_state['docs'])} documents..."):
+            df = review_documents(st.session_state['docs'], use_agent=use_agent)
+        st.session_state['review_results'] = df.to_dict('records')
+        st.write(f"Reviewed Data: {len(df)} assets across {df['URL'].nunique() if 'URL' in df else 0} URLs")
         st.dataframe(df)
 
     # Additional UI components for saving and downloading reviewed content
@@ -1,27 +1,17 @@
 import streamlit as st
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.llms import HuggingFaceEndpoint
-from langchain.schema import Document
-import json
-from typing import Iterable
 import os
 from datetime import datetime
-import zipfile
-import tempfile
-
-def save_docs_to_jsonl(array:Iterable[Document], file_path:str)->None:
-    with open(file_path, 'w') as jsonl_file:
-        for doc in array:
-            jsonl_file.write(doc.json() + '\n')
-
-def load_docs_from_jsonl(file)->Iterable[Document]:
-    array = []
-    for line in file:
-        data = json.loads(line.decode('utf-8'))
-        obj = Document(**data)
-        array.append(obj)
-    return array
+import time
+
+from utils.chunking import stream_chunks
+from utils.data_processing import is_valid_url
+from utils.model_utils import (QUANTIZED_BACKEND, SENTENCE_TRANSFORMERS_BACKEND, CachedEmbeddings,
+                               acquire_embeddings, embedding_cache_key, load_tokenizer)
+from utils.storage_utils import (ENCODE_JOB, FETCH_JOB, JobCheckpoint, JobInUseError, docs_fingerprint, job_name,
+                                 open_doc_store, shared_embedding_cache, write_docs_jsonl)
+from utils.vector_index import (DEFAULT_INDEX_PARAMS, INDEX_TYPES, VECTOR_INDEX_DIR, VectorIndexManager,
+                                benchmark_index_types, encode_into_index, index_lock, open_or_create_index,
+                                package_manifest, write_vector_package)
 
 st.title('Encoding and Storage')
 
@@ -36,21 +26,42 @@ if not os.path.exists(OUTPUT_DIR):
 else:
     st.write(f"Directory '{OUTPUT_DIR}' already exists.")
 
-# Allow the user to upload the JSON file if missing
 # Allow the user to upload the JSONL file if missing
 if 'docs' not in st.session_state:
     st.write("Document collection not found in session state.")
-    uploaded_file = st.file_uploader("Upload JSONL file", type=["jsonl"])
-    if uploaded_file is not None:
+    uploaded_file = st.file_uploader("Upload documents (JSONL, optionally .gz/.zst compressed, or an .arrow store)",
+                                     type=["jsonl", "gz", "zst", "arrow"])
+    docs_path = st.text_input("Or open a document file already on the server")
+    if uploaded_file is not None or docs_path.strip():
         try:
-            docs = load_docs_from_jsonl(uploaded_file)
+            if uploaded_file is not None:
+                docs = open_doc_store(uploaded_file, name=uploaded_file.name)
+            else:
+                docs = open_doc_store(docs_path.strip())
             st.session_state['docs'] = docs
-            st.write(f"Loaded {len(docs)} documents from the uploaded file.")
+            st.write(f"Loaded {len(docs)} documents into the document store {docs.path}.")
         except Exception as e:
-            st.error(f"Error loading JSONL file: {str(e)}")
+            st.error(f"Error loading document file: {str(e)}")
+    # Documents fetched on the Data Organization page are checkpointed per URL selection, so after a restart
+    # they can be reloaded once the same URLs have been scanned again
+    if 'frontier' in st.session_state and st.button("Load the documents last fetched for the scanned URLs"):
+        valid_urls = [url for url in st.session_state['frontier'].urls(include_ignored=False) if is_valid_url(url)]
+        fetch_job = JobCheckpoint(job_name(FETCH_JOB, valid_urls))
+        if fetch_job.manifest and fetch_job.manifest['documents']:
+            docs = list(fetch_job.documents())
+            st.session_state['docs'] = docs
+            status = "complete" if fetch_job.status == 'complete' else "interrupted"
+            st.write(f"Loaded {len(docs)} documents from the {status} fetch started "
+                     f"{fetch_job.manifest['started_at']}.")
+        else:
+            st.write("No fetched documents were found for the scanned URLs.")
 else:
     docs = st.session_state['docs']
     st.write(f"Loaded {len(docs)} documents from the session state.")
+    if isinstance(docs, list) and st.button("Save Documents"):
+        docs_file = os.path.join(OUTPUT_DIR, f"docs_{start_time}.jsonl.gz")
+        count = write_docs_jsonl(docs, docs_file)
+        st.write(f"Saved {count} documents to {docs_file}.")
 # Show the embedding model
 EMBEDDING_MODEL_NAME = st.session_state.get('selected_embedding_model', "thenlper/gte-small")
 st.write(f"Selected Embedding Model: {EMBEDDING_MODEL_NAME}")
@@ -58,16 +69,58 @@ st.write(f"Selected Embedding Model: {EMBEDDING_MODEL_NAME}")
 # Allow the user to select the device (GPU or CPU)
 device_form = st.form(key='device_form')
 device = device_form.radio("Select Device", ("CUDA", "CPU"))
+backends = {"Full precision (sentence-transformers)": SENTENCE_TRANSFORMERS_BACKEND,
+            "Quantized int8 (ONNX Runtime, CPU only)": QUANTIZED_BACKEND}
+embedding_backend = backends[device_form.radio("Embedding backend", list(backends))]
+model_batch_size = device_form.number_input("int8 backend: texts per model call", min_value=1, max_value=1024, value=32)
+model_threads = device_form.number_input("int8 backend: threads (0 = all cores)", min_value=0, max_value=256, value=0)
+device_form.subheader("Chunking")
+chunk_size = device_form.number_input("Chunk size (tokens)", min_value=32, max_value=2048, value=256)
+chunk_overlap = device_form.number_input("Chunk overlap (tokens)", min_value=0, max_value=512, value=32)
+remove_near_duplicates = device_form.checkbox("Remove near-duplicate chunks", value=True)
+near_duplicate_threshold = device_form.slider("Near-duplicate similarity threshold", min_value=0.5, max_value=1.0, value=0.85, step=0.01)
+device_form.subheader("Vector Index")
+update_index = device_form.checkbox("Update the existing index incrementally (unchecked rebuilds it)", value=True)
+# Default to the existing index, so submitting the form as it is updates that index instead of clearing it
+existing_index = VectorIndexManager.read_manifest(VECTOR_INDEX_DIR) if VectorIndexManager.exists(VECTOR_INDEX_DIR) else {}
+existing_params = {**DEFAULT_INDEX_PARAMS, **(existing_index.get('index_params') or {})}
+index_type = device_form.selectbox("Index type (changing it rebuilds the index)", INDEX_TYPES,
+                                   index=INDEX_TYPES.index(existing_index.get('index_type', "Flat")))
+index_params = {}
+if index_type in ("IVF", "IVF-PQ"):
+    index_params['nlist'] = device_form.number_input("IVF lists (nlist)", min_value=1, value=existing_params['nlist'])
+    index_params['nprobe'] = device_form.number_input("IVF lists probed per query (nprobe)", min_value=1,
+                                                      value=existing_params['nprobe'])
+    index_params['train_size'] = device_form.number_input("IVF training sample size", min_value=1000,
+                                                          value=existing_params['train_size'])
+if index_type == "IVF-PQ":
+    index_params['pq_m'] = device_form.number_input("PQ sub-quantizers", min_value=1, value=existing_params['pq_m'])
+if index_type == "HNSW":
+    index_params['hnsw_m'] = device_form.number_input("HNSW neighbours per node (M)", min_value=4,
+                                                      value=existing_params['hnsw_m'])
+    index_params['ef_search'] = device_form.number_input("HNSW search depth (efSearch)", min_value=8,
+                                                         value=existing_params['ef_search'])
+batch_size = device_form.number_input("Encoding batch size (chunks)", min_value=8, max_value=8192, value=256)
+resume_encoding = device_form.checkbox("Resume an interrupted encoding run with the same documents and settings",
+                                       value=True)
+device_form.subheader("Embedding Cache")
+use_embedding_cache = device_form.checkbox("Reuse cached embeddings for unchanged chunks", value=True)
+embedding_cache_gb = device_form.number_input("Embedding cache size limit (GB)", min_value=0.1, value=2.0)
 submit_device = device_form.form_submit_button(label='Submit Device')
 
 if submit_device:
     # Set up the embedding model
-    embedding_model = HuggingFaceEmbeddings(
-        model_name=EMBEDDING_MODEL_NAME,
-        multi_process=True,
-        model_kwargs={"device": device.lower()},
-        encode_kwargs={"normalize_embeddings": True},  # set True for cosine similarity
-    )
+    encode_kwargs = {"normalize_embeddings": True}  # set True for cosine similarity
+    # Batches are small enough that a per-call worker pool costs more than it saves
+    previous_lease = st.session_state.get('embedding_lease')
+    st.session_state['embedding_lease'] = acquire_embeddings(
+        EMBEDDING_MODEL_NAME, device=device.lower(), encode_kwargs=encode_kwargs, multi_process=False,
+        backend=embedding_backend, batch_size=int(model_batch_size), threads=int(model_threads) or None)
+    # The Q&A page must embed questions with the same backend as the documents
+    st.session_state['embedding_backend'] = embedding_backend
+    if previous_lease is not None:
+        previous_lease.release()
+    embedding_model = st.session_state['embedding_lease'].model
 
     # Show the configuration
     st.write("Embedding Model Configuration:")
@@ -75,46 +128,149 @@ if submit_device:
 
     # Start the encoding
     if 'docs' in st.session_state:
-        progress_bar = st.progress(0)
-        total_docs = len(docs)
+        # Chunk and drop duplicate chunks before they reach the embedding model
+        chunks, dedup_stats = stream_chunks(
+            docs,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            tokenizer=load_tokenizer(EMBEDDING_MODEL_NAME),
+            near_duplicate_threshold=near_duplicate_threshold,
+            near_duplicates=remove_near_duplicates,
+        )
 
-        collection_vectorstore = FAISS.from_documents(docs, embedding=embedding_model)
-        st.session_state['collection_vectorstore'] = collection_vectorstore
+        model_key = embedding_cache_key(EMBEDDING_MODEL_NAME, encode_kwargs, backend=embedding_backend)
+        encoder = embedding_model
+        if use_embedding_cache:
+            # One cache per model for every session, so concurrent encodes share its slots
+            embedding_cache = shared_embedding_cache(model_key, max_bytes=int(embedding_cache_gb * 1024 ** 3))
+            if embedding_cache.max_bytes != int(embedding_cache_gb * 1024 ** 3):
+                st.caption(f"The embedding cache for this model is already open with a "
+                           f"{embedding_cache.max_bytes / 1024 ** 3:.1f} GB limit; restart the app to change it.")
+            encoder = CachedEmbeddings(embedding_model, embedding_cache)
+
+        # Pressing any button (e.g. Cancel) interrupts this run; encode_into_index
+        # saves the batches finished so far before the interruption propagates
+        st.button("Cancel Encoding")
+        progress_bar = st.progress(0.0)
+        progress_text = st.empty()
+
+        def show_progress(progress):
+            eta = f", ETA {progress.eta_seconds:.0f}s" if progress.eta_seconds is not None else ""
+            progress_bar.progress(progress.fraction or 0.0)
+            progress_text.write(f"{progress.documents}/{progress.total_documents} documents, {progress.chunks} chunks | "
+                                f"{progress.docs_per_second:.1f} docs/s, {progress.tokens_per_second:.0f} tokens/s{eta}")
+
+        # Every session and pipeline run writes the same index, so only one may change it at a time
+        lock = index_lock(VECTOR_INDEX_DIR)
+        if not lock.acquire(blocking=False):
+            st.warning("The vector index is being updated by another session or pipeline run. "
+                       "Submit again once it has finished.")
+            st.stop()
+        try:
+            # Chunks of documents already indexed by an interrupted run with the same documents and settings
+            # are skipped after chunking, so duplicate detection still sees every chunk the first run saw
+            try:
+                checkpoint = JobCheckpoint.open(job_name(ENCODE_JOB, [docs_fingerprint(docs)]), {
+                    'model_key': model_key, 'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap,
+                    'near_duplicates': remove_near_duplicates, 'near_duplicate_threshold': near_duplicate_threshold,
+                    'index_type': index_type, 'index_params': index_params}, resume=resume_encoding)
+            except JobInUseError:
+                st.warning("These documents are already being encoded in another session.")
+                st.stop()
+            with checkpoint:
+                if checkpoint.resumed:
+                    st.write(f"Resuming the interrupted encoding run: {len(checkpoint)} documents are already encoded.")
+                    chunks = (chunk for chunk in chunks if chunk.metadata.get('source') not in checkpoint)
+                vector_index = open_or_create_index(embedding_model, VECTOR_INDEX_DIR, model_key,
+                                                    rebuild=not update_index and not checkpoint.resumed,
+                                                    index_type=index_type, index_params=index_params)
+                progress = encode_into_index(chunks, vector_index, encoder, batch_size=batch_size,
+                                             total_documents=max(1, len(docs) - len(checkpoint)),
+                                             on_progress=show_progress, checkpoint=checkpoint)
+        finally:
+            lock.release()
+        progress_bar.progress(1.0)
+        encode_seconds = progress.elapsed
 
-        for i in range(total_docs):
-            progress_bar.progress((i + 1) / total_docs)
+        # Queries must go through the plain model, not the document cache wrapper
+        collection_vectorstore = vector_index.as_vectorstore(embedding_model)
+        st.session_state['collection_vectorstore'] = collection_vectorstore
+        st.session_state['vector_index'] = vector_index
+        # Cached answers and search scopes on the Q&A page are keyed by this, so it must follow the new store
+        st.session_state['vector_index_version'] = vector_index.version
+        st.session_state['vector_store_id'] = ('local-index', vector_index.version)
+        st.write(f"Split {dedup_stats.input_documents} documents into {dedup_stats.chunks} chunks, "
+                 f"dropped {dedup_stats.exact_duplicates} exact and {dedup_stats.near_duplicates} near duplicates.")
+        st.write(f"{vector_index.index_type} index version {vector_index.version}: {progress.added} documents added, "
+                 f"{progress.replaced} replaced, {progress.unchanged} unchanged, {len(vector_index)} vectors in total.")
 
-        st.write("Encoding completed.")
+        if use_embedding_cache:
+            st.write(f"Embedding cache: {encoder.hits} hits, {encoder.misses} chunks encoded.")
+        st.write(f"Encoding completed: {dedup_stats.kept} chunks in {encode_seconds:.1f}s "
+                 f"({progress.docs_per_second:.1f} docs/s, {progress.tokens_per_second:.0f} tokens/s). "
+                 f"Deduplication saved an estimated {dedup_stats.estimated_time_saved(encode_seconds):.1f}s of encoding.")
     else:
         st.write("No documents found in the session state.")
         
- # Allow saving and downloading the configuration
+# Remove pages that no longer exist from the persisted index
+if VectorIndexManager.exists(VECTOR_INDEX_DIR):
+    with st.expander("Remove documents from the index"):
+        urls_to_remove = st.text_area("Source URLs to remove, separated by new lines:")
+        if st.button("Remove Documents"):
+            # Reopened under the lock: the copy in this session may be older than what is on disk
+            with index_lock(VECTOR_INDEX_DIR):
+                vector_index = VectorIndexManager.open(VECTOR_INDEX_DIR)
+                removed = vector_index.delete([url.strip() for url in urls_to_remove.split('\n') if url.strip()])
+                version = vector_index.save()
+            st.session_state['vector_index'] = vector_index
+            if 'collection_vectorstore' in st.session_state:
+                st.session_state['collection_vectorstore'] = vector_index.as_vectorstore(
+                    st.session_state['collection_vectorstore'].embedding_function)
+                st.session_state['vector_index_version'] = vector_index.version
+                st.session_state['vector_store_id'] = ('local-index', vector_index.version)
+            st.write(f"Removed {removed} vectors, index is now at version {version}.")
+
+    # Compare index types on the vectors already encoded for this collection
+    with st.expander("Benchmark index types"):
+        benchmark_types = st.multiselect("Index types", INDEX_TYPES, default=list(INDEX_TYPES))
+        benchmark_k = st.number_input("k", min_value=1, max_value=100, value=10)
+        benchmark_queries = st.number_input("Held-out queries", min_value=10, value=200)
+        if st.button("Run Benchmark"):
+            vector_index = st.session_state.get('vector_index') or VectorIndexManager.open(VECTOR_INDEX_DIR)
+            _, vectors = vector_index.vectors()
+            with st.spinner(f"Benchmarking on {len(vectors)} vectors..."):
+                results = benchmark_index_types(vectors, benchmark_types, k=benchmark_k, n_queries=benchmark_queries)
+            st.dataframe(results)
+            st.caption("Recall is measured against exact (Flat) search over the same vectors, "
+                       "latency is per single query, memory is the serialized index size and process RSS growth.")
+
+# Allow saving and downloading the configuration
+MAX_DOWNLOAD_BYTES = 1024 ** 3
+
 if st.button("Save and Download Configuration"):
     if 'collection_vectorstore' in st.session_state:
         collection_vectorstore = st.session_state['collection_vectorstore']
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        zip_filename = f"docs_vectors_{timestamp}.zip"
+        zip_filename = os.path.join(OUTPUT_DIR, f"docs_vectors_{timestamp}.zip")
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            collection_vectorstore.save_local(f"{temp_dir}/docs_vectors")
-
-            with zipfile.ZipFile(zip_filename, "w") as zip_file:
-                for root, _, files in os.walk(temp_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        zip_file.write(file_path, os.path.relpath(file_path, temp_dir))
+        manifest = package_manifest(EMBEDDING_MODEL_NAME, st.session_state.get('vector_index'))
+        with st.spinner("Writing vector store package..."):
+            write_vector_package(collection_vectorstore, zip_filename, manifest)
 
+        package_size = os.path.getsize(zip_filename)
+        if package_size <= MAX_DOWNLOAD_BYTES:
             with open(zip_filename, "rb") as zip_file:
-                zip_bytes = zip_file.read()
-
-            st.download_button(
-                label="Download Configuration",
-                data=zip_bytes,
-                file_name=zip_filename,
-                mime="application/zip",
-            )
-
-        st.success("Configuration saved and downloaded.")
+                st.download_button(
+                    label="Download Configuration",
+                    data=zip_file,
+                    file_name=os.path.basename(zip_filename),
+                    mime="application/zip",
+                )
+            st.success("Configuration saved and downloaded.")
+        else:
+            # Browser downloads are buffered in memory by Streamlit, so large packages stay on disk
+            st.success(f"Configuration saved to {os.path.abspath(zip_filename)} ({package_size / 1e9:.1f} GB). "
+                       "Open it from that path on the Q&A page.")
     else:
         st.warning("No vector store found. Please make sure the encoding is completed.")
 
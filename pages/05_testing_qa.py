@@ -1,13 +1,17 @@
 import streamlit as st
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.llms import HuggingFaceEndpoint
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
 import tempfile
 import zipfile
 import os
+import hashlib
+from datetime import datetime
+
+from utils.answer_cache import AnswerCache, cache_namespace
+from utils.metadata_index import MetadataIndex
+from utils.metrics import metrics
+from utils.model_utils import (SENTENCE_TRANSFORMERS_BACKEND, STUB_LLM_NAME, LazyEmbeddings, acquire_embeddings,
+                               acquire_llm, embedding_cache_key)
+from utils.vector_index import (VECTOR_INDEX_DIR, VectorIndexManager, extract_vector_package, is_vector_package,
+                                open_vector_package)
 
 st.title('Testing and QA')
 
@@ -15,21 +19,22 @@ st.title('Testing and QA')
 EMBEDDING_MODEL_NAME = st.session_state.get('selected_embedding_model', "thenlper/gte-small")
 LLM_MODEL_NAME = st.session_state.get('selected_llm_model', "mistralai/Mistral-7B-Instruct-v0.2")
 
-# Initialization block for embedding_model, with a debug message
-if 'embedding_model' not in st.session_state:
-    EMBEDDING_MODEL_NAME = st.session_state.get('selected_embedding_model', "thenlper/gte-small")
-    st.session_state['embedding_model'] = HuggingFaceEmbeddings(
-        model_name=EMBEDDING_MODEL_NAME,
-        multi_process=True,
-        model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True},
-    )
+# Embedding models are shared by all sessions through the model registry. The
+# session holds a lazy handle that only loads the model when a question or
+# vector store first needs it, and releases it when the session switches models or ends
+EMBEDDING_BACKEND = st.session_state.get('embedding_backend', SENTENCE_TRANSFORMERS_BACKEND)
+embedding_model = st.session_state.get('embedding_model')
+if (not isinstance(embedding_model, LazyEmbeddings)
+        or st.session_state.get('embedding_model_name') != (EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND)):
+    embedding_model = LazyEmbeddings(lambda name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND:
+                                     acquire_embeddings(name, device="cpu", backend=backend))
+    st.session_state['embedding_model'] = embedding_model
+    st.session_state['embedding_model_name'] = (EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND)
     st.info("embedding_model has been initialized.")  # Debug message for initialization
 else:
     st.info("embedding_model was already initialized.")  # Debug message if already initialized
+EMBEDDING_KEY = embedding_cache_key(EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND)
 
-# Now that we've ensured embedding_model is initialized, we can safely access it
-embedding_model = st.session_state['embedding_model']
 st.write("Accessing embedding_model...")  # Debug message for accessing
 
 # Form for LLM settings, allowing dynamic model selection
@@ -42,36 +47,137 @@ with st.form("llm_settings_form"):
     typical_p = st.number_input("Typical P", value=0.95, key="typical_p")
     temperature = st.number_input("Temperature", value=0.01, key="temperature")
     repetition_penalty = st.number_input("Repetition Penalty", value=1.035, key="repetition_penalty")
+    use_stub_llm = st.checkbox("Use local stub LLM (offline testing)", key="use_stub_llm")
+    stub_first_token_delay = st.number_input("Stub delay before first token (s)", min_value=0.0, value=0.5)
+    stub_token_delay = st.number_input("Stub delay between tokens (s)", min_value=0.0, value=0.05)
 
     submitted = st.form_submit_button("Update LLM Settings")
     if submitted:
-        st.session_state['llm'] = HuggingFaceEndpoint(
-            repo_id=repo_id,
-            max_new_tokens=max_new_tokens,
-            top_k=top_k,
-            top_p=top_p,
-            typical_p=typical_p,
-            temperature=temperature,
-            repetition_penalty=repetition_penalty,
-        )
+        previous_lease = st.session_state.get('llm_lease')
+        if use_stub_llm:
+            st.session_state['llm_lease'] = acquire_llm(
+                STUB_LLM_NAME, first_token_delay=stub_first_token_delay, token_delay=stub_token_delay)
+        else:
+            st.session_state['llm_lease'] = acquire_llm(
+                repo_id,
+                max_new_tokens=max_new_tokens,
+                top_k=top_k,
+                top_p=top_p,
+                typical_p=typical_p,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+            )
+        if previous_lease is not None:
+            previous_lease.release()
+        st.session_state['llm'] = st.session_state['llm_lease'].model
         st.success("LLM settings updated.")
 
+# Open the incrementally maintained index written by the encoding page
+if VectorIndexManager.exists(VECTOR_INDEX_DIR):
+    index_version = VectorIndexManager.read_manifest(VECTOR_INDEX_DIR)['version']
+    if st.session_state.get('vector_index_version') != index_version:
+        if st.button(f"Open local vector index (version {index_version})"):
+            vector_index = VectorIndexManager.open(VECTOR_INDEX_DIR)
+            st.session_state['collection_vectorstore'] = vector_index.as_vectorstore(embedding_model)
+            st.session_state['retriever'] = st.session_state['collection_vectorstore'].as_retriever()
+            st.session_state['vector_index_version'] = vector_index.version
+            st.session_state['vector_store_id'] = ('local-index', vector_index.version)
+            st.success(f"Vector index version {vector_index.version} loaded with {len(vector_index)} vectors.")
+
+@st.cache_resource
+def load_vector_package(package_dir, embedding_model_name, _embedding_model):
+    # Shared by every session: the index and docstore are memory-mapped once per package
+    return open_vector_package(package_dir, _embedding_model)
+
+def use_vectorstore(vectorstore, store_id, store_version):
+    st.session_state['collection_vectorstore'] = vectorstore
+    # Cached answers are tied to the store they were retrieved from
+    st.session_state['vector_store_id'] = (store_id, store_version)
+    # Create the retriever as soon as the vector store is created
+    st.session_state['retriever'] = vectorstore.as_retriever()
+    st.info("Retriever has been created.")  # Debug message to confirm the retriever's creation
+
 # Vector store upload and setup
 if 'collection_vectorstore' not in st.session_state:
     uploaded_file = st.file_uploader("Upload Vector Store ZIP", type=["zip"])
-    if uploaded_file is not None:
+    package_path = st.text_input("Or open a vector store package already on the server")
+    if uploaded_file is not None and is_vector_package(uploaded_file):
+        package_key = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()[:16]
+        package_dir = extract_vector_package(uploaded_file, package_key)
+        vectorstore, manifest = load_vector_package(package_dir, EMBEDDING_KEY, embedding_model)
+        use_vectorstore(vectorstore, uploaded_file.name, package_key)
+        st.success(f"Vector store package loaded with {manifest['count']} vectors.")
+    elif uploaded_file is not None:
+        # Older archives written with FAISS.save_local
+        from langchain_community.vectorstores import FAISS
+
+        uploaded_file.seek(0)
+        upload_key = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()[:16]
         with tempfile.TemporaryDirectory() as temp_dir:
             with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
                 zip_ref.extractall(temp_dir)
             docs_vectors_path = os.path.join(temp_dir, "docs_vectors")
-            st.session_state['collection_vectorstore'] = FAISS.load_local(docs_vectors_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
+            use_vectorstore(FAISS.load_local(docs_vectors_path, embeddings=embedding_model, allow_dangerous_deserialization=True),
+                            uploaded_file.name, upload_key)
             st.success("Vector store uploaded and loaded successfully.")
+    elif package_path.strip():
+        package_path = os.path.abspath(package_path.strip())
+        package_stat = os.stat(package_path)
+        package_key = hashlib.sha256(f"{package_path}:{package_stat.st_size}:{package_stat.st_mtime_ns}".encode()).hexdigest()[:16]
+        package_dir = extract_vector_package(package_path, package_key)
+        vectorstore, manifest = load_vector_package(package_dir, EMBEDDING_KEY, embedding_model)
+        use_vectorstore(vectorstore, package_path, package_key)
+        st.success(f"Vector store package loaded with {manifest['count']} vectors.")
 
-             # Create the retriever as soon as the vector store is created
-            st.session_state['retriever'] = st.session_state['collection_vectorstore'].as_retriever()
-            st.info("Retriever has been created.")  # Debug message to confirm the retriever's creation
+
+@st.cache_resource
+def get_answer_cache():
+    # One cache for every session, so repeated questions from different users are answered once
+    return AnswerCache(max_entries=1000, ttl_seconds=3600, similarity_threshold=0.95)
 
 
+answer_cache = get_answer_cache()
+with st.expander("Answer cache"):
+    use_answer_cache = st.checkbox("Use answer cache", value=True)
+    answer_cache.similarity_threshold = st.slider(
+        "Semantic match threshold (cosine similarity)", min_value=0.80, max_value=1.0,
+        value=answer_cache.similarity_threshold, step=0.01)
+    cache_stats = answer_cache.stats
+    st.write(f"{len(answer_cache)} cached answers (limit {answer_cache.max_entries}, "
+             f"expire after {answer_cache.ttl_seconds // 60} minutes)")
+    st.write(f"Exact hits: {cache_stats.exact_hits}, semantic hits: {cache_stats.semantic_hits}, "
+             f"misses: {cache_stats.misses}, hit rate: {cache_stats.hit_rate:.0%}")
+    st.write(f"Evicted: {cache_stats.evictions}, expired: {cache_stats.expirations}")
+    if st.button("Clear answer cache"):
+        answer_cache.clear()
+
+@st.cache_resource
+def get_metadata_index(store_id, store_version, _vectorstore):
+    return MetadataIndex.from_vectorstore(_vectorstore)
+
+
+# Restrict retrieval to a subset of the collection before vector scoring
+search_bitmap, metadata_index, search_scope = None, None, {}
+if 'collection_vectorstore' in st.session_state:
+    store_id, store_version = st.session_state.get('vector_store_id', ('session', id(st.session_state['collection_vectorstore'])))
+    metadata_index = get_metadata_index(store_id, store_version, st.session_state['collection_vectorstore'])
+    with st.expander("Search scope"):
+        domains = metadata_index.values('domain')
+        url_types = metadata_index.values('url_type')
+        page_names = metadata_index.values('page_name')
+        search_scope['domain'] = st.multiselect("Domains", list(domains), format_func=lambda d: f"{d} ({domains[d]})")
+        search_scope['url_type'] = st.multiselect("Link type", list(url_types), format_func=lambda t: f"{t} ({url_types[t]})")
+        search_scope['page_name'] = st.multiselect("Found on page", list(page_names))
+        first_scan, last_scan = metadata_index.scan_range()
+        if first_scan is not None:
+            scan_dates = st.date_input("Scanned between", value=(first_scan.date(), last_scan.date()))
+            if len(scan_dates) == 2 and (scan_dates[0] > first_scan.date() or scan_dates[1] < last_scan.date()):
+                search_scope['scanned_from'] = datetime.combine(scan_dates[0], datetime.min.time())
+                search_scope['scanned_to'] = datetime.combine(scan_dates[1], datetime.max.time())
+        search_bitmap = metadata_index.select(**search_scope)
+        if search_bitmap is not None:
+            st.write(f"Searching {len(metadata_index.ids(search_bitmap))} of {len(metadata_index.ids(metadata_index.present))} chunks.")
+
 # Check if LLM and vector store are ready
 if 'llm' in st.session_state and 'collection_vectorstore' in st.session_state:
     # Use a button to indicate when to update the prompt template
@@ -94,18 +200,38 @@ question = st.text_input("Enter your question", key="question_input")
 
 if question:
     llm = st.session_state['llm']
-    prompt = ChatPromptTemplate.from_template(current_template)
-    retriever = st.session_state['retriever']
-    chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
-
+    vectorstore = st.session_state['collection_vectorstore']
+    store_id, store_version = st.session_state.get('vector_store_id', ('session', id(vectorstore)))
+    scope_key = sorted((field, str(value)) for field, value in search_scope.items() if value)
+    namespace = cache_namespace(current_template, (st.session_state['llm_lease'].key, scope_key), EMBEDDING_KEY)
     if st.button("Ask"):
-        result = chain.invoke(question)
+        cached, tier, query_vector = None, None, None
+        if use_answer_cache:
+            with metrics.span('answer_cache_lookup'):
+                cached, tier = answer_cache.get(question, namespace, store_id, store_version)
+                if cached is None:
+                    query_vector = embedding_model.embed_query(question)
+                    cached, tier = answer_cache.get(question, namespace, store_id, store_version, vector=query_vector)
+            metrics.count('answer_cache_lookups_total', help="Q&A answer cache lookups", result=tier or 'miss')
+
         st.subheader("Answer:")
-        st.write(result)
+        if cached is not None:
+            st.write(cached.answer)
+            st.caption(f"Answered from cache ({tier} match on \"{cached.question}\")")
+        else:
+            from utils.qa_chain import StreamedAnswer, stream_answer
+
+            answer_area = st.empty()
+            # Reuses the vector computed for the cache lookup instead of embedding the question twice
+            streamed = StreamedAnswer(question, query_vector=query_vector)
+            stream_answer(streamed, vectorstore, embedding_model, current_template, llm,
+                          on_token=lambda result: answer_area.markdown(result.answer + "▌"),
+                          bitmap=search_bitmap, metadata_index=metadata_index)
+            answer_area.markdown(streamed.answer)
+            st.caption(f"Retrieval {streamed.retrieval_seconds:.2f}s, first token {streamed.first_token_seconds or 0:.2f}s, "
+                       f"total {streamed.total_seconds:.2f}s, {streamed.tokens} tokens")
+            if use_answer_cache:
+                answer_cache.put(question, namespace, store_id, store_version, streamed.answer, streamed.documents,
+                                 vector=streamed.query_vector)
 else:
     st.warning("Please configure and submit the LLM settings and ensure the vector store is loaded to ask questions.")
@@ -0,0 +1,57 @@
+import numpy as np
+
+from utils.storage_utils import EmbeddingCache, shared_embedding_cache
+
+DIM = 4
+ROW_BYTES = DIM * 2  # float16
+
+
+def _vectors(start, n):
+    # Integers below 2048 are exact in float16, so every key's vector can be checked exactly
+    return np.arange(start, start + n, dtype=np.float32)[:, None].repeat(DIM, axis=1)
+
+
+def _keys(start, n):
+    return [f"chunk-{i}" for i in range(start, start + n)]
+
+
+def test_slots_survive_shrinking_and_growing_the_cap(tmp_path):
+    cache = EmbeddingCache("test-model", str(tmp_path), max_bytes=1000 * ROW_BYTES)
+    cache.put_many(_keys(0, 1000), _vectors(0, 1000))
+
+    # Shrinking evicts the oldest half; the survivors keep their high slots
+    cache.max_bytes = 500 * ROW_BYTES
+    cache.put_many(_keys(1000, 1), _vectors(1000, 1))
+    assert len(cache) == 500
+
+    cache.max_bytes = 1000 * ROW_BYTES
+    cache.put_many(_keys(1500, 400), _vectors(1500, 400))
+
+    survivors = cache.get_many(_keys(0, 1001))
+    assert len(survivors) == 500
+    for key, vector in survivors.items():
+        assert vector[0] == int(key.split('-')[1])
+    written = cache.get_many(_keys(1500, 400))
+    assert len(written) == 400
+    for key, vector in written.items():
+        assert vector[0] == int(key.split('-')[1])
+    cache.close()
+
+
+def test_evicted_slots_are_reused(tmp_path):
+    cache = EmbeddingCache("test-model", str(tmp_path), max_bytes=10 * ROW_BYTES)
+    cache.put_many(_keys(0, 10), _vectors(0, 10))
+    cache.put_many(_keys(10, 5), _vectors(10, 5))
+
+    slots = [slot for slot, in cache._conn.execute("SELECT slot FROM entries")]
+    assert len(cache) == 10
+    assert sorted(slots) == list(range(10))
+    for key, vector in cache.get_many(_keys(0, 15)).items():
+        assert vector[0] == int(key.split('-')[1])
+    cache.close()
+
+
+def test_shared_cache_keeps_the_cap_it_was_created_with(tmp_path):
+    cache = shared_embedding_cache("test-model", max_bytes=1000 * ROW_BYTES, cache_dir=str(tmp_path))
+    assert shared_embedding_cache("test-model", max_bytes=10 * ROW_BYTES, cache_dir=str(tmp_path)) is cache
+    assert cache.max_bytes == 1000 * ROW_BYTES
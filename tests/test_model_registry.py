@@ -0,0 +1,37 @@
+import gc
+import threading
+
+import pytest
+
+from utils.model_registry import ModelRegistry
+
+
+def test_lease_finalized_while_the_registry_lock_is_held_does_not_deadlock():
+    registry = ModelRegistry()
+    lease = registry.acquire('embeddings', 'model', {}, object, size_fn=lambda model: 0)
+
+    def drop_lease_under_lock():
+        nonlocal lease
+        # As when garbage collection runs inside acquire or _evict
+        with registry._lock:
+            lease = None
+            gc.collect()
+
+    thread = threading.Thread(target=drop_lease_under_lock, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert registry.stats()[0]['References'] == 0
+
+
+def test_failed_load_leaves_no_entry():
+    registry = ModelRegistry()
+
+    def failing_factory():
+        raise OSError("download failed")
+
+    with pytest.raises(OSError):
+        registry.acquire('llm', 'model', {}, failing_factory)
+    assert registry.stats() == []
+    registry.acquire('llm', 'model', {}, object, size_fn=lambda model: 0).release()
+    assert registry.loads == 1
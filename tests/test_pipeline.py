@@ -0,0 +1,50 @@
+import functools
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.model_utils import HASHING_MODEL_NAME
+from utils.pipeline import run_pipeline
+from utils.vector_index import VectorIndexManager
+
+
+@pytest.fixture
+def site(tmp_path):
+    root = tmp_path / "site"
+    root.mkdir()
+    links = ''.join(f'<a href="/p{i}.html">page {i}</a>' for i in range(5))
+    (root / "index.html").write_text(f"<html><head><title>Index</title></head><body>{links}</body></html>")
+    for i in range(5):
+        (root / f"p{i}.html").write_text(
+            f"<html><head><title>Page {i}</title></head><body><p>{f'Page {i} talks about topic {i}. ' * 40}</p>"
+            f"</body></html>")
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(root))
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/index.html"
+    server.shutdown()
+
+
+def _run(site, tmp_path, **kwargs):
+    return run_pipeline([site], str(tmp_path / "package.zip"), embedding_model_name=HASHING_MODEL_NAME,
+                        index_dir=str(tmp_path / "index"), use_cache=False, embedding_cache_gb=0,
+                        chunk_workers=1, **kwargs)
+
+
+def test_default_run_keeps_an_existing_hnsw_index(site, tmp_path, monkeypatch):
+    # The chunkers' tokenizer lookup would otherwise retry the Hugging Face Hub
+    monkeypatch.setenv("HF_HUB_OFFLINE", "1")
+    _run(site, tmp_path, index_type="HNSW", index_params={'ef_search': 128})
+    first = VectorIndexManager.open(str(tmp_path / "index"))
+    assert first.index_type == "HNSW"
+    assert len(first) > 0
+
+    stats = _run(site, tmp_path)
+    second = VectorIndexManager.open(str(tmp_path / "index"))
+    assert second.index_type == "HNSW"
+    assert second.index_params['ef_search'] == 128
+    assert len(second) == len(first)
+    assert stats.vectors == len(first)
@@ -0,0 +1,133 @@
+# Two-tier cache for Q&A answers: exact question matches, then similar questions
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils.chunking import normalize_text
+from utils.storage_utils import content_hash
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    documents: list
+    vector: np.ndarray = None
+    created: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+@dataclass
+class AnswerCacheStats:
+    exact_hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hits(self):
+        return self.exact_hits + self.semantic_hits
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def cache_namespace(template, model_settings, embedding_model_name):
+    """Answers are only interchangeable for the same prompt template, LLM settings and query embedder."""
+    return content_hash(f"{template}\x00{model_settings!r}\x00{embedding_model_name}")[:16]
+
+
+class AnswerCache:
+    """Caches retrieved documents and answers in front of the Q&A chain.
+
+    Entries live in a namespace (see `cache_namespace`) and belong to one
+    version of a vector store, identified by `store_id` and `store_version`.
+    Lookups first match the normalized question exactly, then fall back to the
+    most similar cached question whose embedding cosine similarity reaches
+    `similarity_threshold`. Sessions on different versions of the same store
+    keep separate entries; those of versions no longer asked about age out.
+    Entries expire after `ttl_seconds` and the least recently used are evicted
+    beyond `max_entries`. Safe to share between sessions.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=3600, similarity_threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.stats = AnswerCacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds is not None and now - entry.created > self.ttl_seconds
+
+    def get(self, question, namespace, store_id, store_version, vector=None):
+        """Return (CachedAnswer, tier) where tier is 'exact' or 'semantic', or (None, None).
+
+        Only the exact tier is checked when `vector` is None, so callers can
+        skip embedding the question on an exact hit.
+        """
+        now = time.time()
+        with self._lock:
+            key = (store_id, store_version, namespace, normalize_text(question))
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                self.stats.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                self.stats.exact_hits += 1
+                return entry, 'exact'
+            if vector is None:
+                return None, None
+
+            best_key, best_score = None, self.similarity_threshold
+            query = np.asarray(vector, dtype=np.float32)
+            query = query / (np.linalg.norm(query) or 1.0)
+            for candidate_key, candidate in list(self._entries.items()):
+                if candidate_key[:3] != key[:3] or candidate.vector is None:
+                    continue
+                if self._expired(candidate, now):
+                    del self._entries[candidate_key]
+                    self.stats.expirations += 1
+                    continue
+                score = float(candidate.vector @ query)
+                if score >= best_score:
+                    best_key, best_score = candidate_key, score
+            if best_key is None:
+                self.stats.misses += 1
+                return None, None
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            entry.hits += 1
+            self.stats.semantic_hits += 1
+            return entry, 'semantic'
+
+    def put(self, question, namespace, store_id, store_version, answer, documents, vector=None):
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+        entry = CachedAnswer(question=question, answer=answer, documents=list(documents), vector=vector)
+        with self._lock:
+            key = (store_id, store_version, namespace, normalize_text(question))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
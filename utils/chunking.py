@@ -0,0 +1,203 @@
+# Chunking and duplicate elimination between fetch and encode
+import re
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+from langchain_core.documents import Document
+
+from utils.html_extraction import extract_html
+from utils.storage_utils import content_hash
+
+_WHITESPACE = re.compile(r'\s+')
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+def approx_token_count(text):
+    # Roughly what a WordPiece tokenizer produces for English prose
+    return int(len(text.split()) * 1.3) + 1
+
+
+def make_splitter(chunk_size=256, chunk_overlap=32, tokenizer=None):
+    """Token-aware splitter. Uses the embedding model's tokenizer when given, otherwise an estimate."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    if tokenizer is not None:
+        return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer, chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        length_function=approx_token_count, add_start_index=True)
+
+
+def document_text(doc):
+    """Clean text for a fetched document, stripping markup when the content is HTML."""
+    content = doc.page_content
+    if '<' in content[:1000] and '>' in content[:1000]:
+        page = extract_html(content)
+        return page.text, page.title
+    return content, doc.metadata.get('title')
+
+
+def chunk_documents(docs, splitter):
+    """Split documents into chunks that keep provenance back to the source URL."""
+    for doc in docs:
+        text, title = document_text(doc)
+        source = doc.metadata.get('source')
+        for chunk_index, chunk in enumerate(splitter.create_documents([text])):
+            metadata = dict(doc.metadata)
+            metadata.update({
+                'source': source,
+                'chunk_index': chunk_index,
+                'chunk_id': f"{source}#{chunk_index}",
+                'start_index': chunk.metadata.get('start_index'),
+                'chunk_hash': content_hash(chunk.page_content),
+            })
+            metadata.pop('content_hash', None)
+            if title:
+                metadata['title'] = title
+            yield Document(page_content=chunk.page_content, metadata=metadata)
+
+
+def normalize_text(text):
+    return _WHITESPACE.sub(' ', text).strip().lower()
+
+
+class MinHasher:
+    """MinHash signatures over word shingles, for estimating Jaccard similarity."""
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        words = text.split()
+        k = self.shingle_size
+        if len(words) <= k:
+            grams = [' '.join(words)]
+        else:
+            grams = (' '.join(words[i:i + k]) for i in range(len(words) - k + 1))
+        return np.fromiter({zlib.crc32(g.encode('utf-8')) for g in grams}, dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = self.shingles(text) % _MERSENNE_PRIME
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % _MERSENNE_PRIME
+        # Values are below 2**31, so uint32 halves the memory kept per chunk
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+@dataclass
+class DedupStats:
+    input_documents: int = 0
+    chunks: int = 0
+    exact_duplicates: int = 0
+    near_duplicates: int = 0
+    dropped_tokens: int = 0
+    kept_tokens: int = 0
+
+    @property
+    def dropped(self):
+        return self.exact_duplicates + self.near_duplicates
+
+    @property
+    def kept(self):
+        return self.chunks - self.dropped
+
+    def estimated_time_saved(self, encode_seconds):
+        """Encode time avoided, extrapolated from the time spent encoding the kept chunks."""
+        if not self.kept_tokens:
+            return 0.0
+        return encode_seconds * self.dropped_tokens / self.kept_tokens
+
+
+class Deduplicator:
+    """Drops exact and near-duplicate chunks, keeping the first occurrence.
+
+    Exact duplicates are matched on a hash of the normalized text. Near
+    duplicates use MinHash with LSH banding: only chunks sharing a band
+    bucket are compared, and a chunk is dropped when its estimated Jaccard
+    similarity with a kept chunk reaches `threshold`.
+    """
+
+    def __init__(self, threshold=0.85, num_perm=128, bands=16, shingle_size=5):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        self.seen_hashes = set()
+        self.buckets = [dict() for _ in range(bands)]
+        self.signatures = []
+        self.stats = DedupStats()
+
+    def is_duplicate(self, text):
+        normalized = normalize_text(text)
+        digest = content_hash(normalized)
+        if digest in self.seen_hashes:
+            self.stats.exact_duplicates += 1
+            return True
+
+        signature = self.hasher.signature(normalized)
+        keys = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        candidates = set()
+        for band, key in zip(self.buckets, keys):
+            candidates.update(band.get(key, ()))
+        for candidate in candidates:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                self.stats.near_duplicates += 1
+                return True
+
+        self.seen_hashes.add(digest)
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        for band, key in zip(self.buckets, keys):
+            band.setdefault(key, []).append(index)
+        return False
+
+    def filter(self, chunks, near_duplicates=True):
+        for chunk in chunks:
+            self.stats.chunks += 1
+            tokens = approx_token_count(chunk.page_content)
+            if near_duplicates:
+                duplicate = self.is_duplicate(chunk.page_content)
+            else:
+                digest = content_hash(normalize_text(chunk.page_content))
+                duplicate = digest in self.seen_hashes
+                if duplicate:
+                    self.stats.exact_duplicates += 1
+                else:
+                    self.seen_hashes.add(digest)
+            if duplicate:
+                self.stats.dropped_tokens += tokens
+                continue
+            self.stats.kept_tokens += tokens
+            yield chunk
+
+
+def stream_chunks(docs, chunk_size=256, chunk_overlap=32, tokenizer=None,
+                  near_duplicate_threshold=0.85, near_duplicates=True):
+    """Lazily chunk `docs` and remove duplicates.
+
+    Returns (chunks, DedupStats): a generator and the stats object it
+    updates as it is consumed.
+    """
+    splitter = make_splitter(chunk_size, chunk_overlap, tokenizer)
+    deduplicator = Deduplicator(threshold=near_duplicate_threshold)
+
+    def counted(docs):
+        for doc in docs:
+            deduplicator.stats.input_documents += 1
+            yield doc
+
+    chunks = deduplicator.filter(chunk_documents(counted(docs), splitter), near_duplicates=near_duplicates)
+    return chunks, deduplicator.stats
+
+
+def prepare_chunks(docs, **kwargs):
+    """Chunk `docs` and remove duplicates. Returns (chunks, DedupStats)."""
+    chunks, stats = stream_chunks(docs, **kwargs)
+    return list(chunks), stats
@@ -1 +1,422 @@
 # Add your data processing utilities here
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from datetime import datetime
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.html_extraction import extract_html
+from utils.metrics import metrics, propagate
+from utils.storage_utils import FetchResult, content_hash
+
+DEFAULT_TIMEOUT = 10
+MEDIA_COLUMNS = ['URL', 'Tag', 'Src', 'Alt']
+DEFAULT_USER_AGENT = "KnowledgeNavigator/0.1 (+https://github.com/ricklon/knowledge_navigator)"
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Query parameters that only track where a click came from; utm_* is matched by prefix
+TRACKING_PARAMS = {'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_ga', '_gl', 'igshid'}
+
+
+def convert_to_absolute_urls(base_url, links):
+    return {urljoin(base_url, link) if not link.startswith('http') else link for link in links}
+
+
+def categorize_links(base_url, links):
+    internal_links, external_links = set(), set()
+    for link in links:
+        if urlparse(link).netloc == urlparse(base_url).netloc:
+            internal_links.add(link)
+        else:
+            external_links.add(link)
+    return internal_links, external_links
+
+
+def canonicalize_url(url):
+    """Normal form of `url` used for deduplication.
+
+    Lowercases the scheme and host, drops default ports, the fragment and
+    tracking parameters (utm_*, gclid, fbclid, ...) and gives an empty path
+    as '/'. The remaining query parameters keep their order.
+    """
+    scheme, netloc, path, query, _ = urlsplit(url.strip())
+    scheme = scheme.lower()
+    if scheme not in DEFAULT_PORTS or not netloc:
+        return url.split('#', 1)[0]
+    # Parsed by hand rather than through .hostname/.port, this runs for every discovered link
+    userinfo, at, host = netloc.rpartition('@')
+    host = host.lower()
+    default_port = f":{DEFAULT_PORTS[scheme]}"
+    if host.endswith(default_port):
+        host = host[:-len(default_port)]
+    if query:
+        query = '&'.join(param for param in query.split('&')
+                         if param and not _is_tracking_param(param.split('=', 1)[0].lower()))
+    return urlunsplit((scheme, userinfo + at + host, path or '/', query, ''))
+
+
+def _is_tracking_param(name):
+    return name.startswith('utm_') or name in TRACKING_PARAMS
+
+
+def is_valid_url(url):
+    parsed = urlparse(url)
+    return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
+
+
+def make_session(pool_size=32, user_agent=DEFAULT_USER_AGENT):
+    """Create a requests session with a keep-alive connection pool sized for the crawler."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = user_agent
+    return session
+
+
+@metrics.timed('parse_html')
+def parse_links_and_title(html):
+    page = extract_html(html)
+    return page.links, page.title
+
+
+@metrics.timed('fetch_page')
+def fetch_page(url, session=None, timeout=DEFAULT_TIMEOUT, cache=None):
+    """GET `url`, through `cache` when one is given, and return a FetchResult.
+
+    Network errors propagate, non-200 responses come back with `error` set.
+    """
+    session = session or requests
+    if cache is not None:
+        page = cache.fetch(url, session, timeout)
+    else:
+        response = session.get(url, timeout=timeout)
+        if response.status_code != 200:
+            page = FetchResult(url, '', response.status_code, changed=False, error=f"HTTP {response.status_code}")
+        else:
+            page = FetchResult(url, response.text, 200, content_hash(response.text))
+    if page.error:
+        metrics.count('fetch_failures_total', help="Fetches that returned an error response", reason=page.error)
+    return page
+
+
+@metrics.timed('crawl_page')
+def find_linked_urls_and_title(url, session=None, timeout=DEFAULT_TIMEOUT, cache=None):
+    """Fetch a page and return the set of hrefs on it, its title and the FetchResult."""
+    page = fetch_page(url, session, timeout, cache)
+    if not page.ok:
+        return set(), 'No Title Found', page
+    urls, page_title = parse_links_and_title(page.body)
+    return urls, page_title, page
+
+
+class HostThrottle:
+    """Caps concurrent requests and request rate per host.
+
+    `max_concurrency` requests may be in flight against one host at a time and
+    consecutive requests to the same host are spaced by at least
+    1 / `requests_per_second` seconds. A rate of None disables spacing.
+    """
+
+    def __init__(self, max_concurrency=4, requests_per_second=None):
+        self.max_concurrency = max_concurrency
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_slot = defaultdict(float)
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_concurrency)
+            return self._semaphores[host]
+
+    def _wait_for_slot(self, host):
+        if not self.min_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot[host])
+            self._next_slot[host] = slot + self.min_interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __call__(self, url):
+        return _HostSlot(self, urlparse(url).netloc)
+
+
+class _HostSlot:
+    def __init__(self, throttle, host):
+        self.throttle = throttle
+        self.host = host
+
+    def __enter__(self):
+        self.semaphore = self.throttle._semaphore(self.host)
+        self.semaphore.acquire()
+        self.throttle._wait_for_slot(self.host)
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+        return False
+
+
+@dataclass
+class CrawlResult:
+    url: str
+    depth: int
+    title: str = 'No Title Found'
+    internal_links: set = field(default_factory=set)
+    external_links: set = field(default_factory=set)
+    status_code: int = None
+    error: str = None
+    scanned_at: str = None
+    changed: bool = True
+
+    @property
+    def ok(self):
+        return self.error is None and self.status_code == 200
+
+
+class Crawler:
+    """Thread-pooled crawler over a shared keep-alive session.
+
+    Pages are yielded from `crawl` as soon as they finish, so callers can
+    render partial results while the rest of the frontier is still in flight.
+    With `max_depth` > 0 internal links found on a page are queued for
+    fetching, up to `max_pages` pages in total. Passing a PageCache makes
+    every request conditional and marks unchanged pages with `changed=False`.
+    """
+
+    def __init__(self, max_workers=16, per_host_concurrency=4, requests_per_second=None,
+                 timeout=DEFAULT_TIMEOUT, max_depth=0, max_pages=1000, session=None, cache=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.timeout = timeout
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.throttle = HostThrottle(per_host_concurrency, requests_per_second)
+        self.session = session or make_session(pool_size=max_workers)
+
+    def fetch(self, url, depth=0):
+        result = CrawlResult(url=url, depth=depth)
+        try:
+            with self.throttle(url):
+                links, title, page = find_linked_urls_and_title(url, self.session, self.timeout, self.cache)
+            result.title = title
+            result.status_code = page.status_code
+            result.error = page.error
+            result.changed = page.changed
+            absolute_urls = convert_to_absolute_urls(url, links)
+            result.internal_links, result.external_links = categorize_links(url, absolute_urls)
+        except Exception as e:
+            result.error = str(e)
+        result.scanned_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return result
+
+    def crawl(self, seed_urls):
+        seen = set()
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for url in seed_urls:
+                # Same form as discovered links, so a seed is not fetched again when a page links back to it
+                url = canonicalize_url(url)
+                if url not in seen and len(seen) < self.max_pages:
+                    seen.add(url)
+                    pending.add(executor.submit(propagate(self.fetch), url, 0))
+
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        if result.depth < self.max_depth:
+                            for link in result.internal_links:
+                                link = canonicalize_url(link)
+                                if urlparse(link).scheme not in ('http', 'https'):
+                                    continue
+                                if link in seen or len(seen) >= self.max_pages:
+                                    continue
+                                seen.add(link)
+                                pending.add(executor.submit(propagate(self.fetch), link, result.depth + 1))
+                        yield result
+            finally:
+                # Stop queued fetches if the consumer bails out early
+                for future in pending:
+                    future.cancel()
+
+    def close(self):
+        self.session.close()
+
+
+def crawl_result_rows(result):
+    """(URL, Type, Page Name, Scanned DateTime, Ignore) rows for the links found by a crawl."""
+    return ([(link, 'Internal', result.title, result.scanned_at, False) for link in result.internal_links] +
+            [(link, 'External', result.title, result.scanned_at, False) for link in result.external_links])
+
+
+def crawl(seed_urls, **kwargs):
+    """Convenience wrapper: crawl `seed_urls` and yield CrawlResult objects as they complete."""
+    crawler = Crawler(**kwargs)
+    try:
+        yield from crawler.crawl(seed_urls)
+    finally:
+        crawler.close()
+
+
+def fetch_pages(urls, cache=None, max_workers=16, per_host_concurrency=4, requests_per_second=None,
+                timeout=DEFAULT_TIMEOUT, session=None):
+    """Fetch `urls` concurrently and yield a FetchResult for each as it completes.
+
+    `urls` is consumed lazily with at most two fetches per worker queued, so
+    it can be a generator fed by another stage (e.g. a crawl).
+    """
+    throttle = HostThrottle(per_host_concurrency, requests_per_second)
+    own_session = session is None
+    session = session or make_session(pool_size=max_workers)
+
+    def fetch(url):
+        try:
+            with throttle(url):
+                return fetch_page(url, session, timeout, cache)
+        except Exception as e:
+            return FetchResult(url, '', None, changed=False, error=str(e))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            seen = set()
+            pending = set()
+            try:
+                for url in urls:
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                    pending.add(executor.submit(propagate(fetch), url))
+                    if len(pending) >= 2 * max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        if own_session:
+            session.close()
+
+
+def page_to_document(page, extra_metadata=None):
+    # Imported here so crawling does not pay for loading langchain
+    from langchain_core.documents import Document
+
+    metadata = {'source': page.url, 'content_hash': page.content_hash, 'domain': urlparse(page.url).netloc.lower()}
+    metadata.update(extra_metadata or {})
+    return Document(page_content=page.body, metadata=metadata)
+
+
+@metrics.timed('fetch_documents')
+def fetch_documents(urls, cache=None, only_changed=False, url_metadata=None, checkpoint=None, checkpoint_every=200,
+                    **kwargs):
+    """Fetch `urls` into Documents.
+
+    With a cache and `only_changed=True` pages whose content is identical to
+    the cached copy are left out, so downstream stages only see new work.
+    `url_metadata` maps URLs to extra metadata for their documents (e.g.
+    `URLFrontier.metadata_view()`).
+    With a `checkpoint` (a storage_utils.JobCheckpoint) the fetched pages are
+    committed every `checkpoint_every` pages and when the fetch is
+    interrupted; URLs it already holds are not fetched again and their
+    documents are read back from it, so a rerun resumes where the last one
+    stopped. Failed URLs are never committed, so they are retried.
+    Returns (documents, stats) where stats counts fetched/changed/unchanged/failed
+    pages and the pages resumed from the checkpoint.
+    """
+    url_metadata = url_metadata or {}
+    docs = []
+    stats = {'fetched': 0, 'changed': 0, 'unchanged': 0, 'failed': 0, 'resumed': 0}
+    if checkpoint is not None:
+        urls = list(urls)
+        # Only the documents of URLs still selected, in case the job's URLs were edited since it ran
+        wanted = set(urls)
+        docs = [doc for doc in checkpoint.documents() if doc.metadata.get('source') in wanted]
+        stats['resumed'] = sum(1 for url in wanted if url in checkpoint)
+        urls = [url for url in urls if url not in checkpoint]
+    done, new_docs = [], []
+    try:
+        for page in fetch_pages(urls, cache=cache, **kwargs):
+            if not page.ok:
+                stats['failed'] += 1
+                continue
+            stats['fetched'] += 1
+            stats['changed' if page.changed else 'unchanged'] += 1
+            done.append(page.url)
+            if page.changed or not only_changed:
+                new_docs.append(page_to_document(page, url_metadata.get(page.url)))
+            if checkpoint is not None and len(done) >= checkpoint_every:
+                checkpoint.commit(done, new_docs)
+                docs.extend(new_docs)
+                done, new_docs = [], []
+    finally:
+        if checkpoint is not None:
+            checkpoint.commit(done, new_docs)
+    docs.extend(new_docs)
+    if checkpoint is not None:
+        checkpoint.complete()
+    return docs, stats
+
+
+def media_rows(url, html):
+    """One (URL, Tag, Src, Alt) row per image and per video source in `html`."""
+    rows = []
+    for media in extract_html(html).media:
+        if media['tag'] == 'video':
+            rows.extend((url, 'video', src, None) for src in media['src'] or [None])
+        else:
+            rows.append((url, media['tag'], media['src'], media['alt']))
+    return rows
+
+
+def _media_rows_batch(batch):
+    rows = []
+    for url, html in batch:
+        rows.extend(media_rows(url, html))
+    return rows
+
+
+@metrics.timed('review_documents')
+def review_documents_local(docs, max_workers=None, batch_size=None):
+    """Find image and video assets in every document using a process pool.
+
+    Each document is parsed independently, so results stay traceable to
+    their source URL and memory does not grow with a concatenated corpus.
+    Returns a DataFrame with one row per asset.
+    """
+    import pandas as pd
+
+    items = [(doc.metadata.get('source'), doc.page_content) for doc in docs]
+    if not items:
+        return pd.DataFrame(columns=MEDIA_COLUMNS)
+    max_workers = max_workers or os.cpu_count() or 1
+    # Several batches per worker keeps the pool balanced without paying
+    # inter-process overhead per document
+    batch_size = batch_size or max(1, len(items) // (max_workers * 4))
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    rows = []
+    if max_workers == 1 or len(batches) == 1:
+        for batch in batches:
+            rows.extend(_media_rows_batch(batch))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for batch_rows in executor.map(_media_rows_batch, batches):
+                rows.extend(batch_rows)
+    return pd.DataFrame(rows, columns=MEDIA_COLUMNS)
@@ -0,0 +1,145 @@
+# Single-pass HTML extraction shared by link scanning and media review
+import re
+from dataclasses import dataclass, field
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional, BeautifulSoup is the fallback
+    etree = None
+
+NO_TITLE = 'No Title Found'
+
+# Tags whose text never belongs in the clean text output
+SKIP_TEXT_TAGS = {'script', 'style', 'noscript', 'template', 'head'}
+# Tags that end a line of text
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'table', 'section', 'article',
+    'header', 'footer', 'nav', 'aside', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'pre', 'blockquote', 'hr', 'dd', 'dt', 'figcaption', 'main', 'form',
+}
+_WHITESPACE = re.compile(r'\s+')
+
+
+@dataclass
+class ExtractedPage:
+    title: str = NO_TITLE
+    links: set = field(default_factory=set)
+    media: list = field(default_factory=list)
+    text: str = ''
+
+
+class _ExtractionTarget:
+    """lxml parser target that collects everything in one pass over the events."""
+
+    def __init__(self):
+        self.page = ExtractedPage()
+        self._title_parts = None
+        self._title_done = False
+        self._skip_depth = 0
+        self._video = None
+        self._lines = []
+        self._current = []
+
+    def start(self, tag, attrib):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag == 'a':
+            href = attrib.get('href')
+            if href is not None:
+                self.page.links.add(href)
+        elif tag == 'img':
+            self.page.media.append({'tag': 'img', 'src': attrib.get('src'), 'alt': attrib.get('alt', 'N/A')})
+        elif tag == 'video':
+            self._video = {'tag': 'video', 'src': []}
+            self.page.media.append(self._video)
+        elif tag == 'source' and self._video is not None:
+            self._video['src'].append(attrib.get('src'))
+        elif tag == 'title' and not self._title_done:
+            self._title_parts = []
+
+        if tag in SKIP_TEXT_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._break_line()
+
+    def end(self, tag):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag == 'video':
+            self._video = None
+        elif tag == 'title' and self._title_parts is not None:
+            self.page.title = ''.join(self._title_parts)
+            self._title_parts = None
+            self._title_done = True
+
+        if tag in SKIP_TEXT_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self._break_line()
+
+    def data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+        if not self._skip_depth:
+            self._current.append(data)
+
+    def _break_line(self):
+        if self._current:
+            line = _WHITESPACE.sub(' ', ''.join(self._current)).strip()
+            if line:
+                self._lines.append(line)
+            self._current = []
+
+    def close(self):
+        self._break_line()
+        self.page.text = '\n'.join(self._lines)
+        return self.page
+
+
+def _extract_lxml(html):
+    target = _ExtractionTarget()
+    parser = etree.HTMLParser(target=target, recover=True)
+    parser.feed(html)
+    try:
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # lxml raises on completely empty documents
+        return target.close()
+
+
+def _extract_bs4(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    page = ExtractedPage()
+    title_tag = soup.find('title')
+    if title_tag:
+        page.title = title_tag.text
+    for tag in soup.find_all(['a', 'img', 'video']):
+        if tag.name == 'a':
+            href = tag.get('href')
+            if href is not None:
+                page.links.add(href)
+        elif tag.name == 'img':
+            page.media.append({'tag': 'img', 'src': tag.get('src'), 'alt': tag.get('alt', 'N/A')})
+        else:
+            page.media.append({'tag': 'video', 'src': [source.get('src') for source in tag.find_all('source')]})
+    for tag in soup.find_all(list(SKIP_TEXT_TAGS)):
+        tag.decompose()
+    lines = (_WHITESPACE.sub(' ', line).strip() for line in soup.get_text('\n').splitlines())
+    page.text = '\n'.join(line for line in lines if line)
+    return page
+
+
+def extract_html(html, backend=None):
+    """Extract links, title, media tags and clean text from `html` in one pass.
+
+    Uses a streaming lxml parser when lxml is installed and falls back to
+    BeautifulSoup otherwise. `backend` forces 'lxml' or 'bs4'.
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    backend = backend or ('lxml' if etree is not None else 'bs4')
+    if backend == 'lxml':
+        if etree is None:
+            raise ImportError("lxml is not installed")
+        return _extract_lxml(html)
+    return _extract_bs4(html)
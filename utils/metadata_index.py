@@ -0,0 +1,177 @@
+# Bitmap index over chunk metadata for scoping vector searches
+from datetime import datetime
+from urllib.parse import urlparse
+
+import faiss
+import numpy as np
+
+BITMAP_FIELDS = ('domain', 'url_type', 'page_name')
+# On approximate indexes, selections up to this size are scored exactly instead of searched
+EXACT_SEARCH_MAX = 20000
+
+
+def _timestamp(value):
+    if not value:
+        return np.nan
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return np.nan
+
+
+def _pack(ids, size):
+    mask = np.zeros(size, dtype=bool)
+    mask[ids] = True
+    # Little bit order is the layout faiss.IDSelectorBitmap expects
+    return np.packbits(mask, bitorder='little')
+
+
+class MetadataIndex:
+    """Per-field bitmaps over vector IDs, plus scan timestamps for date ranges.
+
+    Every distinct value of a BITMAP_FIELDS field gets one bit per vector ID,
+    so a filter is a few OR/AND operations over packed bytes regardless of
+    how many chunks match.
+    """
+
+    def __init__(self, size, bitmaps, scanned_at, present):
+        self.size = size
+        self.bitmaps = bitmaps
+        self.scanned_at = scanned_at
+        self.present = present
+
+    @classmethod
+    def from_items(cls, items):
+        """Build from (vector ID, metadata) pairs."""
+        values = {field: {} for field in BITMAP_FIELDS}
+        ids, timestamps = [], []
+        for vid, metadata in items:
+            vid = int(vid)
+            ids.append(vid)
+            timestamps.append(_timestamp(metadata.get('scanned_at')))
+            if 'domain' not in metadata and metadata.get('source'):
+                metadata = {**metadata, 'domain': urlparse(metadata['source']).netloc.lower()}
+            for field in BITMAP_FIELDS:
+                value = metadata.get(field)
+                if value is not None:
+                    values[field].setdefault(str(value), []).append(vid)
+
+        size = max(ids) + 1 if ids else 0
+        scanned_at = np.full(size, np.nan)
+        scanned_at[ids] = timestamps
+        bitmaps = {field: {value: _pack(value_ids, size) for value, value_ids in field_values.items()}
+                   for field, field_values in values.items()}
+        return cls(size, bitmaps, scanned_at, _pack(ids, size))
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        """Index the metadata of every document in a langchain FAISS vector store."""
+        docstore = vectorstore.docstore
+        if hasattr(docstore, 'iter_metadata'):
+            return cls.from_items(docstore.iter_metadata())
+        return cls.from_items(
+            (vid, docstore.search(doc_id).metadata) for vid, doc_id in vectorstore.index_to_docstore_id.items())
+
+    def values(self, field):
+        """{value: number of chunks} for a bitmap field, most common first."""
+        counts = {value: int(np.unpackbits(bitmap).sum()) for value, bitmap in self.bitmaps.get(field, {}).items()}
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+    def scan_range(self):
+        known = self.scanned_at[~np.isnan(self.scanned_at)]
+        if not len(known):
+            return None, None
+        return datetime.fromtimestamp(known.min()), datetime.fromtimestamp(known.max())
+
+    def select(self, scanned_from=None, scanned_to=None, **filters):
+        """Packed bitmap of the vector IDs matching every filter, or None when nothing is filtered.
+
+        `filters` maps BITMAP_FIELDS names to collections of accepted values;
+        `scanned_from`/`scanned_to` bound the scan time (datetimes, inclusive).
+        """
+        selected = None
+        for field, accepted in filters.items():
+            if field not in self.bitmaps:
+                raise ValueError(f"{field} is not an indexed field")
+            if not accepted:
+                continue
+            field_bits = np.zeros_like(self.present)
+            for value in accepted:
+                bitmap = self.bitmaps[field].get(str(value))
+                if bitmap is not None:
+                    field_bits |= bitmap
+            selected = field_bits if selected is None else selected & field_bits
+
+        if scanned_from is not None or scanned_to is not None:
+            in_range = ~np.isnan(self.scanned_at)
+            if scanned_from is not None:
+                in_range &= self.scanned_at >= scanned_from.timestamp()
+            if scanned_to is not None:
+                in_range &= self.scanned_at <= scanned_to.timestamp()
+            range_bits = np.packbits(in_range, bitorder='little')
+            selected = range_bits if selected is None else selected & range_bits
+
+        return None if selected is None else selected & self.present
+
+    def ids(self, bitmap):
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.size, bitorder='little'))
+
+
+def _inner_index(index):
+    return faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+
+
+def _search_parameters(index, selector):
+    """SearchParameters of the type `index` (or the index it wraps) expects, carrying `selector`."""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _exact_search(index, query, ids, k):
+    vectors = index.reconstruct_batch(ids)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        scores = vectors @ query[0]
+        order = np.argsort(-scores)[:k]
+    else:
+        scores = ((vectors - query[0]) ** 2).sum(axis=1)
+        order = np.argsort(scores)[:k]
+    return scores[order], ids[order]
+
+
+def filtered_search(vectorstore, vector, k=4, bitmap=None, metadata_index=None):
+    """Nearest documents to `vector` among the vector IDs set in `bitmap` (see MetadataIndex.select).
+
+    The index is searched with an ID selector, so vectors outside the
+    selection are never scored. IVF probing and HNSW graph walks can miss
+    a narrow selection entirely, so on those indexes selections of up to
+    EXACT_SEARCH_MAX vectors are instead scored exactly from their
+    reconstructed vectors (needs `metadata_index`). Without a bitmap this
+    is a plain search.
+    """
+    if bitmap is None:
+        return vectorstore.similarity_search_by_vector(vector, k=k)
+    index = faiss.downcast_index(vectorstore.index)
+    query = np.asarray([vector], dtype=np.float32)
+
+    labels = None
+    if metadata_index is not None and not isinstance(_inner_index(index), faiss.IndexFlat):
+        ids = metadata_index.ids(bitmap)
+        if not len(ids):
+            return []
+        if len(ids) <= EXACT_SEARCH_MAX:
+            try:
+                labels = _exact_search(index, query, ids.astype(np.int64), k)[1]
+            except RuntimeError:
+                # Index types without reconstruction (e.g. IVF without a direct map)
+                labels = None
+    if labels is None:
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        _, labels = index.search(query, k, params=_search_parameters(index, selector))
+        labels = labels[0]
+
+    return [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(label)])
+            for label in labels if label != -1]
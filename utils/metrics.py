@@ -0,0 +1,267 @@
+# Process-wide timers, counters and histograms, with per-request stage spans
+import contextvars
+import functools
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+TRACE_FILE_ENV = "KNOWLEDGE_NAVIGATOR_TRACE_FILE"
+METRIC_PREFIX = "knowledge_navigator_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+# Recent observations kept per stage for the dashboard's windowed percentiles
+RECENT_OBSERVATIONS = 4096
+RECENT_SPANS = 2000
+
+_ids = itertools.count(1)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+@dataclass
+class Span:
+    """One timed stage of a request. Spans opened inside another span share its trace_id."""
+    name: str
+    trace_id: int
+    span_id: int
+    parent_id: int = None
+    start: float = 0.0
+    seconds: float = None
+    status: str = 'ok'
+    error: str = None
+    attributes: dict = field(default_factory=dict)
+
+
+class Histogram:
+    """Cumulative buckets, sum and count in the Prometheus sense, plus recent (time, value) observations."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_OBSERVATIONS)
+
+    def observe(self, value, now=None):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.recent.append((now or time.time(), value))
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = q / 100 * (len(sorted_values) - 1)
+    low = math.floor(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """Counters, histograms and spans collected for the whole process.
+
+    `span(stage)` is the main entry point: it times the block into the
+    `stage_seconds` histogram, counts failures in `stage_errors_total` and
+    records a Span, nested under the span that is open in the same thread or
+    asyncio task. Finished spans are kept in a ring buffer for the dashboard
+    and, when a trace file is set, appended to it as JSON lines.
+    """
+
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self.spans = deque(maxlen=RECENT_SPANS)
+
+    def count(self, name, amount=1, help=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if help:
+                self._help[name] = help
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, help=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+            if help:
+                self._help[name] = help
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def counters(self, name):
+        """{labels as 'name=value, ...': count} for every label set of counter `name`."""
+        with self._lock:
+            return {', '.join(f"{label}={value}" for label, value in labels) or name: count
+                    for (counter, labels), count in sorted(self._counters.items()) if counter == name}
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """Time the block as `stage`; yields the Span so attributes can be added while it runs."""
+        parent = _current_span.get()
+        span = Span(stage, parent.trace_id if parent else next(_ids), next(_ids),
+                    parent.span_id if parent else None, time.time(), attributes=attributes)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            # Not BaseException: Streamlit reruns and KeyboardInterrupt are not stage failures
+            span.status = 'error'
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            _current_span.reset(token)
+            self._finish(span)
+
+    def record(self, stage, seconds, status='ok', **attributes):
+        """Record a stage timed elsewhere (e.g. across the yields of a generator) as a finished span."""
+        parent = _current_span.get()
+        span = Span(stage, parent.trace_id if parent else next(_ids), next(_ids),
+                    parent.span_id if parent else None, time.time() - seconds, seconds, status,
+                    attributes=attributes)
+        self._finish(span)
+        return span
+
+    def timed(self, stage):
+        """Decorator form of `span`."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, span):
+        self.observe('stage_seconds', span.seconds, help="Time spent in each pipeline stage", stage=span.name)
+        self.count('stage_calls_total', help="Stage executions", stage=span.name)
+        if span.status == 'error':
+            self.count('stage_errors_total', help="Stage executions that raised", stage=span.name)
+        self.spans.append(span)
+        trace_file = self.trace_file or os.environ.get(TRACE_FILE_ENV)
+        if trace_file:
+            line = json.dumps(asdict(span), default=str)
+            with self._lock, open(trace_file, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def stage_summary(self, window_seconds=300):
+        """Per stage over the last `window_seconds`: calls, errors, calls/s and latency percentiles (ms).
+
+        Computed from the last RECENT_OBSERVATIONS calls of each stage.
+        """
+        now = time.time()
+        since = now - window_seconds
+        elapsed = min(window_seconds, now - self.started) or 1.0
+        errors = {}
+        for span in list(self.spans):
+            if span.status == 'error' and span.start >= since:
+                errors[span.name] = errors.get(span.name, 0) + 1
+        rows = []
+        with self._lock:
+            histograms = [(dict(labels)['stage'], list(histogram.recent))
+                          for (name, labels), histogram in self._histograms.items() if name == 'stage_seconds']
+        for stage, recent in sorted(histograms):
+            values = sorted(value for at, value in recent if at >= since)
+            if not values:
+                continue
+            rows.append({
+                'stage': stage,
+                'calls': len(values),
+                'errors': errors.get(stage, 0),
+                'per_second': round(len(values) / elapsed, 3),
+                'p50_ms': round(_percentile(values, 50) * 1000, 2),
+                'p95_ms': round(_percentile(values, 95) * 1000, 2),
+                'p99_ms': round(_percentile(values, 99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2),
+            })
+        return rows
+
+    def recent_traces(self, limit=20):
+        """The last `limit` traces as {trace_id: [spans, oldest first]}, newest trace first."""
+        traces = {}
+        for span in reversed(list(self.spans)):
+            if span.trace_id not in traces and len(traces) >= limit:
+                continue
+            traces.setdefault(span.trace_id, []).append(span)
+        return {trace_id: sorted(spans, key=lambda s: s.start) for trace_id, spans in traces.items()}
+
+    def to_prometheus(self):
+        """All counters and histograms in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count))
+                                for key, h in self._histograms.items())
+            help_text = dict(self._help)
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in help_text:
+                    lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text[name]}")
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{METRIC_PREFIX}{name}{_label_text(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_label_text(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_label_text(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def to_jsonl(self):
+        """The recent spans as JSON lines, oldest first."""
+        return ''.join(json.dumps(asdict(span), default=str) + '\n' for span in list(self.spans))
+
+    def write_prometheus(self, path):
+        # Written to a temporary file first so a scraper (e.g. node_exporter's textfile collector) never sees half a file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.spans.clear()
+            self.started = time.time()
+
+
+def propagate(function):
+    """Bind `function` to the current context, so spans it opens in a worker thread join the caller's trace."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+metrics = Metrics()
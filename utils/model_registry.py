@@ -0,0 +1,164 @@
+# Process-wide registry of loaded models, shared by every Streamlit session
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+WARMUP_MODELS_ENV = "KNOWLEDGE_NAVIGATOR_WARMUP_MODELS"
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("KNOWLEDGE_NAVIGATOR_MODEL_MEMORY_MB", "4096"))
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def estimate_model_bytes(model):
+    """Parameter memory of a torch-backed model (e.g. HuggingFaceEmbeddings.client), 0 if unknown."""
+    module = getattr(model, 'client', model)
+    try:
+        return sum(p.numel() * p.element_size() for p in module.parameters())
+    except Exception:
+        return 0
+
+
+class ModelLease:
+    """A reference to a registry entry. Released explicitly or when garbage collected,
+    so a lease kept in st.session_state is dropped when its session ends.
+
+    A garbage-collected lease is only queued for release: the finalizer can run
+    in a thread that already holds the registry lock."""
+
+    def __init__(self, registry, key, model):
+        self.registry = registry
+        self.key = key
+        self.model = model
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.registry._release(self.key)
+
+    def __del__(self):
+        if not self._released:
+            self._released = True
+            self.registry._release_later(self.key)
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.model = None
+        self.refs = 0
+        self.size = 0
+        self.last_used = 0.0
+
+
+class ModelRegistry:
+    """Process-wide cache of embedding models and LLM clients shared by all sessions.
+
+    Entries are keyed by kind, model name and config. Each `acquire` returns a
+    ModelLease that holds a reference; entries nobody references are kept for
+    reuse and evicted least recently used first once their estimated memory
+    exceeds `memory_budget_mb`. Entries in use are never evicted.
+    """
+
+    def __init__(self, memory_budget_mb=MODEL_MEMORY_BUDGET_MB):
+        self.memory_budget = memory_budget_mb * 1024 ** 2
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Keys of leases released by their finalizers, applied by the next acquire or release
+        self._deferred_releases = deque()
+        self.loads = 0
+        self.hits = 0
+
+    def acquire(self, kind, name, config, factory, size_fn=estimate_model_bytes):
+        key = (kind, name, _freeze(config))
+        with self._lock:
+            self._apply_deferred_releases()
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.refs += 1
+            self._entries.move_to_end(key)
+
+        # Loading happens under the entry's own lock so other models are not blocked
+        with entry.lock:
+            if entry.model is None:
+                try:
+                    entry.model = factory()
+                except Exception:
+                    self._discard_failed(key, entry)
+                    raise
+                entry.size = size_fn(entry.model)
+                self.loads += 1
+            else:
+                self.hits += 1
+            entry.last_used = time.time()
+
+        self._evict()
+        return ModelLease(self, key, entry.model)
+
+    def _discard_failed(self, key, entry):
+        # Drop the lease taken above, and the entry itself unless another caller is waiting to load it
+        with self._lock:
+            entry.refs = max(0, entry.refs - 1)
+            if entry.refs == 0 and entry.model is None and self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def _release(self, key):
+        with self._lock:
+            self._drop_ref(key)
+        self._evict()
+
+    def _release_later(self, key):
+        # Takes no lock: deque.append is atomic, and this runs from finalizers
+        self._deferred_releases.append(key)
+
+    def _drop_ref(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_used = time.time()
+
+    def _apply_deferred_releases(self):
+        # Called with self._lock held
+        while self._deferred_releases:
+            self._drop_ref(self._deferred_releases.popleft())
+
+    def _evict(self):
+        with self._lock:
+            self._apply_deferred_releases()
+            total = sum(entry.size for entry in self._entries.values())
+            for key in list(self._entries):
+                if total <= self.memory_budget:
+                    break
+                entry = self._entries[key]
+                if entry.refs == 0 and entry.model is not None:
+                    total -= entry.size
+                    del self._entries[key]
+
+    def warm_up(self, kind, name, config, factory):
+        """Load a model ahead of first use without holding a reference to it."""
+        self.acquire(kind, name, config, factory).release()
+
+    def stats(self):
+        with self._lock:
+            self._apply_deferred_releases()
+            return [
+                {'Kind': key[0], 'Model': key[1], 'References': entry.refs,
+                 'Memory MB': round(entry.size / 1024 ** 2, 1), 'Loaded': entry.model is not None}
+                for key, entry in self._entries.items()
+            ]
+
+
+registry = ModelRegistry()
+
+
+def warmup_model_names():
+    """Embedding models to preload at startup, from the KNOWLEDGE_NAVIGATOR_WARMUP_MODELS list."""
+    return [name.strip() for name in os.environ.get(WARMUP_MODELS_ENV, "").split(",") if name.strip()]
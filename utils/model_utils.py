@@ -1 +1,226 @@
 # Add your model-related utilities here
+import asyncio
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+from utils.model_registry import registry, warmup_model_names
+from utils.storage_utils import content_hash
+
+
+def load_tokenizer(model_name):
+    """Load the Hugging Face tokenizer for `model_name`, or None when it is unavailable (e.g. offline)."""
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_name)
+    except Exception:
+        return None
+
+
+SENTENCE_TRANSFORMERS_BACKEND = "sentence-transformers"
+QUANTIZED_BACKEND = "onnx-int8"
+EMBEDDING_BACKENDS = (SENTENCE_TRANSFORMERS_BACKEND, QUANTIZED_BACKEND)
+
+
+def embedding_cache_key(model_name, encode_kwargs=None, backend=SENTENCE_TRANSFORMERS_BACKEND):
+    """Cache namespace for a model: vectors are only reusable with identical encode settings."""
+    settings = ','.join(f"{k}={v}" for k, v in sorted((encode_kwargs or {}).items()))
+    if backend != SENTENCE_TRANSFORMERS_BACKEND:
+        # Quantized vectors are close to, but not the same as, the full precision ones
+        model_name = f"{model_name}@{backend}"
+    return f"{model_name}|{settings}"
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings model so document texts already in `cache` are not re-encoded."""
+
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [content_hash(text) for text in texts]
+        found = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing), vectors)
+            found.update(zip(missing, vectors))
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [list(map(float, found[key])) for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+class HashingEmbeddings(Embeddings):
+    """Tiny deterministic embedder: hashed bag of words, L2-normalized.
+
+    Needs no download or network, so benchmarks and CI can run offline.
+    Texts sharing words get similar vectors, which is enough to exercise
+    retrieval end to end.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            h = zlib.crc32(word.encode('utf-8'))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class LazyEmbeddings(Embeddings):
+    """Embeddings that lease the real model on the first embed call.
+
+    Lets a page open vector stores and render without loading the model;
+    the lease is released with this object.
+    """
+
+    def __init__(self, acquire):
+        self._acquire = acquire
+        self._lock = threading.Lock()
+        self.lease = None
+
+    @property
+    def model(self):
+        with self._lock:
+            if self.lease is None:
+                self.lease = self._acquire()
+        return self.lease.model
+
+    def embed_documents(self, texts):
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.model.embed_query(text)
+
+
+HASHING_MODEL_NAME = "hashing"
+
+
+def acquire_embeddings(model_name, device="cpu", encode_kwargs=None, multi_process=False,
+                       backend=SENTENCE_TRANSFORMERS_BACKEND, batch_size=32, threads=None):
+    """Lease a shared HuggingFaceEmbeddings for `model_name` on `device`.
+
+    HASHING_MODEL_NAME gives the offline HashingEmbeddings instead. With
+    `backend=QUANTIZED_BACKEND` the model runs int8-quantized on ONNX
+    Runtime (CPU only, exported on first use), encoding `batch_size` texts
+    per call on `threads` threads (None: all cores).
+    """
+    if model_name == HASHING_MODEL_NAME:
+        return registry.acquire('embeddings', model_name, {}, HashingEmbeddings, size_fn=lambda model: 0)
+
+    if backend == QUANTIZED_BACKEND:
+        from utils.onnx_embeddings import load_quantized_embeddings
+
+        normalize = (encode_kwargs or {}).get("normalize_embeddings", True)
+        config = {'backend': backend, 'batch_size': batch_size, 'threads': threads, 'normalize': normalize}
+        return registry.acquire('embeddings', model_name, config, lambda: load_quantized_embeddings(
+            model_name, batch_size=batch_size, intra_op_threads=threads, normalize=normalize),
+            size_fn=lambda model: model.model_bytes)
+
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    encode_kwargs = encode_kwargs or {"normalize_embeddings": True}
+    config = {'device': device, 'encode_kwargs': encode_kwargs, 'multi_process': multi_process}
+    return registry.acquire('embeddings', model_name, config, lambda: HuggingFaceEmbeddings(
+        model_name=model_name,
+        multi_process=multi_process,
+        model_kwargs={"device": device},
+        encode_kwargs=encode_kwargs,
+    ))
+
+
+STUB_LLM_NAME = "local/stub"
+
+
+class StubLLM(LLM):
+    """Offline stand-in for HuggingFaceEndpoint that streams a canned answer.
+
+    Waits `first_token_delay` seconds before the first token and
+    `token_delay` between tokens, so streaming and latency reporting can be
+    exercised without a model server. Without `response` it answers with the
+    end of the prompt.
+    """
+
+    first_token_delay: float = 0.5
+    token_delay: float = 0.05
+    response: str = ""
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _tokens(self, prompt):
+        text = self.response or "Stub answer. " + ' '.join(prompt.split()[-40:])
+        return re.findall(r'\S+\s*', text)
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        return ''.join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_delay)
+        for i, token in enumerate(self._tokens(prompt)):
+            if i:
+                time.sleep(self.token_delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, prompt, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_delay)
+        for i, token in enumerate(self._tokens(prompt)):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+def acquire_llm(repo_id, **params):
+    """Lease a shared HuggingFaceEndpoint client for `repo_id` with generation `params`.
+
+    STUB_LLM_NAME gives a StubLLM instead; `params` are then its delays.
+    """
+    if repo_id == STUB_LLM_NAME:
+        return registry.acquire('llm', repo_id, params, lambda: StubLLM(**params), size_fn=lambda llm: 0)
+
+    from langchain_community.llms import HuggingFaceEndpoint
+
+    return registry.acquire('llm', repo_id, params, lambda: HuggingFaceEndpoint(repo_id=repo_id, **params),
+                            size_fn=lambda llm: 0)
+
+
+def warm_up_models(model_names=None, device="cpu"):
+    """Preload embedding models, by default those listed in KNOWLEDGE_NAVIGATOR_WARMUP_MODELS."""
+    if model_names is None:
+        model_names = warmup_model_names()
+    for model_name in model_names:
+        acquire_embeddings(model_name, device=device).release()
+    return model_names
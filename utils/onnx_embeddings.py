@@ -0,0 +1,258 @@
+# int8-quantized ONNX Runtime embeddings for CPU-only hosts
+import inspect
+import json
+import os
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ONNX_MODEL_DIR = "./out/onnx_models"
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model.int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+CONFIG_FILE = "embedding_config.json"
+
+
+def model_dir_for(model_name, root=ONNX_MODEL_DIR):
+    """Where the export of `model_name` lives; a directory that already holds an export is used as is."""
+    if os.path.isfile(os.path.join(model_name, CONFIG_FILE)):
+        return model_name
+    return os.path.join(root, model_name.replace('/', '--'))
+
+
+def quantize_model(model_dir):
+    """Write the int8 version of `model_dir`'s float model: weights quantized ahead of time,
+    activations quantized on the fly, which is what suits CPU inference."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(os.path.join(model_dir, MODEL_FILE), os.path.join(model_dir, QUANTIZED_MODEL_FILE),
+                     weight_type=QuantType.QInt8)
+
+
+def _write_config(model_dir, **config):
+    with open(os.path.join(model_dir, CONFIG_FILE), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def _pooling_mode(model_name):
+    """'cls' or 'mean', from the sentence-transformers pooling config when the model has one."""
+    try:
+        from huggingface_hub import hf_hub_download
+        with open(hf_hub_download(model_name, "1_Pooling/config.json")) as f:
+            pooling = json.load(f)
+        return 'cls' if pooling.get('pooling_mode_cls_token') else 'mean'
+    except Exception:
+        return 'mean'
+
+
+def export_model(model_name, model_dir=None, max_length=512, opset=14):
+    """Export a Hugging Face sentence-transformers model to ONNX and quantize it to int8.
+
+    Needs torch and transformers, but only here: the exported directory runs
+    on onnxruntime and tokenizers alone. Returns the directory.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    model_dir = model_dir or model_dir_for(model_name)
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.backend_tokenizer.save(os.path.join(model_dir, TOKENIZER_FILE))
+
+    sample = tokenizer(["an example sentence", "another"], padding=True, return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    sequence_axes = {0: 'batch', 1: 'sequence'}
+    # Newer torch defaults to the dynamo exporter, which needs onnxscript; the TorchScript one does not
+    legacy = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    class LastHiddenState(torch.nn.Module):
+        # Positional tensors in, one tensor out: what the tracer handles across transformers versions
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)), return_dict=True).last_hidden_state
+
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState().eval(), tuple(sample[name] for name in input_names),
+                          os.path.join(model_dir, MODEL_FILE), input_names=input_names,
+                          output_names=['last_hidden_state'],
+                          dynamic_axes={name: sequence_axes for name in input_names + ['last_hidden_state']},
+                          opset_version=opset, **legacy)
+    quantize_model(model_dir)
+    _write_config(model_dir, model_name=model_name, pooling=_pooling_mode(model_name),
+                  max_length=min(max_length, tokenizer.model_max_length), pad_token=tokenizer.pad_token,
+                  dim=model.config.hidden_size)
+    return model_dir
+
+
+def build_tiny_model(model_dir, texts, dim=64, hidden=128, max_vocab=5000, seed=0):
+    """Generate a small random embedding model from `texts`' vocabulary, for offline tests.
+
+    The graph (token embeddings, a feed-forward layer with a residual
+    connection) has the same inputs and output as an exported transformer,
+    and is quantized the same way, so the whole backend can be exercised
+    without downloading anything. Needs the onnx package.
+    """
+    from collections import Counter
+
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+
+    os.makedirs(model_dir, exist_ok=True)
+    counts = Counter(word for text in texts for word in text.lower().split())
+    vocab = {'[PAD]': 0, '[UNK]': 1}
+    for word, _ in counts.most_common(max_vocab - len(vocab)):
+        vocab.setdefault(word, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='[UNK]'))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.save(os.path.join(model_dir, TOKENIZER_FILE))
+
+    rng = np.random.default_rng(seed)
+    weights = {
+        'embeddings': rng.normal(0, 1, (len(vocab), dim)),
+        'w1': rng.normal(0, dim ** -0.5, (dim, hidden)),
+        'b1': rng.normal(0, 0.1, hidden),
+        'w2': rng.normal(0, hidden ** -0.5, (hidden, dim)),
+    }
+    nodes = [
+        helper.make_node('Gather', ['embeddings', 'input_ids'], ['tokens']),
+        helper.make_node('MatMul', ['tokens', 'w1'], ['projected']),
+        helper.make_node('Add', ['projected', 'b1'], ['biased']),
+        helper.make_node('Tanh', ['biased'], ['activated']),
+        helper.make_node('MatMul', ['activated', 'w2'], ['mixed']),
+        helper.make_node('Add', ['tokens', 'mixed'], ['last_hidden_state']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'tiny_embedding_model',
+        [helper.make_tensor_value_info('input_ids', TensorProto.INT64, ['batch', 'sequence'])],
+        [helper.make_tensor_value_info('last_hidden_state', TensorProto.FLOAT, ['batch', 'sequence', dim])],
+        initializer=[numpy_helper.from_array(value.astype(np.float32), name) for name, value in weights.items()])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 14)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, os.path.join(model_dir, MODEL_FILE))
+    quantize_model(model_dir)
+    _write_config(model_dir, model_name=f"tiny-{dim}", pooling='mean', max_length=256, pad_token='[PAD]', dim=dim)
+    return model_dir
+
+
+def build_tiny_transformer(model_dir, texts, hidden_size=64, layers=2, heads=4, max_vocab=5000, seed=0):
+    """Save a small random BERT with a vocabulary from `texts` as a Hugging Face model directory.
+
+    Unlike `build_tiny_model` it goes through `export_model` and loads in
+    HuggingFaceEmbeddings, so the export can be checked against the
+    sentence-transformers path offline. Needs torch and transformers.
+    """
+    from collections import Counter
+
+    import torch
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors
+    from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+
+    os.makedirs(model_dir, exist_ok=True)
+    special = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    vocab = {token: i for i, token in enumerate(special)}
+    counts = Counter(word for text in texts for word in text.lower().split())
+    for word, _ in counts.most_common(max_vocab - len(vocab)):
+        vocab.setdefault(word, len(vocab))
+    tokenizer = Tokenizer(models.WordPiece(vocab, unk_token='[UNK]'))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+        special_tokens=[('[CLS]', vocab['[CLS]']), ('[SEP]', vocab['[SEP]'])])
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='[UNK]', pad_token='[PAD]', cls_token='[CLS]',
+                            sep_token='[SEP]', mask_token='[MASK]', model_max_length=512).save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=layers,
+                        num_attention_heads=heads, intermediate_size=hidden_size * 4, max_position_embeddings=512)
+    BertModel(config).save_pretrained(model_dir)
+    return model_dir
+
+
+class QuantizedEmbeddings(Embeddings):
+    """Embeddings from an exported model (see `export_model`) run with ONNX Runtime on CPU.
+
+    Texts are sorted by length before batching so each batch pads to a
+    similar length, then encoded `batch_size` at a time with
+    `intra_op_threads` threads per call (None lets ONNX Runtime use every
+    core). Token vectors are pooled and normalized the way the original
+    sentence-transformers model does, so the vectors are comparable.
+    """
+
+    def __init__(self, model_dir, quantized=True, batch_size=32, intra_op_threads=None, normalize=True):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)
+        self.batch_size = batch_size
+        self.normalize = normalize
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads or 0
+        # Calls are already batched; one op at a time keeps the thread count at intra_op_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(self.config.get('max_length', 512))
+        pad_token = self.config.get('pad_token') or '[PAD]'
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+        # The tokenizer is not safe to reconfigure concurrently and a session run is already multithreaded
+        self._lock = threading.Lock()
+
+    @property
+    def model_bytes(self):
+        return os.path.getsize(self.model_path)
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+        if self.config.get('pooling') == 'cls':
+            vectors = hidden[:, 0]
+        else:
+            mask = inputs['attention_mask'][:, :, None].astype(hidden.dtype)
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.empty((len(texts), self.config['dim']), dtype=np.float32)
+        with self._lock:
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                vectors[batch] = self._encode_batch([texts[i] for i in batch])
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def load_quantized_embeddings(model_name, batch_size=32, intra_op_threads=None, normalize=True,
+                              root=ONNX_MODEL_DIR):
+    """QuantizedEmbeddings for `model_name` (a Hub name or an export directory), exporting it on first use."""
+    model_dir = model_dir_for(model_name, root)
+    if not os.path.isfile(os.path.join(model_dir, CONFIG_FILE)):
+        export_model(model_name, model_dir)
+    return QuantizedEmbeddings(model_dir, batch_size=batch_size, intra_op_threads=intra_op_threads,
+                               normalize=normalize)
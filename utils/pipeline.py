@@ -0,0 +1,318 @@
+"""Headless crawl -> fetch -> chunk -> encode -> package pipeline.
+
+Runs the same steps as the Data Collection, Data Organization and Encoding
+pages without Streamlit, so large collections can be built on a server:
+
+    python -m utils.pipeline https://example.com --depth 2 --output out/example.zip
+
+Crawling and fetching run on thread pools, chunking on a process pool and
+encoding in the main process; the stages are connected by bounded queues so
+memory stays flat however large the crawl is. The output is the vector store
+package the Testing and QA page opens.
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+
+from utils.chunking import Deduplicator, chunk_documents, make_splitter
+from utils.data_processing import (DEFAULT_TIMEOUT, canonicalize_url, crawl, crawl_result_rows, fetch_pages,
+                                   is_valid_url, page_to_document)
+from utils.metrics import metrics
+from utils.model_utils import (EMBEDDING_BACKENDS, SENTENCE_TRANSFORMERS_BACKEND, CachedEmbeddings,
+                               acquire_embeddings, embedding_cache_key, load_tokenizer)
+from utils.storage_utils import PageCache, shared_embedding_cache
+from utils.url_frontier import URLFrontier
+from utils.vector_index import (DEFAULT_INDEX_PARAMS, INDEX_TYPES, VECTOR_INDEX_DIR, encode_into_index, index_lock,
+                                open_or_create_index, package_manifest, write_vector_package)
+
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+@dataclass
+class PipelineStats:
+    pages_crawled: int = 0
+    urls_queued: int = 0
+    fetched: int = 0
+    unchanged: int = 0
+    failed: int = 0
+    documents: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    vectors: int = 0
+    elapsed: float = 0.0
+
+
+def _put(q, item, stop):
+    # Blocks while downstream is busy, but gives up once the pipeline is stopping
+    while True:
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise PipelineStopped()
+
+
+def _drain(q, stop):
+    # Polls, so a consumer is not left waiting for a _DONE that a failing producer could not enqueue
+    while True:
+        try:
+            item = q.get(timeout=0.5)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def _start_stage(name, produce, outbox, stop, errors):
+    """Run `produce()` in a thread, putting what it yields into `outbox` followed by _DONE."""
+    def run():
+        try:
+            for item in produce():
+                _put(outbox, item, stop)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            errors.append((name, e))
+            stop.set()
+        finally:
+            try:
+                _put(outbox, _DONE, stop)
+            except PipelineStopped:
+                pass
+
+    thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+_worker_splitter = None
+
+
+def _init_chunk_worker(chunk_size, chunk_overlap, tokenizer_name):
+    global _worker_splitter
+    tokenizer = load_tokenizer(tokenizer_name) if tokenizer_name else None
+    _worker_splitter = make_splitter(chunk_size, chunk_overlap, tokenizer)
+
+
+def _chunk_batch(docs):
+    return list(chunk_documents(docs, _worker_splitter))
+
+
+def run_pipeline(seed_urls, output_path, embedding_model_name="thenlper/gte-small", device="cpu",
+                 max_depth=1, max_pages=1000, link_types=('Internal',), max_workers=16, per_host_concurrency=4,
+                 requests_per_second=None, timeout=DEFAULT_TIMEOUT, use_cache=True, only_changed=False,
+                 chunk_size=256, chunk_overlap=32, near_duplicates=True, near_duplicate_threshold=0.85,
+                 chunk_workers=None, chunk_batch_size=16, index_dir=VECTOR_INDEX_DIR, rebuild=False,
+                 index_type=None, index_params=None, batch_size=256, embedding_cache_gb=2.0,
+                 queue_size=1000, embedding_backend=SENTENCE_TRANSFORMERS_BACKEND, embedding_threads=None,
+                 on_progress=None):
+    """Crawl `seed_urls`, fetch the linked pages, chunk, encode and write a package to `output_path`.
+
+    Links of `link_types` found by the crawl are fetched, with the crawl's
+    link type, source page and scan time kept as chunk metadata. Vectors
+    are upserted into the persistent index at `index_dir` (recreated when
+    `rebuild`), so nightly runs with `use_cache` only re-encode pages that
+    changed. The index keeps its type and parameters unless `index_type`
+    or `index_params` ask for others; a new index defaults to Flat.
+    `embedding_backend=QUANTIZED_BACKEND` encodes with the int8
+    ONNX Runtime model on `embedding_threads` threads. `on_progress(stats)`
+    is called as encoding advances. Returns PipelineStats.
+    """
+    stats = PipelineStats()
+    start = time.perf_counter()
+    stop = threading.Event()
+    errors = []
+    url_queue = queue.Queue(maxsize=queue_size)
+    doc_queue = queue.Queue(maxsize=max(1, queue_size // 10))
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    frontier = URLFrontier()
+    changed_in_crawl = {}
+    cache = PageCache() if use_cache else None
+
+    def crawl_stage():
+        for result in crawl(seed_urls, max_workers=max_workers, per_host_concurrency=per_host_concurrency,
+                            requests_per_second=requests_per_second, timeout=timeout, max_depth=max_depth,
+                            max_pages=max_pages, cache=cache):
+            stats.pages_crawled += 1
+            # The crawl refreshes the cache first, so its fetch is the one that sees a page change
+            changed_in_crawl[result.url] = result.changed
+            for row in crawl_result_rows(result):
+                if row[1] not in link_types or not is_valid_url(row[0]) or not frontier.add(*row):
+                    continue
+                stats.urls_queued += 1
+                yield canonicalize_url(row[0])
+            if stop.is_set():
+                return
+
+    def fetch_stage():
+        for page in fetch_pages(_drain(url_queue, stop), cache=cache, max_workers=max_workers,
+                                per_host_concurrency=per_host_concurrency,
+                                requests_per_second=requests_per_second, timeout=timeout):
+            if not page.ok:
+                stats.failed += 1
+                continue
+            stats.fetched += 1
+            if not (page.changed or changed_in_crawl.get(page.url)):
+                stats.unchanged += 1
+                if only_changed:
+                    continue
+            stats.documents += 1
+            yield page_to_document(page, frontier.metadata(page.url))
+
+    def chunk_stage():
+        # HTML extraction and splitting are CPU bound, so they run in worker processes;
+        # duplicates are dropped here because that needs every chunk seen so far
+        deduplicator = Deduplicator(threshold=near_duplicate_threshold)
+        workers = chunk_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_chunk_worker,
+                                 initargs=(chunk_size, chunk_overlap, embedding_model_name)) as executor:
+            pending = set()
+
+            def finished(futures):
+                for future in futures:
+                    for chunk in deduplicator.filter(future.result(), near_duplicates=near_duplicates):
+                        stats.chunks += 1
+                        yield chunk
+                    stats.duplicates = deduplicator.stats.dropped
+
+            batch = []
+            for doc in _drain(doc_queue, stop):
+                batch.append(doc)
+                if len(batch) >= chunk_batch_size:
+                    pending.add(executor.submit(_chunk_batch, batch))
+                    batch = []
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        yield from finished(done)
+            if batch:
+                pending.add(executor.submit(_chunk_batch, batch))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from finished(done)
+
+    threads = [
+        _start_stage('crawl', crawl_stage, url_queue, stop, errors),
+        _start_stage('fetch', fetch_stage, doc_queue, stop, errors),
+        _start_stage('chunk', chunk_stage, chunk_queue, stop, errors),
+    ]
+
+    encode_kwargs = {"normalize_embeddings": True}
+    lease = None
+    try:
+        try:
+            lease = acquire_embeddings(embedding_model_name, device=device, encode_kwargs=encode_kwargs,
+                                       backend=embedding_backend, threads=embedding_threads)
+            model_key = embedding_cache_key(embedding_model_name, encode_kwargs, backend=embedding_backend)
+            encoder = lease.model
+            if embedding_cache_gb:
+                encoder = CachedEmbeddings(lease.model, shared_embedding_cache(
+                    model_key, max_bytes=int(embedding_cache_gb * 1024 ** 3)))
+
+            def progress(encode_progress):
+                stats.vectors = len(vector_index)
+                stats.elapsed = time.perf_counter() - start
+                if on_progress is not None:
+                    on_progress(stats)
+
+            # Waits for an encoding run of the app (or another pipeline) on the same index to finish
+            with index_lock(index_dir):
+                vector_index = open_or_create_index(lease.model, index_dir, model_key, rebuild=rebuild,
+                                                    index_type=index_type, index_params=index_params)
+                encode_into_index(_drain(chunk_queue, stop), vector_index, encoder, batch_size=batch_size,
+                                  on_progress=progress)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join(timeout=5)
+            if cache is not None:
+                cache.close()
+
+        if errors:
+            name, error = errors[0]
+            raise RuntimeError(f"Pipeline {name} stage failed: {error}") from error
+
+        write_vector_package(vector_index.as_vectorstore(lease.model), output_path,
+                             package_manifest(embedding_model_name, vector_index))
+    finally:
+        if lease is not None:
+            lease.release()
+    stats.vectors = len(vector_index)
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('seeds', nargs='+', help="URLs to start crawling from")
+    parser.add_argument('--output', required=True, help="vector store package (.zip) to write")
+    parser.add_argument('--embedding-model', default="thenlper/gte-small")
+    parser.add_argument('--device', default="cpu")
+    parser.add_argument('--embedding-backend', default=SENTENCE_TRANSFORMERS_BACKEND, choices=EMBEDDING_BACKENDS)
+    parser.add_argument('--embedding-threads', type=int, default=None, help="threads for the onnx-int8 backend")
+    parser.add_argument('--depth', type=int, default=1, help="follow internal links to this depth")
+    parser.add_argument('--max-pages', type=int, default=1000)
+    parser.add_argument('--link-types', nargs='+', default=['Internal'], choices=['Internal', 'External'])
+    parser.add_argument('--workers', type=int, default=16, help="concurrent fetches")
+    parser.add_argument('--per-host', type=int, default=4, help="concurrent fetches per host")
+    parser.add_argument('--rps', type=float, default=None, help="requests per second per host")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--no-cache', action='store_true', help="do not use the page cache")
+    parser.add_argument('--only-changed', action='store_true', help="skip pages unchanged since the last run")
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--chunk-overlap', type=int, default=32)
+    parser.add_argument('--no-near-duplicates', action='store_true', help="only drop exact duplicate chunks")
+    parser.add_argument('--chunk-workers', type=int, default=None, help="chunking processes (default: all cores)")
+    parser.add_argument('--index-dir', default=VECTOR_INDEX_DIR)
+    parser.add_argument('--rebuild', action='store_true', help="start a new index instead of updating it")
+    parser.add_argument('--index-type', default=None, choices=INDEX_TYPES,
+                        help="index type for a new or rebuilt index (default: keep the existing type, or Flat)")
+    for name, value in DEFAULT_INDEX_PARAMS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=int, default=None,
+                            help=f"default: keep the existing value, or {value}")
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--embedding-cache-gb', type=float, default=2.0, help="0 disables the embedding cache")
+    parser.add_argument('--metrics-file', help="write stage timings and counters here in Prometheus text format")
+    parser.add_argument('--trace-file', help="append every stage span to this JSONL file")
+    args = parser.parse_args()
+    metrics.trace_file = args.trace_file
+
+    def report(stats):
+        print(f"\r{stats.pages_crawled} crawled, {stats.fetched} fetched ({stats.failed} failed), "
+              f"{stats.chunks} chunks, {stats.vectors} vectors, {stats.elapsed:.0f}s", end='', flush=True)
+
+    stats = run_pipeline(
+        args.seeds, args.output, embedding_model_name=args.embedding_model, device=args.device,
+        max_depth=args.depth, max_pages=args.max_pages, link_types=tuple(args.link_types), max_workers=args.workers,
+        per_host_concurrency=args.per_host, requests_per_second=args.rps, timeout=args.timeout,
+        use_cache=not args.no_cache, only_changed=args.only_changed, chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap, near_duplicates=not args.no_near_duplicates,
+        chunk_workers=args.chunk_workers, index_dir=args.index_dir, rebuild=args.rebuild,
+        index_type=args.index_type,
+        # Only the parameters given on the command line, so the index keeps the rest of its settings
+        index_params={name: getattr(args, name) for name in DEFAULT_INDEX_PARAMS
+                      if getattr(args, name) is not None} or None,
+        batch_size=args.batch_size, embedding_cache_gb=args.embedding_cache_gb,
+        embedding_backend=args.embedding_backend, embedding_threads=args.embedding_threads, on_progress=report)
+    print()
+    print(f"Wrote {stats.vectors} vectors from {stats.documents} documents to {args.output} "
+          f"in {stats.elapsed:.1f}s ({stats.duplicates} duplicate chunks dropped).")
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Asynchronous retrieval and streaming generation for the Q&A page
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from utils.metadata_index import filtered_search
+from utils.metrics import metrics
+
+
+@dataclass
+class StreamedAnswer:
+    """Answer text, retrieved documents and timings, filled in while the answer streams."""
+    question: str
+    answer: str = ''
+    documents: list = field(default_factory=list)
+    query_vector: list = None
+    tokens: int = 0
+    started: float = field(default_factory=time.perf_counter)
+    retrieval_seconds: float = None
+    first_token_seconds: float = None
+    total_seconds: float = None
+
+
+def build_prompt(template, question):
+    """The prompt with the question already filled in, leaving only the retrieved context."""
+    prompt = ChatPromptTemplate.from_template(template)
+    if 'question' in prompt.input_variables:
+        prompt = prompt.partial(question=question)
+    return prompt
+
+
+async def retrieve(vectorstore, embedding_model, question, query_vector=None, k=4, bitmap=None, metadata_index=None):
+    if query_vector is None:
+        with metrics.span('embed_query'):
+            query_vector = await embedding_model.aembed_query(question)
+    with metrics.span('search', scoped=bitmap is not None):
+        if bitmap is None:
+            documents = await vectorstore.asimilarity_search_by_vector(query_vector, k=k)
+        else:
+            documents = await asyncio.to_thread(filtered_search, vectorstore, query_vector, k, bitmap, metadata_index)
+    return query_vector, documents
+
+
+async def astream_answer(result, vectorstore, embedding_model, template, llm, k=4, bitmap=None, metadata_index=None):
+    """Yield answer tokens for `result.question` as the LLM produces them.
+
+    Retrieval runs concurrently with building the prompt. `result`, a
+    StreamedAnswer, is updated with the documents, the answer so far and the
+    time to first token and total latency (seconds since `result.started`).
+    A `bitmap` from MetadataIndex.select restricts retrieval to those vectors.
+    """
+    (result.query_vector, result.documents), prompt = await asyncio.gather(
+        retrieve(vectorstore, embedding_model, result.question, result.query_vector, k=k,
+                 bitmap=bitmap, metadata_index=metadata_index),
+        asyncio.to_thread(build_prompt, template, result.question),
+    )
+    result.retrieval_seconds = time.perf_counter() - result.started
+
+    chain = prompt | llm | StrOutputParser()
+    # Recorded rather than wrapped in a span, which cannot stay open across the yields
+    generate_started = time.perf_counter()
+    async for token in chain.astream({"context": result.documents}):
+        if result.first_token_seconds is None:
+            result.first_token_seconds = time.perf_counter() - result.started
+            metrics.record('first_token', time.perf_counter() - generate_started)
+        result.answer += token
+        result.tokens += 1
+        yield token
+    result.total_seconds = time.perf_counter() - result.started
+    metrics.record('generate', time.perf_counter() - generate_started, tokens=result.tokens)
+
+
+def stream_answer(result, vectorstore, embedding_model, template, llm, on_token=None, k=4, bitmap=None,
+                  metadata_index=None):
+    """Run `astream_answer` to completion from synchronous code such as a Streamlit script.
+
+    `on_token(result)` is called after each token. Returns `result`.
+    """
+    async def consume():
+        async for _ in astream_answer(result, vectorstore, embedding_model, template, llm, k=k, bitmap=bitmap,
+                                      metadata_index=metadata_index):
+            if on_token is not None:
+                on_token(result)
+
+    with metrics.span('qa_request'):
+        asyncio.run(consume())
+    return result
@@ -1 +1,742 @@
 # Add your storage and backup utilities here
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library json is the fallback
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, gzip is always available
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where FileLock only excludes threads of this process
+    fcntl = None
+
+PAGE_CACHE_DIR = "./out/page_cache"
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileLock:
+    """Exclusive lock on `path`, held across the threads and processes that lock the same path.
+
+    Backed by flock, so the operating system releases it when a process
+    dies. Without fcntl only threads of this process are excluded.
+    """
+
+    _thread_locks = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        with self._thread_locks_lock:
+            self._thread_lock = self._thread_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+    def acquire(self, blocking=True):
+        """Take the lock; with `blocking=False` returns False at once when it is held elsewhere."""
+        if fcntl is None:
+            return self._thread_lock.acquire(blocking)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if fcntl is None:
+            self._thread_lock.release()
+        elif self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    content_hash: str
+    etag: str = None
+    last_modified: str = None
+    status_code: int = 200
+    fetched_at: str = None
+
+
+@dataclass
+class FetchResult:
+    url: str
+    body: str
+    status_code: int
+    content_hash: str = None
+    changed: bool = True
+    from_cache: bool = False
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.status_code == 200
+
+
+class PageCache:
+    """Persistent, content-addressed HTTP page cache.
+
+    Page bodies are stored once per distinct content hash as zlib-compressed
+    blobs under `objects/`, and a small SQLite index maps each URL to its
+    current hash plus the ETag / Last-Modified validators from the last
+    response. `fetch` sends a conditional request when validators are known
+    and reports whether the page content actually changed.
+    """
+
+    def __init__(self, cache_dir=PAGE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, etag TEXT, "
+            "last_modified TEXT, status_code INTEGER, fetched_at TEXT)"
+        )
+        self._conn.commit()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, content_hash, etag, last_modified, status_code, fetched_at FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def read_body(self, entry):
+        with open(self._object_path(entry.content_hash), 'rb') as f:
+            return zlib.decompress(f.read()).decode('utf-8')
+
+    def put(self, url, body, etag=None, last_modified=None, status_code=200):
+        """Store `body` for `url` and return (entry, changed)."""
+        digest = content_hash(body)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(body.encode('utf-8')))
+            os.replace(tmp_path, path)
+
+        previous = self.get(url)
+        entry = CacheEntry(url, digest, etag, last_modified, status_code,
+                           datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (entry.url, entry.content_hash, entry.etag, entry.last_modified,
+                 entry.status_code, entry.fetched_at),
+            )
+            self._conn.commit()
+        return entry, previous is None or previous.content_hash != digest
+
+    def touch(self, url):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE pages SET fetched_at = ? WHERE url = ?",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), url),
+            )
+            self._conn.commit()
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def fetch(self, url, session, timeout=10):
+        """GET `url` through the cache, revalidating with the stored validators.
+
+        Unchanged pages (a 304, or a 200 whose body hashes to the cached
+        content) come back with `changed=False` and the cached body.
+        """
+        entry = self.get(url)
+        response = session.get(url, timeout=timeout, headers=self.conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            self.touch(url)
+            return FetchResult(url, self.read_body(entry), 200, entry.content_hash,
+                               changed=False, from_cache=True)
+        if response.status_code != 200:
+            return FetchResult(url, '', response.status_code, changed=False,
+                               error=f"HTTP {response.status_code}")
+
+        new_entry, changed = self.put(
+            url,
+            response.text,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            status_code=response.status_code,
+        )
+        return FetchResult(url, response.text, 200, new_entry.content_hash, changed=changed)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+EMBEDDING_CACHE_DIR = "./out/embedding_cache"
+
+
+class EmbeddingCache:
+    """Persistent embedding cache for one model, keyed by chunk content hash.
+
+    Vectors live in a single memory-mapped array file (float16 by default) and
+    a SQLite index maps each key to its row. When `max_bytes` would be
+    exceeded the least recently used rows are evicted and their slots recorded
+    as free. New rows take free slots first and only then extend the array past
+    the highest slot in use, so rows are never handed out twice whatever the
+    cap was when they were written.
+
+    Slots are allocated, written and read inside SQLite write transactions
+    (`BEGIN IMMEDIATE`), so several instances on the same directory, in this
+    process or in others such as the headless pipeline, never hand out the
+    same slot. Within a process, share one instance per model with
+    `shared_embedding_cache`.
+    """
+
+    def __init__(self, model_key, cache_dir=EMBEDDING_CACHE_DIR, dtype='float16', max_bytes=2 * 1024 ** 3):
+        self.model_key = model_key
+        self.cache_dir = os.path.join(cache_dir, content_hash(model_key)[:16])
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._vectors_path = os.path.join(self.cache_dir, "vectors.bin")
+        self._meta_path = os.path.join(self.cache_dir, "meta.json")
+
+        self.dim = None
+        self.dtype = np.dtype(dtype)
+        self._load_meta()
+
+        # Autocommit mode, so transactions are only the explicit ones in _transaction
+        self._conn = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), timeout=60,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER NOT NULL, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_slot ON entries (slot)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY)")
+
+    def _load_meta(self):
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.dtype = np.dtype(meta['dtype'])
+
+    @contextmanager
+    def _transaction(self):
+        """Hold this instance's lock and the database write lock, which other instances and processes share."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @property
+    def max_entries(self):
+        if not self.dim:
+            return None
+        return max(1, self.max_bytes // (self.dim * self.dtype.itemsize))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _open_vectors(self, min_rows=0):
+        row_bytes = self.dim * self.dtype.itemsize
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        rows = size // row_bytes
+        # Another instance may have grown the file since it was mapped here
+        if self._vectors is not None and len(self._vectors) >= max(rows, min_rows):
+            return self._vectors
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        if rows < min_rows:
+            # Grow geometrically so appends stay amortized O(1), up to the cap unless a slot beyond it is needed
+            rows = max(min_rows, min(max(rows * 2, 1024), self.max_entries))
+            with open(self._vectors_path, 'ab') as f:
+                f.truncate(rows * row_bytes)
+        self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode='r+', shape=(rows, self.dim))
+        return self._vectors
+
+    def _lookup(self, keys):
+        slots = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            slots.update(self._conn.execute(
+                f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch).fetchall())
+        return slots
+
+    def get_many(self, keys):
+        """Return {key: float32 vector} for the keys present in the cache."""
+        self._load_meta()
+        if not self.dim:
+            return {}
+        # A write transaction, so no other instance can evict and overwrite a slot while it is read
+        with self._transaction():
+            slots = self._lookup(set(keys))
+            if not slots:
+                return {}
+            vectors = self._open_vectors()
+            now = time.time()
+            self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                   [(now, key) for key in slots])
+            return {key: np.asarray(vectors[slot], dtype=np.float32) for key, slot in slots.items()}
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+        with self._transaction():
+            self._load_meta()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'model_key': self.model_key, 'dim': self.dim, 'dtype': self.dtype.name}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+            existing = self._lookup(keys)
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in existing:
+                    new[key] = vector
+            new_items = list(new.items())[-self.max_entries:]
+            if not new_items:
+                return
+
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            overflow = count + len(new_items) - self.max_entries
+            if overflow > 0:
+                evicted = self._conn.execute(
+                    "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (overflow,)).fetchall()
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+                self._conn.executemany("INSERT OR IGNORE INTO free_slots VALUES (?)", [(slot,) for _, slot in evicted])
+            slots = self._allocate_slots(len(new_items))
+
+            array = self._open_vectors(min_rows=max(slots) + 1)
+            now = time.time()
+            for slot, (key, vector) in zip(slots, new_items):
+                array[slot] = vector
+            array.flush()
+            self._conn.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                                   [(key, slot, now) for slot, (key, _) in zip(slots, new_items)])
+
+    def _allocate_slots(self, n):
+        # Slots freed by eviction first, lowest first; the rest past the highest slot in use or free
+        slots = [slot for slot, in self._conn.execute(
+            "SELECT slot FROM free_slots ORDER BY slot LIMIT ?", (n,)).fetchall()]
+        self._conn.executemany("DELETE FROM free_slots WHERE slot = ?", [(slot,) for slot in slots])
+        if len(slots) < n:
+            end = self._conn.execute(
+                "SELECT MAX(slot) FROM (SELECT MAX(slot) AS slot FROM entries "
+                "UNION ALL SELECT MAX(slot) FROM free_slots)").fetchone()[0]
+            end = -1 if end is None else end
+            slots.extend(range(end + 1, end + 1 + n - len(slots)))
+        return slots
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            self._conn.close()
+
+
+_shared_embedding_caches = {}
+_shared_embedding_caches_lock = threading.Lock()
+
+
+def shared_embedding_cache(model_key, max_bytes=2 * 1024 ** 3, cache_dir=EMBEDDING_CACHE_DIR):
+    """The process-wide EmbeddingCache for `model_key`, created on first use.
+
+    `max_bytes` only applies when the cache is created; later callers share
+    that cap, so concurrent users do not keep resizing it under each other.
+    """
+    key = (os.path.abspath(cache_dir), model_key)
+    with _shared_embedding_caches_lock:
+        cache = _shared_embedding_caches.get(key)
+        if cache is None:
+            cache = _shared_embedding_caches[key] = EmbeddingCache(model_key, cache_dir, max_bytes=max_bytes)
+        return cache
+
+
+DOC_STORE_DIR = "./out/doc_store"
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _document(data):
+    from langchain_core.documents import Document
+    return Document(page_content=data['page_content'], metadata=data.get('metadata') or {})
+
+
+def open_compressed(path_or_file, mode='rb'):
+    """Open a possibly compressed binary stream.
+
+    For writing, compression is picked from the file extension (.gz, .zst).
+    For reading it is detected from the magic bytes, so uploaded file objects
+    work regardless of their name.
+    """
+    if 'w' in mode:
+        if path_or_file.endswith('.zst'):
+            if zstandard is None:
+                raise ImportError("zstandard is not installed, use a .gz path or pip install zstandard")
+            return zstandard.ZstdCompressor(level=3).stream_writer(open(path_or_file, 'wb'), closefd=True)
+        if path_or_file.endswith('.gz'):
+            return gzip.open(path_or_file, 'wb', compresslevel=5)
+        return open(path_or_file, 'wb')
+
+    raw = open(path_or_file, 'rb') if isinstance(path_or_file, str) else path_or_file
+    stream = raw if hasattr(raw, 'peek') else io.BufferedReader(raw)
+    magic = stream.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream)
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError("zstandard is not installed, cannot read a .zst document file")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream))
+    return stream
+
+
+def write_docs_jsonl(docs, path):
+    """Stream `docs` to a JSONL file, compressed according to the extension. Returns the count."""
+    count = 0
+    with open_compressed(path, 'wb') as f:
+        for doc in docs:
+            f.write(json_dumps({'page_content': doc.page_content, 'metadata': doc.metadata}) + b'\n')
+            count += 1
+    return count
+
+
+def iter_docs_jsonl(path_or_file):
+    """Lazily yield Documents from a (optionally gzip/zstd compressed) JSONL file or file object."""
+    stream = open_compressed(path_or_file, 'rb')
+    try:
+        for line in stream:
+            if line.strip():
+                yield _document(json_loads(line))
+    finally:
+        if isinstance(path_or_file, str):
+            stream.close()
+
+
+class ArrowDocStore:
+    """Columnar on-disk document store in the Arrow IPC file format.
+
+    The file is memory-mapped, so iteration reads one record batch at a time
+    and `get` fetches a single document by ID without loading the rest.
+    Columns are `id`, `page_content` and JSON-encoded `metadata`; the ID is
+    taken from `metadata[id_key]` (the source URL by default).
+    """
+
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self.path = path
+        self._reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        self._id_index = None
+
+    @classmethod
+    def write(cls, docs, path, batch_size=1024, id_key='source'):
+        import pyarrow as pa
+
+        schema = pa.schema([('id', pa.string()), ('page_content', pa.large_string()), ('metadata', pa.string())])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            batch = []
+            for position, doc in enumerate(docs):
+                doc_id = doc.metadata.get(id_key)
+                batch.append((str(doc_id if doc_id is not None else position), doc.page_content,
+                              json_dumps(doc.metadata).decode('utf-8')))
+                if len(batch) >= batch_size:
+                    writer.write_batch(pa.RecordBatch.from_arrays([pa.array(c) for c in zip(*batch)], schema=schema))
+                    batch = []
+            if batch:
+                writer.write_batch(pa.RecordBatch.from_arrays([pa.array(c) for c in zip(*batch)], schema=schema))
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def __len__(self):
+        return sum(self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches))
+
+    def _rows(self, batch):
+        for content, metadata in zip(batch.column('page_content').to_pylist(), batch.column('metadata').to_pylist()):
+            yield _document({'page_content': content, 'metadata': json_loads(metadata)})
+
+    def __iter__(self):
+        for i in range(self._reader.num_record_batches):
+            yield from self._rows(self._reader.get_batch(i))
+
+    def ids(self):
+        for i in range(self._reader.num_record_batches):
+            yield from self._reader.get_batch(i).column('id').to_pylist()
+
+    def get(self, doc_id):
+        """Return the Document with `doc_id`, or None. The ID index is built on first use."""
+        if self._id_index is None:
+            self._id_index = {}
+            for i in range(self._reader.num_record_batches):
+                for row, value in enumerate(self._reader.get_batch(i).column('id').to_pylist()):
+                    self._id_index.setdefault(value, (i, row))
+        location = self._id_index.get(doc_id)
+        if location is None:
+            return None
+        batch = self._reader.get_batch(location[0]).slice(location[1], 1)
+        return next(self._rows(batch))
+
+
+def open_doc_store(path_or_file, name=None):
+    """Open documents for streaming: an Arrow store, or a (compressed) JSONL file or upload.
+
+    JSONL input is converted once into an Arrow store under DOC_STORE_DIR so
+    later passes are memory-mapped instead of re-parsed.
+    """
+    name = name or (path_or_file if isinstance(path_or_file, str) else 'upload')
+    if name.endswith('.arrow'):
+        if isinstance(path_or_file, str):
+            return ArrowDocStore(path_or_file)
+        target = os.path.join(DOC_STORE_DIR, os.path.basename(name))
+        os.makedirs(DOC_STORE_DIR, exist_ok=True)
+        with open(target, 'wb') as f:
+            for block in iter(lambda: path_or_file.read(1 << 20), b''):
+                f.write(block)
+        return ArrowDocStore(target)
+    base = os.path.basename(name)
+    for suffix in ('.gz', '.zst', '.jsonl'):
+        base = base[:-len(suffix)] if base.endswith(suffix) else base
+    return ArrowDocStore.write(iter_docs_jsonl(path_or_file), os.path.join(DOC_STORE_DIR, base + '.arrow'))
+
+
+JOBS_DIR = "./out/jobs"
+MANIFEST_FILE = "manifest.json"
+FETCH_JOB = "fetch"
+ENCODE_JOB = "encode"
+
+
+class JobInUseError(Exception):
+    """Raised when another session or process is already running the job."""
+
+
+def job_name(kind, keys):
+    """Name of the `kind` job over `keys` (e.g. the URLs to fetch), so every distinct set gets its own job."""
+    digest = hashlib.sha256()
+    for key in sorted(keys):
+        digest.update(key.encode('utf-8') + b'\n')
+    return f"{kind}-{digest.hexdigest()[:16]}"
+
+
+class JobCheckpoint:
+    """Progress of a long fetch or encoding job, kept on disk so a rerun can resume it.
+
+    Work is committed in parts: the keys finished since the last commit
+    (URLs, document IDs) and, optionally, the documents they produced as a
+    compressed JSONL file. `manifest.json` lists the committed parts and is
+    replaced atomically once a part is on disk, so a crash loses at most the
+    work since the last commit. Name jobs with `job_name` so they are scoped
+    to their input. `open` resumes a job that was interrupted with the same
+    parameters and starts it over otherwise; it holds the job's lock until
+    `close`, so two sessions never run or reset the same job at once.
+    """
+
+    def __init__(self, name, jobs_dir=JOBS_DIR):
+        self.name = name
+        self.path = os.path.join(jobs_dir, name)
+        self.resumed = False
+        self._lock = threading.Lock()
+        self._job_lock = None
+        self.manifest = self.read_manifest(name, jobs_dir)
+        self.done = set()
+        for part in self.manifest['parts'] if self.manifest else []:
+            with open(os.path.join(self.path, part['name'] + '.keys.json'), 'rb') as f:
+                self.done.update(json_loads(f.read()))
+
+    @classmethod
+    def read_manifest(cls, name, jobs_dir=JOBS_DIR):
+        """The job's manifest, or None when it has never run."""
+        path = os.path.join(jobs_dir, name, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    @classmethod
+    def open(cls, name, params=None, resume=True, jobs_dir=JOBS_DIR):
+        """Resume job `name` if it was interrupted with the same `params`, else start it over.
+
+        Raises JobInUseError when the job is open elsewhere.
+        """
+        job_lock = FileLock(os.path.join(jobs_dir, name + '.lock'))
+        if not job_lock.acquire(blocking=False):
+            raise JobInUseError(f"Job {name} is already running in another session")
+        try:
+            checkpoint = cls(name, jobs_dir)
+            # Round-trip through JSON so tuples compare equal to the lists read back from the manifest
+            params = json.loads(json.dumps(params or {}))
+            if resume and checkpoint.status == 'running' and checkpoint.manifest['params'] == params:
+                checkpoint.resumed = True
+            else:
+                checkpoint.reset(params)
+        except BaseException:
+            job_lock.release()
+            raise
+        checkpoint._job_lock = job_lock
+        return checkpoint
+
+    def close(self):
+        if self._job_lock is not None:
+            self._job_lock.release()
+            self._job_lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def status(self):
+        return self.manifest['status'] if self.manifest else None
+
+    def __len__(self):
+        return len(self.done)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def _write_manifest(self):
+        self.manifest['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        tmp_path = os.path.join(self.path, MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_FILE))
+
+    def reset(self, params=None):
+        """Drop every committed part and start the job over."""
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+            self.done = set()
+            self.resumed = False
+            self.manifest = {'job': self.name, 'params': params or {}, 'status': 'running',
+                             'started_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                             'keys': 0, 'documents': 0, 'parts': []}
+            self._write_manifest()
+
+    def commit(self, keys, docs=()):
+        """Record `keys` as done, with the documents they produced. Returns the new part's name, or None."""
+        keys = list(dict.fromkeys(key for key in keys if key is not None and key not in self.done))
+        docs = list(docs)
+        if not keys and not docs:
+            return None
+        with self._lock:
+            name = f"part-{len(self.manifest['parts']) + 1:06d}"
+            if docs:
+                tmp_path = os.path.join(self.path, f"tmp-{name}.jsonl.gz")
+                write_docs_jsonl(docs, tmp_path)
+                os.replace(tmp_path, os.path.join(self.path, name + '.jsonl.gz'))
+            tmp_path = os.path.join(self.path, f"tmp-{name}.keys.json")
+            with open(tmp_path, 'wb') as f:
+                f.write(json_dumps(keys))
+            os.replace(tmp_path, os.path.join(self.path, name + '.keys.json'))
+
+            self.manifest['parts'].append({'name': name, 'keys': len(keys), 'documents': len(docs)})
+            self.manifest['keys'] += len(keys)
+            self.manifest['documents'] += len(docs)
+            self._write_manifest()
+            self.done.update(keys)
+        return name
+
+    def complete(self):
+        with self._lock:
+            self.manifest['status'] = 'complete'
+            self._write_manifest()
+
+    def documents(self):
+        """Lazily yield the documents of every committed part, in commit order."""
+        for part in self.manifest['parts'] if self.manifest else []:
+            if part['documents']:
+                yield from iter_docs_jsonl(os.path.join(self.path, part['name'] + '.jsonl.gz'))
+
+
+def docs_fingerprint(docs):
+    """A short hash identifying a document collection, to tell whether a checkpointed job ran on the same one."""
+    if isinstance(docs, ArrowDocStore):
+        stat = os.stat(docs.path)
+        return content_hash(f"{os.path.abspath(docs.path)}:{stat.st_size}:{stat.st_mtime_ns}")[:16]
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(f"{doc.metadata.get('source')}\0{doc.metadata.get('content_hash') or content_hash(doc.page_content)}\n"
+                      .encode('utf-8'))
+    return digest.hexdigest()[:16]
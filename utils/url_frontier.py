@@ -0,0 +1,253 @@
+# Deduplicated store of the URLs discovered by the crawler
+import os
+import sqlite3
+import threading
+from array import array
+from collections.abc import Mapping
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from utils.data_processing import canonicalize_url
+
+COLUMNS = ['URL', 'Type', 'Page Name', 'Scanned DateTime', 'Ignore']
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class _Codes:
+    """Interning table mapping repeated strings (link types, page titles) to small integer codes."""
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        if value is None:
+            return -1
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def value(self, code):
+        return None if code < 0 else self.values[code]
+
+    def get(self, value):
+        return self._codes.get(value)
+
+
+@lru_cache(maxsize=1024)
+def _to_timestamp(value):
+    # Every link found on a page shares the page's scan time, so this is mostly cache hits
+    if not value:
+        return 0
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp())
+    except ValueError:
+        return 0
+
+
+def _from_timestamp(value):
+    return datetime.fromtimestamp(value).strftime(_TIME_FORMAT) if value else None
+
+
+class URLFrontier:
+    """Discovered URLs, deduplicated on their canonical form.
+
+    A dict maps each canonical URL to its row number, so adding a link is
+    O(1) however many are already stored. The other columns are kept as
+    typed arrays: link type and page title are interned to integer codes
+    (most links on a page share its title), the scan time is epoch seconds
+    and Ignore is one byte. With `path` the rows are also written through
+    to SQLite, with the canonical URL as a unique key, and loaded again when
+    the frontier is reopened.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._rows = {}
+        self._urls = []
+        self._types = _Codes()
+        self._titles = _Codes()
+        self._type_codes = array('b')
+        self._title_codes = array('i')
+        self._scanned_at = array('q')
+        self._ignore = array('b')
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                "id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, type TEXT, "
+                "page_name TEXT, scanned_at INTEGER, ignore INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.commit()
+            for url, url_type, page_name, scanned_at, ignore in self._conn.execute(
+                    "SELECT url, type, page_name, scanned_at, ignore FROM urls ORDER BY id"):
+                self._append(url, url_type, page_name, scanned_at or 0, ignore)
+
+    def _append(self, url, url_type, page_name, scanned_at, ignore):
+        self._rows[url] = len(self._urls)
+        self._urls.append(url)
+        self._type_codes.append(self._types.code(url_type))
+        self._title_codes.append(self._titles.code(page_name))
+        self._scanned_at.append(scanned_at)
+        self._ignore.append(1 if ignore else 0)
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __contains__(self, url):
+        return canonicalize_url(url) in self._rows
+
+    def add(self, url, url_type=None, page_name=None, scanned_at=None, ignore=False):
+        """Add one URL; returns False when its canonical form is already stored."""
+        return self.add_many([(url, url_type, page_name, scanned_at, ignore)]) == 1
+
+    def add_many(self, rows):
+        """Add (URL, Type, Page Name, Scanned DateTime, Ignore) rows, skipping known URLs. Returns the number added."""
+        added = []
+        with self._lock:
+            for url, url_type, page_name, scanned_at, ignore in rows:
+                url = canonicalize_url(url)
+                if url in self._rows:
+                    continue
+                scanned_at = _to_timestamp(scanned_at)
+                self._append(url, url_type, page_name, scanned_at, ignore)
+                added.append((url, url_type, page_name, scanned_at, 1 if ignore else 0))
+            if self._conn is not None and added:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO urls (url, type, page_name, scanned_at, ignore) VALUES (?, ?, ?, ?, ?)",
+                    added)
+                self._conn.commit()
+        return len(added)
+
+    def set_ignore(self, row_ids, ignore):
+        """Set the Ignore flag of rows (as numbered in `page`) to `ignore`, one bool or one per row."""
+        row_ids = [int(row_id) for row_id in row_ids]
+        flags = [bool(ignore)] * len(row_ids) if isinstance(ignore, (bool, np.bool_)) else [bool(f) for f in ignore]
+        with self._lock:
+            for row_id, flag in zip(row_ids, flags):
+                self._ignore[row_id] = 1 if flag else 0
+            if self._conn is not None:
+                self._conn.executemany("UPDATE urls SET ignore = ? WHERE url = ?",
+                                       [(int(flag), self._urls[row_id]) for row_id, flag in zip(row_ids, flags)])
+                self._conn.commit()
+
+    def delete(self, row_ids):
+        """Remove rows (as numbered in `page`). Later rows are renumbered. Returns the number removed."""
+        with self._lock:
+            drop = sorted({int(row_id) for row_id in row_ids if 0 <= int(row_id) < len(self._urls)})
+            if not drop:
+                return 0
+            removed = [self._urls[row_id] for row_id in drop]
+            self._urls = np.delete(np.array(self._urls, dtype=object), drop).tolist()
+            for name in ('_type_codes', '_title_codes', '_scanned_at', '_ignore'):
+                column = getattr(self, name)
+                kept = array(column.typecode)
+                kept.frombytes(np.delete(np.frombuffer(column, dtype=column.typecode), drop).tobytes())
+                setattr(self, name, kept)
+            self._rows = {url: row_id for row_id, url in enumerate(self._urls)}
+            if self._conn is not None:
+                self._conn.executemany("DELETE FROM urls WHERE url = ?", [(url,) for url in removed])
+                self._conn.commit()
+        return len(drop)
+
+    def _selection(self, url_type=None, include_ignored=True):
+        """Row numbers matching the filters, or None for all rows."""
+        mask = None
+        if url_type is not None:
+            code = self._types.get(url_type)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            mask = np.frombuffer(self._type_codes, dtype=np.int8) == code
+        if not include_ignored:
+            kept = np.frombuffer(self._ignore, dtype=np.int8) == 0
+            mask = kept if mask is None else mask & kept
+        return None if mask is None else np.flatnonzero(mask)
+
+    def count(self, url_type=None, include_ignored=True):
+        with self._lock:
+            selection = self._selection(url_type, include_ignored)
+            return len(self._urls) if selection is None else len(selection)
+
+    def page(self, offset=0, limit=1000, url_type=None, include_ignored=True):
+        """DataFrame of up to `limit` rows from `offset`, indexed by row number, for display and editing."""
+        import pandas as pd
+
+        with self._lock:
+            selection = self._selection(url_type, include_ignored)
+            if selection is None:
+                row_ids = range(offset, min(offset + limit, len(self._urls)))
+            else:
+                row_ids = selection[offset:offset + limit].tolist()
+            rows = [(self._urls[i], self._types.value(self._type_codes[i]),
+                     self._titles.value(self._title_codes[i]), _from_timestamp(self._scanned_at[i]),
+                     bool(self._ignore[i])) for i in row_ids]
+        return pd.DataFrame(rows, columns=COLUMNS, index=pd.Index(list(row_ids), name='Row'))
+
+    def tail(self, limit=200):
+        return self.page(max(0, len(self) - limit), limit)
+
+    def urls(self, include_ignored=False):
+        with self._lock:
+            selection = self._selection(include_ignored=include_ignored)
+            if selection is None:
+                return list(self._urls)
+            return [self._urls[i] for i in selection]
+
+    def metadata(self, url):
+        """Link type, page it was found on and scan time for `url`, as chunk metadata, or None."""
+        row_id = self._rows.get(canonicalize_url(url))
+        if row_id is None:
+            return None
+        return {
+            'url_type': self._types.value(self._type_codes[row_id]),
+            'page_name': self._titles.value(self._title_codes[row_id]),
+            'scanned_at': _from_timestamp(self._scanned_at[row_id]),
+        }
+
+    def metadata_view(self):
+        """Read-only mapping of URL -> metadata, to pass as `url_metadata` to fetch_documents."""
+        return _MetadataView(self)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._urls.clear()
+            self._types = _Codes()
+            self._titles = _Codes()
+            for column in (self._type_codes, self._title_codes, self._scanned_at, self._ignore):
+                del column[:]
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM urls")
+                self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class _MetadataView(Mapping):
+    def __init__(self, frontier):
+        self._frontier = frontier
+
+    def __getitem__(self, url):
+        metadata = self._frontier.metadata(url)
+        if metadata is None:
+            raise KeyError(url)
+        return metadata
+
+    def __iter__(self):
+        return iter(self._frontier.urls(include_ignored=True))
+
+    def __len__(self):
+        return len(self._frontier)
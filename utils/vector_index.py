@@ -0,0 +1,869 @@
+# Incrementally maintained FAISS index with stable document -> vector IDs
+import functools
+import json
+import os
+import shutil
+import time
+import zipfile
+from collections.abc import Mapping
+from dataclasses import dataclass
+from datetime import datetime
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from utils.chunking import approx_token_count
+from utils.metrics import metrics
+from utils.storage_utils import FileLock, json_dumps, json_loads
+
+VECTOR_INDEX_DIR = "./out/vector_index"
+MANIFEST = "manifest.json"
+INDEX_LOCK = "index.lock"
+
+INDEX_TYPES = ("Flat", "IVF", "IVF-PQ", "HNSW")
+# Deleted vectors an HNSW graph may hide before a save compacts it
+HNSW_MAX_DELETED_FRACTION = 0.25
+DEFAULT_INDEX_PARAMS = {
+    'nlist': 1024,        # IVF: number of inverted lists (upper bound, scaled down for small corpora)
+    'nprobe': 16,         # IVF: lists visited per query
+    'pq_m': 16,           # PQ: sub-quantizers per vector
+    'pq_bits': 8,         # PQ: bits per sub-quantizer code
+    'hnsw_m': 32,         # HNSW: graph neighbours per node
+    'ef_search': 64,      # HNSW: candidate list size per query
+    'train_size': 50000,  # IVF: vectors buffered before training
+}
+
+
+def needs_training(index_type):
+    return index_type in ("IVF", "IVF-PQ")
+
+
+def build_index(index_type, dim, n_train=None, **params):
+    """Create an empty FAISS index of `index_type` that accepts explicit vector IDs.
+
+    IVF variants are sized from `n_train`: k-means wants roughly 39 training
+    points per list and PQ needs at least 2**bits points per codebook.
+    """
+    params = {**DEFAULT_INDEX_PARAMS, **params}
+    if index_type == "Flat":
+        index = faiss.index_factory(dim, "IDMap2,Flat")
+    elif index_type == "HNSW":
+        index = faiss.index_factory(dim, f"IDMap2,HNSW{params['hnsw_m']}")
+    elif needs_training(index_type):
+        n_train = n_train or params['train_size']
+        nlist = max(1, min(params['nlist'], n_train // 39))
+        if index_type == "IVF":
+            index = faiss.index_factory(dim, f"IVF{nlist},Flat")
+        else:
+            pq_m = max(m for m in range(1, min(params['pq_m'], dim) + 1) if dim % m == 0)
+            pq_bits = max(1, min(params['pq_bits'], int(np.log2(max(2, n_train)))))
+            index = faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m}x{pq_bits}")
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    set_search_params(index, params.get('nprobe'), params.get('ef_search'))
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Apply query-time knobs (IVF nprobe, HNSW efSearch) to whichever index type this is."""
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        if nprobe:
+            ivf.nprobe = min(nprobe, ivf.nlist)
+    except RuntimeError:
+        pass
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if ef_search and hasattr(inner, 'hnsw'):
+        inner.hnsw.efSearch = ef_search
+
+
+def train_index(index, vectors):
+    index.train(vectors)
+    try:
+        # Keeps reconstruct() working with arbitrary 64-bit IDs
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    except RuntimeError:
+        pass
+
+
+def _write_docs(path, items):
+    with open(path, 'w') as f:
+        for vector_id, doc in items:
+            f.write(json.dumps({'id': vector_id, 'page_content': doc.page_content, 'metadata': doc.metadata}) + '\n')
+
+
+def _read_docs(path):
+    with open(path) as f:
+        for line in f:
+            data = json.loads(line)
+            yield data['id'], Document(page_content=data['page_content'], metadata=data['metadata'])
+
+
+class VectorIndexManager:
+    """FAISS index that supports add, replace and delete by document ID.
+
+    Every vector gets a stable 64-bit ID and each document ID (the chunk's
+    `source` URL by default) maps to the vector IDs of its chunks. On disk the
+    index is a base snapshot plus an ordered list of deltas (added vectors and
+    deleted IDs) named in `manifest.json`, so a save only writes what changed
+    since the last one. `compact` folds the deltas into a new base.
+
+    `index_type` picks the FAISS structure: exact "Flat", the trained "IVF"
+    and "IVF-PQ" variants, or graph based "HNSW". IVF indexes buffer their
+    first `train_size` vectors and train on them before indexing. HNSW cannot
+    remove vectors in place, so deleted vectors stay in its graph, hidden
+    from searches by an ID selector, until `compact` rebuilds the graph
+    (which `save` does once they are more than HNSW_MAX_DELETED_FRACTION of
+    it).
+    """
+
+    def __init__(self, dim, path=VECTOR_INDEX_DIR, model_key=None, doc_id_key='source',
+                 index_type="Flat", index_params=None):
+        self.path = path
+        self.dim = dim
+        self.model_key = model_key
+        self.doc_id_key = doc_id_key
+        self.index_type = index_type
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+        self.index = None if needs_training(index_type) else build_index(index_type, dim, **self.index_params)
+        self.docstore = InMemoryDocstore({})
+        self.index_to_docstore_id = {}
+        self.doc_vectors = {}
+        self.next_id = 0
+        self.manifest = {'version': 0, 'base': None, 'deltas': []}
+        self._needs_compaction = False
+        self._pending_ids = []
+        self._pending_vectors = []
+        # HNSW vectors deleted but still in the graph; mutated in place, the search wrapper holds it
+        self._hidden_ids = set()
+        self._reset_delta()
+
+    def _reset_delta(self):
+        self._added_ids = []
+        self._added_vectors = []
+        self._deleted_ids = []
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    @property
+    def dirty(self):
+        return bool(self._added_ids or self._deleted_ids)
+
+    @property
+    def is_trained(self):
+        return self.index is not None
+
+    def __len__(self):
+        return (self.index.ntotal if self.index is not None else 0) - len(self._hidden_ids) + len(self._pending_ids)
+
+    # Mutation
+
+    def train(self):
+        """Train an IVF index on the buffered vectors and index them."""
+        if self.index is not None or not self._pending_ids:
+            return
+        vectors = np.concatenate(self._pending_vectors)
+        ids = np.asarray(self._pending_ids, dtype=np.int64)
+        sample = vectors[:self.index_params['train_size']]
+        self.index = build_index(self.index_type, self.dim, n_train=len(sample), **self.index_params)
+        train_index(self.index, sample)
+        self.index.add_with_ids(vectors, ids)
+        self._pending_ids, self._pending_vectors = [], []
+
+    def _add_vectors(self, ids, vectors, docs):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if self.index is not None:
+            self.index.add_with_ids(vectors, ids)
+        else:
+            self._pending_ids.extend(ids.tolist())
+            self._pending_vectors.append(vectors)
+            if len(self._pending_ids) >= self.index_params['train_size']:
+                self.train()
+        for vector_id, doc in zip(ids.tolist(), docs):
+            docstore_id = str(vector_id)
+            self.docstore._dict[docstore_id] = doc
+            self.index_to_docstore_id[vector_id] = docstore_id
+            self.doc_vectors.setdefault(doc.metadata.get(self.doc_id_key), []).append(vector_id)
+        self.next_id = max(self.next_id, int(ids.max()) + 1) if len(ids) else self.next_id
+
+    def _remove_from_index(self, ids):
+        removed = set(ids)
+        if self._pending_ids:
+            vectors = np.concatenate(self._pending_vectors)
+            keep = [i for i, v in enumerate(self._pending_ids) if v not in removed]
+            self._pending_ids = [self._pending_ids[i] for i in keep]
+            self._pending_vectors = [vectors[keep]]
+        if self.index is None:
+            return
+        if self.index_type == "HNSW":
+            # Rebuilding the graph costs O(N), so that waits for compact()
+            self._hidden_ids.update(v for v in removed if v in self.index_to_docstore_id)
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def _drop_hidden(self):
+        """Rebuild the HNSW graph from the vectors that are not deleted."""
+        if not self._hidden_ids:
+            return
+        keep_ids = np.asarray(list(self.index_to_docstore_id), dtype=np.int64)
+        vectors = self.index.reconstruct_batch(keep_ids) if len(keep_ids) else None
+        self.index.reset()
+        if vectors is not None:
+            self.index.add_with_ids(vectors, keep_ids)
+        self._hidden_ids.clear()
+
+    def _remove_vectors(self, ids):
+        if not ids:
+            return
+        self._remove_from_index(ids)
+        for vector_id in ids:
+            doc = self.docstore._dict.pop(str(vector_id), None)
+            self.index_to_docstore_id.pop(vector_id, None)
+            if doc is not None:
+                doc_id = doc.metadata.get(self.doc_id_key)
+                remaining = [v for v in self.doc_vectors.get(doc_id, []) if v != vector_id]
+                if remaining:
+                    self.doc_vectors[doc_id] = remaining
+                else:
+                    self.doc_vectors.pop(doc_id, None)
+
+    def add_embeddings(self, docs, vectors):
+        """Append pre-computed vectors for `docs` and return their vector IDs."""
+        docs = list(docs)
+        if not docs:
+            return []
+        ids = list(range(self.next_id, self.next_id + len(docs)))
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._add_vectors(ids, vectors, docs)
+        self._added_ids.extend(ids)
+        self._added_vectors.append(vectors)
+        return ids
+
+    def add_documents(self, docs, embeddings):
+        docs = list(docs)
+        if not docs:
+            return []
+        vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+        return self.add_embeddings(docs, vectors)
+
+    def delete(self, doc_ids):
+        """Remove every vector belonging to `doc_ids`. Returns the number of vectors removed."""
+        ids = [v for doc_id in doc_ids for v in self.doc_vectors.get(doc_id, [])]
+        self._remove_vectors(ids)
+        removed, added = set(ids), set(self._added_ids)
+        # Vectors added and deleted within the same delta never need to hit disk
+        self._deleted_ids.extend(v for v in ids if v not in added)
+        if added & removed:
+            keep = [i for i, v in enumerate(self._added_ids) if v not in removed]
+            vectors = np.concatenate(self._added_vectors)
+            self._added_ids = [self._added_ids[i] for i in keep]
+            self._added_vectors = [vectors[keep]]
+        return len(ids)
+
+    def chunk_hashes(self, doc_id):
+        return sorted(self.docstore._dict[str(v)].metadata.get('chunk_hash') or ''
+                      for v in self.doc_vectors.get(doc_id, []))
+
+    def upsert_documents(self, docs, embeddings):
+        """Replace the chunks of every document in `docs`, skipping documents whose chunks are unchanged.
+
+        Returns (added, removed, unchanged) document counts.
+        """
+        by_doc = {}
+        for doc in docs:
+            by_doc.setdefault(doc.metadata.get(self.doc_id_key), []).append(doc)
+
+        changed, unchanged = {}, 0
+        for doc_id, chunks in by_doc.items():
+            new_hashes = sorted(chunk.metadata.get('chunk_hash') or '' for chunk in chunks)
+            if doc_id in self.doc_vectors and '' not in new_hashes and new_hashes == self.chunk_hashes(doc_id):
+                unchanged += 1
+            else:
+                changed[doc_id] = chunks
+
+        removed = sum(1 for doc_id in changed if doc_id in self.doc_vectors)
+        new_chunks = [chunk for chunks in changed.values() for chunk in chunks]
+        # Embed before deleting, so a failed embedding call leaves the old vectors in place
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in new_chunks]) if new_chunks else []
+        self.delete(changed)
+        self.add_embeddings(new_chunks, vectors)
+        return len(changed) - removed, removed, unchanged
+
+    def clear(self, index_type=None, index_params=None):
+        """Drop every vector, optionally switching index type.
+
+        The next save writes a fresh base and removes the old files.
+        """
+        self.index_type = index_type or self.index_type
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **self.index_params, **(index_params or {})}
+        self.index = None if needs_training(self.index_type) else build_index(self.index_type, self.dim, **self.index_params)
+        self._pending_ids, self._pending_vectors = [], []
+        self._hidden_ids.clear()
+        self.docstore._dict.clear()
+        self.index_to_docstore_id.clear()
+        self.doc_vectors.clear()
+        self._reset_delta()
+        self._needs_compaction = True
+
+    # Persistence
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def _check_current(self):
+        # Another session or process may have saved since this manager was opened; writing now would
+        # reuse its delta name and vector IDs
+        on_disk = self.read_manifest(self.path)['version'] if self.exists(self.path) else 0
+        if on_disk != self.version:
+            raise RuntimeError(f"Index at {self.path} is at version {on_disk}, this copy is at {self.version}; "
+                               "reopen it under index_lock before changing it")
+
+    def _next_name(self, kind):
+        return f"{kind}-{self.manifest['version'] + 1:06d}"
+
+    def save(self):
+        """Persist changes since the last save as a new delta. Returns the new version."""
+        os.makedirs(self.path, exist_ok=True)
+        if self.manifest['base'] is None or self._needs_compaction:
+            return self.compact()
+        if not self.dirty:
+            return self.version
+        if self.index is not None and len(self._hidden_ids) > HNSW_MAX_DELETED_FRACTION * self.index.ntotal:
+            return self.compact()
+        self._check_current()
+
+        name = self._next_name('delta')
+        delta_dir = os.path.join(self.path, name)
+        os.makedirs(delta_dir, exist_ok=True)
+        vectors = np.concatenate(self._added_vectors) if self._added_vectors else np.empty((0, self.dim), np.float32)
+        np.save(os.path.join(delta_dir, 'ids.npy'), np.asarray(self._added_ids, dtype=np.int64))
+        np.save(os.path.join(delta_dir, 'vectors.npy'), vectors.astype(np.float32))
+        np.save(os.path.join(delta_dir, 'deleted.npy'), np.asarray(self._deleted_ids, dtype=np.int64))
+        _write_docs(os.path.join(delta_dir, 'docs.jsonl'),
+                    ((v, self.docstore._dict[str(v)]) for v in self._added_ids))
+
+        self.manifest['deltas'].append(name)
+        self.manifest['version'] += 1
+        self.manifest['next_id'] = self.next_id
+        self._write_manifest()
+        self._reset_delta()
+        return self.version
+
+    def compact(self):
+        """Write the whole index as a new base snapshot and drop the old base and deltas."""
+        os.makedirs(self.path, exist_ok=True)
+        self._check_current()
+        # A snapshot must contain a usable index, so train on whatever has been buffered
+        self.train()
+        self._drop_hidden()
+        name = self._next_name('base')
+        base_dir = os.path.join(self.path, name)
+        os.makedirs(base_dir, exist_ok=True)
+        if self.index is not None:
+            faiss.write_index(self.index, os.path.join(base_dir, 'index.faiss'))
+        _write_docs(os.path.join(base_dir, 'docs.jsonl'),
+                    ((v, self.docstore._dict[s]) for v, s in self.index_to_docstore_id.items()))
+
+        stale = ([self.manifest['base']] if self.manifest['base'] else []) + self.manifest['deltas']
+        self.manifest.update({
+            'version': self.manifest['version'] + 1,
+            'base': name,
+            'deltas': [],
+            'dim': self.dim,
+            'model_key': self.model_key,
+            'doc_id_key': self.doc_id_key,
+            'index_type': self.index_type,
+            'index_params': self.index_params,
+            'next_id': self.next_id,
+        })
+        self._write_manifest()
+        self._reset_delta()
+        self._needs_compaction = False
+        for old in stale:
+            shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+        return self.version
+
+    @classmethod
+    def exists(cls, path=VECTOR_INDEX_DIR):
+        return os.path.exists(os.path.join(path, MANIFEST))
+
+    @classmethod
+    def read_manifest(cls, path=VECTOR_INDEX_DIR):
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+
+    @classmethod
+    def open(cls, path=VECTOR_INDEX_DIR, model_key=None):
+        """Load the current version: the base snapshot with every delta applied in order."""
+        manifest = cls.read_manifest(path)
+        if model_key is not None and manifest.get('model_key') not in (None, model_key):
+            raise ValueError(f"Index at {path} was built with {manifest['model_key']}, not {model_key}")
+
+        manager = cls(manifest['dim'], path=path, model_key=manifest.get('model_key'),
+                      doc_id_key=manifest.get('doc_id_key', 'source'),
+                      index_type=manifest.get('index_type', "Flat"),
+                      index_params=manifest.get('index_params'))
+        base_dir = os.path.join(path, manifest['base'])
+        index_path = os.path.join(base_dir, 'index.faiss')
+        if os.path.exists(index_path):
+            # An untrained IVF index with no vectors yet is saved without an index file
+            manager.index = faiss.read_index(index_path)
+            set_search_params(manager.index, manager.index_params['nprobe'], manager.index_params['ef_search'])
+        for vector_id, doc in _read_docs(os.path.join(base_dir, 'docs.jsonl')):
+            docstore_id = str(vector_id)
+            manager.docstore._dict[docstore_id] = doc
+            manager.index_to_docstore_id[vector_id] = docstore_id
+            manager.doc_vectors.setdefault(doc.metadata.get(manager.doc_id_key), []).append(vector_id)
+
+        for name in manifest['deltas']:
+            delta_dir = os.path.join(path, name)
+            manager._remove_vectors(np.load(os.path.join(delta_dir, 'deleted.npy')).tolist())
+            ids = np.load(os.path.join(delta_dir, 'ids.npy'))
+            if len(ids):
+                docs = [doc for _, doc in _read_docs(os.path.join(delta_dir, 'docs.jsonl'))]
+                manager._add_vectors(ids, np.load(os.path.join(delta_dir, 'vectors.npy')), docs)
+
+        manager.next_id = max(manager.next_id, manifest.get('next_id', 0))
+        manager.manifest = manifest
+        return manager
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        self.index_params.update({k: v for k, v in (('nprobe', nprobe), ('ef_search', ef_search)) if v})
+        if self.index is not None:
+            set_search_params(self.index, nprobe, ef_search)
+
+    def vectors(self):
+        """Return (ids, vectors) for everything in the index, reconstructed from FAISS."""
+        self.train()
+        ids = np.asarray(list(self.index_to_docstore_id), dtype=np.int64)
+        if not len(ids):
+            return ids, np.empty((0, self.dim), dtype=np.float32)
+        return ids, self.index.reconstruct_batch(ids)
+
+    def as_vectorstore(self, embedding):
+        """A langchain FAISS vector store view sharing this manager's index and docstore.
+
+        Rebuilding operations (training, clear) replace the index object, so
+        take a new view after mutating the manager.
+        """
+        self.train()
+        if self.index_type == "HNSW" and not isinstance(self.index.__dict__.get('search'), functools.partial):
+            # langchain searches without parameters, so deleted vectors are hidden by the index's own search
+            self.index.search = functools.partial(_search_visible, self.index.search, self.index, self._hidden_ids)
+        return FAISS(embedding, self.index, self.docstore, self.index_to_docstore_id)
+
+
+def _search_visible(search, index, hidden_ids, x, k, params=None, **kwargs):
+    """`index.search` skipping `hidden_ids`, unless the caller passes its own selector."""
+    if hidden_ids and params is None:
+        hidden = np.fromiter(hidden_ids, dtype=np.int64, count=len(hidden_ids))
+        batch = faiss.IDSelectorBatch(len(hidden), faiss.swig_ptr(hidden))
+        selector = faiss.IDSelectorNot(batch)
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+        # batch and selector must stay referenced until the search returns
+        return search(x, k, params=params, **kwargs)
+    return search(x, k, params=params, **kwargs)
+
+
+def index_lock(path=VECTOR_INDEX_DIR):
+    """Inter-process lock for the index at `path`.
+
+    Hold it from opening the index until the last save: sessions and
+    pipeline runs share the index directory, and two writers would take the
+    same vector IDs and delta names.
+    """
+    return FileLock(os.path.join(path, INDEX_LOCK))
+
+
+def open_or_create_index(embeddings, path=VECTOR_INDEX_DIR, model_key=None, rebuild=False,
+                         index_type=None, index_params=None):
+    """Open the index at `path`, or start a new one sized for `embeddings`.
+
+    The existing index is cleared (keeping its version history) when
+    `rebuild` is set, when it was built with a different model, or when a
+    different `index_type` is requested. Call it under `index_lock(path)`
+    when the index will be changed.
+    """
+    if VectorIndexManager.exists(path):
+        manifest = VectorIndexManager.read_manifest(path)
+        manager = VectorIndexManager.open(path)
+        if (rebuild or (model_key is not None and manifest.get('model_key') != model_key)
+                or (index_type is not None and index_type != manager.index_type)):
+            manager.model_key = model_key
+            manager.dim = len(embeddings.embed_query("dimension probe"))
+            manager.clear(index_type, index_params)
+        elif index_params:
+            manager.set_search_params(index_params.get('nprobe'), index_params.get('ef_search'))
+        return manager
+    dim = len(embeddings.embed_query("dimension probe"))
+    return VectorIndexManager(dim, path=path, model_key=model_key,
+                              index_type=index_type or "Flat", index_params=index_params)
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def benchmark_index_types(vectors, index_types=INDEX_TYPES, k=10, n_queries=200, seed=0, **params):
+    """Compare index types on `vectors` against exact search.
+
+    A random sample of `n_queries` vectors is held out as queries and the
+    rest is indexed. For each type this reports recall@k against the flat
+    index, single-query p50/p99 latency, the serialized index size and the
+    growth in resident memory while building it.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    n_queries = min(n_queries, max(1, len(vectors) // 10))
+    queries, base = vectors[order[:n_queries]], vectors[order[n_queries:]]
+    k = min(k, len(base))
+    ids = np.arange(len(base), dtype=np.int64)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(base)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        rss_before = _rss_bytes()
+        build_start = time.perf_counter()
+        index = build_index(index_type, vectors.shape[1], n_train=len(base), **params)
+        if needs_training(index_type):
+            train_index(index, base[:params.get('train_size', DEFAULT_INDEX_PARAMS['train_size'])])
+        index.add_with_ids(base, ids)
+        build_seconds = time.perf_counter() - build_start
+        rss_after = _rss_bytes()
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query[None, :], k)
+            latencies.append(time.perf_counter() - start)
+        _, found = index.search(queries, k)
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+
+        rows.append({
+            'Index': index_type,
+            f'Recall@{k}': round(float(recall), 4),
+            'p50 ms': round(float(np.percentile(latencies, 50)) * 1000, 3),
+            'p99 ms': round(float(np.percentile(latencies, 99)) * 1000, 3),
+            'Index MB': round(len(faiss.serialize_index(index)) / 1e6, 2),
+            'RSS growth MB': round((rss_after - rss_before) / 1e6, 2) if rss_before is not None else None,
+            'Build s': round(build_seconds, 2),
+        })
+        del index
+    return rows
+
+
+@dataclass
+class EncodeProgress:
+    total_documents: int = None
+    documents: int = 0
+    chunks: int = 0
+    tokens: int = 0
+    added: int = 0
+    replaced: int = 0
+    unchanged: int = 0
+    elapsed: float = 0.0
+    cancelled: bool = False
+
+    @property
+    def docs_per_second(self):
+        return self.documents / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.tokens / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def fraction(self):
+        if not self.total_documents:
+            return None
+        return min(1.0, self.documents / self.total_documents)
+
+    @property
+    def eta_seconds(self):
+        if not self.total_documents or not self.documents:
+            return None
+        return (self.total_documents - self.documents) / self.docs_per_second
+
+
+def batch_by_document(chunks, batch_size, doc_id_key='source'):
+    """Group chunks into batches of about `batch_size`, never splitting one document's chunks."""
+    batch, current = [], object()
+    for chunk in chunks:
+        doc_id = chunk.metadata.get(doc_id_key)
+        if len(batch) >= batch_size and doc_id != current:
+            yield batch
+            batch = []
+        batch.append(chunk)
+        current = doc_id
+    if batch:
+        yield batch
+
+
+def encode_into_index(chunks, vector_index, embeddings, batch_size=256, total_documents=None,
+                      save_every=20, on_progress=None, cancel_event=None, checkpoint=None):
+    """Embed `chunks` batch by batch and upsert each batch into `vector_index`.
+
+    Only one batch of texts and vectors is held at a time and the index is
+    saved every `save_every` batches, so pending delta vectors do not pile up
+    either. `on_progress` is called with an EncodeProgress after each batch.
+    Setting `cancel_event` (a threading.Event) stops after the current batch;
+    work done so far is saved in both cases, including when the caller is
+    interrupted by an exception. With a `checkpoint` (a
+    storage_utils.JobCheckpoint) the IDs of the documents in the index are
+    committed after every save, and the job is marked complete once all
+    chunks are encoded, so a rerun can skip the documents already done.
+    """
+    progress = EncodeProgress(total_documents=total_documents)
+    start = time.perf_counter()
+    encoded_doc_ids = []
+    finished = False
+
+    def save():
+        vector_index.save()
+        if checkpoint is not None:
+            # Only after the save: a committed document must be in the index on disk
+            checkpoint.commit(encoded_doc_ids)
+            encoded_doc_ids.clear()
+
+    try:
+        for batch_number, batch in enumerate(batch_by_document(chunks, batch_size, vector_index.doc_id_key), 1):
+            if cancel_event is not None and cancel_event.is_set():
+                progress.cancelled = True
+                break
+            with metrics.span('encode_batch', chunks=len(batch)):
+                added, replaced, unchanged = vector_index.upsert_documents(batch, embeddings)
+            metrics.count('encoded_chunks_total', len(batch), help="Chunks embedded and upserted into the index")
+            encoded_doc_ids.extend(chunk.metadata.get(vector_index.doc_id_key) for chunk in batch)
+            progress.added += added
+            progress.replaced += replaced
+            progress.unchanged += unchanged
+            progress.documents += added + replaced + unchanged
+            progress.chunks += len(batch)
+            progress.tokens += sum(approx_token_count(chunk.page_content) for chunk in batch)
+            progress.elapsed = time.perf_counter() - start
+            if batch_number % save_every == 0:
+                save()
+            if on_progress is not None:
+                on_progress(progress)
+        finished = not progress.cancelled
+    finally:
+        save()
+        if checkpoint is not None and finished:
+            checkpoint.complete()
+        progress.elapsed = time.perf_counter() - start
+    return progress
+
+
+PACKAGE_FORMAT = "knowledge-navigator-vectors"
+PACKAGE_CACHE_DIR = "./out/packages"
+PACKAGE_MEMBERS = ("manifest.json", "index.faiss", "docs.arrow")
+
+
+def package_manifest(embedding_model_name, vector_index=None):
+    """Manifest fields describing how a package's vectors were produced."""
+    manifest = {'embedding_model': embedding_model_name, 'created': datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}
+    if vector_index is not None:
+        manifest.update({
+            'model_key': vector_index.model_key,
+            'index_type': vector_index.index_type,
+            'index_params': vector_index.index_params,
+            'index_version': vector_index.version,
+        })
+    return manifest
+
+
+@metrics.timed('write_package')
+def write_vector_package(vectorstore, path, manifest=None, batch_size=1024):
+    """Stream a langchain FAISS vector store into a zip package at `path`.
+
+    The index is serialized straight into the archive through a FAISS
+    callback writer and the docstore is written as an Arrow file sorted by
+    vector ID, so nothing is staged in a temp directory or held in memory
+    as a whole. Members are stored uncompressed, which keeps them
+    contiguous in the archive and cheap to copy out.
+    """
+    import pyarrow as pa
+
+    ids = sorted(vectorstore.index_to_docstore_id)
+    manifest = {
+        'format': PACKAGE_FORMAT,
+        'format_version': 1,
+        'count': len(ids),
+        'dim': vectorstore.index.d,
+        **(manifest or {}),
+    }
+    schema = pa.schema([('vid', pa.int64()), ('page_content', pa.large_string()), ('metadata', pa.string())])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as package:
+        package.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+        with package.open('index.faiss', 'w', force_zip64=True) as member:
+            writer = faiss.PyCallbackIOWriter(member.write)
+            faiss.write_index(_without_hidden(vectorstore.index, ids), writer)
+            del writer
+
+        with package.open('docs.arrow', 'w', force_zip64=True) as member:
+            sink = pa.PythonFile(member, mode='w')
+            with pa.ipc.new_file(sink, schema) as arrow_writer:
+                for start in range(0, len(ids), batch_size):
+                    batch_ids = ids[start:start + batch_size]
+                    docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in batch_ids]
+                    arrow_writer.write_batch(pa.RecordBatch.from_arrays([
+                        pa.array(batch_ids, pa.int64()),
+                        pa.array([doc.page_content for doc in docs], pa.large_string()),
+                        pa.array([json_dumps(doc.metadata).decode('utf-8') for doc in docs]),
+                    ], schema=schema))
+    os.replace(tmp_path, path)
+    return path
+
+
+def _without_hidden(index, ids):
+    """`index`, or a copy holding only `ids` when it still holds deleted HNSW vectors."""
+    if index.ntotal <= len(ids):
+        return index
+    ids = np.asarray(ids, dtype=np.int64)
+    vectors = index.reconstruct_batch(ids) if len(ids) else None
+    copy = faiss.clone_index(index)
+    copy.reset()
+    if vectors is not None:
+        copy.add_with_ids(vectors, ids)
+    return copy
+
+
+def is_vector_package(zip_file):
+    return 'manifest.json' in zipfile.ZipFile(zip_file).namelist()
+
+
+def extract_vector_package(zip_file, key, cache_dir=PACKAGE_CACHE_DIR):
+    """Copy the package members into `cache_dir/key` unless already there. Returns the directory.
+
+    Extraction happens once per package, so every session (and process)
+    opening it memory-maps the same files and shares their pages.
+    """
+    target = os.path.join(cache_dir, key)
+    if all(os.path.exists(os.path.join(target, name)) for name in PACKAGE_MEMBERS):
+        return target
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    os.makedirs(tmp_target, exist_ok=True)
+    with zipfile.ZipFile(zip_file) as package:
+        for name in PACKAGE_MEMBERS:
+            with package.open(name) as source, open(os.path.join(tmp_target, name), 'wb') as dest:
+                shutil.copyfileobj(source, dest, 1 << 20)
+    try:
+        os.replace(tmp_target, target)
+    except OSError:
+        # Another session extracted the same package first
+        shutil.rmtree(tmp_target, ignore_errors=True)
+    return target
+
+
+class PackageDocstore(Docstore):
+    """Read-only docstore over a package's memory-mapped `docs.arrow`.
+
+    Rows are sorted by vector ID, so a lookup is a binary search over the
+    (zero-copy) ID column followed by decoding a single row.
+    """
+
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self._reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        self._batches = [self._reader.get_batch(i) for i in range(self._reader.num_record_batches)]
+        self._first_ids = np.asarray([batch.column('vid')[0].as_py() for batch in self._batches if batch.num_rows],
+                                     dtype=np.int64)
+
+    def __len__(self):
+        return sum(batch.num_rows for batch in self._batches)
+
+    def ids(self):
+        for batch in self._batches:
+            yield from batch.column('vid').to_numpy().tolist()
+
+    def iter_metadata(self):
+        """(vector ID, metadata) for every row, decoded a batch at a time without the page content."""
+        for batch in self._batches:
+            yield from zip(batch.column('vid').to_numpy().tolist(),
+                           map(json_loads, batch.column('metadata').to_pylist()))
+
+    def search(self, search):
+        search = int(search)
+        position = int(np.searchsorted(self._first_ids, search, side='right')) - 1
+        if position >= 0:
+            batch = self._batches[position]
+            column = batch.column('vid').to_numpy()
+            row = int(np.searchsorted(column, search))
+            if row < len(column) and column[row] == search:
+                return Document(page_content=batch.column('page_content')[row].as_py(),
+                                metadata=json_loads(batch.column('metadata')[row].as_py()))
+        return f"ID {search} not found."
+
+    def add(self, texts):
+        raise NotImplementedError("Packaged vector stores are read-only")
+
+    def delete(self, ids):
+        raise NotImplementedError("Packaged vector stores are read-only")
+
+
+class _IdentityIdMap(Mapping):
+    """index_to_docstore_id for packages: FAISS ids are the docstore ids."""
+
+    def __init__(self, docstore):
+        self._docstore = docstore
+
+    def __getitem__(self, key):
+        return int(key)
+
+    def __iter__(self):
+        return self._docstore.ids()
+
+    def __len__(self):
+        return len(self._docstore)
+
+
+def read_index_mmap(path):
+    """Read a FAISS index memory-mapped where the index type allows it.
+
+    Flat codes map with IO_FLAG_MMAP_IFC (newer FAISS), IVF inverted lists
+    with IO_FLAG_MMAP; the two cannot be combined for IVF, hence the
+    fallbacks, ending with a regular read.
+    """
+    candidates = [faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY, 0]
+    if hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        candidates.insert(0, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    for flags in candidates[:-1]:
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError:
+            continue
+    return faiss.read_index(path)
+
+
+def open_vector_package(directory, embedding):
+    """Open an extracted package in place: the index and docstore are memory-mapped, not loaded."""
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    index = read_index_mmap(os.path.join(directory, 'index.faiss'))
+    params = manifest.get('index_params') or {}
+    set_search_params(index, params.get('nprobe'), params.get('ef_search'))
+    docstore = PackageDocstore(os.path.join(directory, 'docs.arrow'))
+    return FAISS(embedding, index, docstore, _IdentityIdMap(docstore)), manifest